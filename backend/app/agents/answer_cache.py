@@ -0,0 +1,172 @@
+import threading
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+import numpy as np
+from pydantic import BaseModel, ConfigDict
+from ..metrics import ANSWER_CACHE_LOOKUPS, ANSWER_CACHE_SAVED_SECONDS
+
+class AnswerCacheStats(BaseModel):
+    """
+    Counters of an AnswerCache.
+
+    Attributes:
+        lookups (int): Questions looked up
+        hits (int): Questions answered from the cache
+        stores (int): Answers stored
+        evictions (int): Least recently used answers dropped to stay within max_entries
+        invalidations (int): Answers dropped because their table changed
+        entries (int): Answers currently held
+        max_entries (int): Maximum number of answers held
+        saved_seconds (float): Retrieval and generation time of the answers replayed from the cache
+    """
+    lookups: int = 0
+    hits: int = 0
+    stores: int = 0
+    evictions: int = 0
+    invalidations: int = 0
+    entries: int = 0
+    max_entries: int = 0
+    saved_seconds: float = 0.0
+
+    @property
+    def hit_ratio(self) -> float:
+        return self.hits / self.lookups if self.lookups else 0.0
+
+class CachedAnswer(BaseModel):
+    """
+    An answer with the table version it was retrieved from.
+
+    Attributes:
+        scope (Tuple[str, str]): Table name and retrieval mode the answer was retrieved with
+        table_version (int): Version of the table when the answer was retrieved
+        vector (np.ndarray): Unit length embedding of the question
+        answer (str): The generated answer
+        sources (List[str]): The references of the answer
+        seconds (float): Time the retrieval and generation took
+    """
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    scope: Tuple[str, str]
+    table_version: int
+    vector: np.ndarray
+    answer: str
+    sources: List[str]
+    seconds: float
+
+class AnswerCache:
+    """
+    Replays stored answers for questions whose embedding is close to one answered before.
+
+    A question matches when the cosine similarity of its embedding to a stored question is at least
+    `similarity_threshold`, on the same table and retrieval mode. Answers are tied to the table version
+    they were retrieved from, so once ingestion or deletion changes the table they are dropped.
+    The least recently used answers are evicted beyond `max_entries`; a lookup is a single
+    matrix-vector product over the stored embeddings of the scope.
+
+    Args
+    - max_entries (int): Maximum number of answers held.
+    - similarity_threshold (float): Minimum cosine similarity of two questions to share an answer.
+    """
+    def __init__(self, max_entries: int = 1000, similarity_threshold: float = 0.95):
+        self.max_entries = max_entries
+        self.similarity_threshold = similarity_threshold
+        self._entries: "OrderedDict[int, CachedAnswer]" = OrderedDict()
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self._stats = AnswerCacheStats(max_entries=max_entries)
+
+    @staticmethod
+    def _unit(query_vector: List[float]) -> np.ndarray:
+        vector = np.asarray(query_vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def lookup(
+        self,
+        query_vector: List[float],
+        table_name: str,
+        retrieval_mode: str,
+        table_version: int
+    ) -> Optional[CachedAnswer]:
+        """
+        Finds the stored answer of the most similar question on the same table version.
+
+        Args
+        - query_vector (List[float]): The vectorised user question.
+        - table_name (str): The table, or the comma separated collections, the answer is retrieved from.
+        - retrieval_mode (str): The retrieval mode of the answer.
+        - table_version (int): The current version of the table, see SemanticDb.collection_version.
+
+        Returns
+        - answer (Optional[CachedAnswer]): The stored answer, None on a miss.
+        """
+        vector = self._unit(query_vector)
+        scope = (table_name, retrieval_mode)
+        with self._lock:
+            self._stats.lookups += 1
+            stale = [i for i, e in self._entries.items() if e.scope == scope and e.table_version != table_version]
+            for i in stale:
+                del self._entries[i]
+            self._stats.invalidations += len(stale)
+
+            candidates = [(i, e) for i, e in self._entries.items() if e.scope == scope]
+            best = None
+            if candidates:
+                similarities = np.stack([e.vector for _, e in candidates]) @ vector
+                index = int(np.argmax(similarities))
+                if similarities[index] >= self.similarity_threshold:
+                    best_id, best = candidates[index]
+                    self._entries.move_to_end(best_id)
+                    self._stats.hits += 1
+                    self._stats.saved_seconds += best.seconds
+        if best is None:
+            ANSWER_CACHE_LOOKUPS.inc(result="miss")
+        else:
+            ANSWER_CACHE_LOOKUPS.inc(result="hit")
+            ANSWER_CACHE_SAVED_SECONDS.inc(best.seconds)
+        return best
+
+    def store(
+        self,
+        query_vector: List[float],
+        table_name: str,
+        retrieval_mode: str,
+        table_version: int,
+        answer: str,
+        sources: List[str],
+        seconds: float
+    ):
+        """
+        Stores a complete answer, evicting the least recently used answers beyond max_entries.
+
+        Args
+        - query_vector (List[float]): The vectorised user question.
+        - table_name (str): The table, or the comma separated collections, the answer is retrieved from.
+        - retrieval_mode (str): The retrieval mode of the answer.
+        - table_version (int): The version of the table the answer was retrieved from.
+        - answer (str): The generated answer.
+        - sources (List[str]): The references of the answer.
+        - seconds (float): Time the retrieval and generation took.
+        """
+        if self.max_entries <= 0:
+            return
+        entry = CachedAnswer(
+            scope=(table_name, retrieval_mode),
+            table_version=table_version,
+            vector=self._unit(query_vector),
+            answer=answer,
+            sources=sources,
+            seconds=seconds
+        )
+        with self._lock:
+            self._entries[self._next_id] = entry
+            self._next_id += 1
+            self._stats.stores += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._stats.evictions += 1
+
+    def stats(self) -> AnswerCacheStats:
+        """Returns a snapshot of the cache counters."""
+        with self._lock:
+            return self._stats.model_copy(update={"entries": len(self._entries)})
@@ -1,9 +1,12 @@
 import json
-from typing import List
+from typing import Dict, List, Optional
 import requests
 from dotenv import load_dotenv
 import os
-from ..models import Message, ContentStream
+from ..metrics import RAG_PROMPT_CHARS
+from ..models import AsyncContentStream, Message, ContentStream, StreamFrame
+from .conversation import history_prompt, history_turns, session_store
+from .llm import GenerationTimer, decode_generate_line, generation_stats, stream_generate
 
 load_dotenv()
 llm_model = os.getenv("LLM_MODEL")
@@ -11,25 +14,60 @@ llm_generate_url = os.getenv("LLM_GENERATE_URL")
 
 def run_agent(messages: List[Message],) -> ContentStream:
 
-    # Get the latest user message
+    # Get the latest user message, after the earlier turns
     user_question = messages[-1].content
+    prompt = history_prompt(messages, history_turns) + user_question
+    RAG_PROMPT_CHARS.observe(len(prompt), agent="chat")
+    timer = GenerationTimer("chat")
 
     # Send the POST request with streaming enabled
-    with requests.post(
-            llm_generate_url, 
-            json={
-                "model": llm_model, 
-                "prompt": user_question
-            }, 
-            stream=True
-        ) as r:
-        # Ensure the response is successful
-        r.raise_for_status()
-        # Process the streamed response
-        for chunk in r.iter_lines(decode_unicode=True):
-            if chunk:
-                try:
-                    data = json.loads(chunk)
-                    yield data.get("response", "")
-                except json.JSONDecodeError:
-                    yield f"Error decoding response chunk: {chunk}"
\ No newline at end of file
+    try:
+        with requests.post(
+                llm_generate_url, 
+                json={
+                    "model": llm_model, 
+                    "prompt": prompt
+                }, 
+                stream=True
+            ) as r:
+            # Ensure the response is successful
+            r.raise_for_status()
+            # Process the streamed response
+            for chunk in r.iter_lines(decode_unicode=True):
+                if chunk:
+                    try:
+                        data = decode_generate_line(chunk)
+                        timer.on_line(data)
+                        yield data.get("response", "")
+                    except json.JSONDecodeError:
+                        yield f"Error decoding response chunk: {chunk}"
+    except Exception:
+        timer.finish(failed=True)
+        raise
+    timer.finish()
+
+async def run_agent_async(
+    messages: List[Message],
+    timings: Optional[Dict[str, float]] = None,
+    session_id: Optional[str] = None
+    ) -> AsyncContentStream:
+    """
+    Async version of run_agent over the shared pooled HTTP client.
+    Cancelling the stream (e.g. when the client disconnects) aborts the upstream generation.
+    `timings` is filled with the duration of each stage, used for timing headers.
+    With a `session_id` follow-up questions continue the Ollama context of the earlier turns,
+    so only the new question is evaluated instead of the whole history.
+    The answer is streamed as strings, followed by a stats frame with the token counts of the generation.
+    """
+
+    # Get the latest user message, the earlier turns are either in the context or put in the prompt
+    user_question = messages[-1].content
+    context = session_store.context_for(session_id, messages, agent="chat")
+    prompt = user_question if context else history_prompt(messages, history_turns) + user_question
+    RAG_PROMPT_CHARS.observe(len(prompt), agent="chat")
+
+    done = {}
+    async for token in stream_generate(prompt, agent="chat", timings=timings, context=context, on_done=done.update):
+        yield token
+    session_store.update(session_id, messages, done.get("context"))
+    yield StreamFrame(event="stats", data=generation_stats(done))
@@ -0,0 +1,74 @@
+import re
+from typing import TYPE_CHECKING, List, Set
+
+if TYPE_CHECKING:
+    from ..semantic_db.semantic_db import RagSearchResult
+
+# Rough size of a token in characters for English text with Llama style tokenizers
+CHARS_PER_TOKEN = 4
+
+def estimate_tokens(text: str) -> int:
+    """Cheap estimate of the number of LLM tokens in a text."""
+    return len(text) // CHARS_PER_TOKEN + 1
+
+def _words(text: str) -> Set[str]:
+    return set(re.findall(r"\w+", text.lower()))
+
+def is_near_duplicate(words: Set[str], packed_words: List[Set[str]], threshold: float = 0.8) -> bool:
+    """
+    Whether a chunk mostly repeats an already packed chunk, e.g. the overlapping window of the same page
+    or the same page in two revisions of a document.
+
+    Args
+    - words (Set[str]): The words of the candidate chunk.
+    - packed_words (List[Set[str]]): The words of each chunk packed so far.
+    - threshold (float): Share of the candidate's words found in a packed chunk above which it is a duplicate.
+
+    Returns
+    - (bool): True if the candidate adds little new content.
+    """
+    if not words:
+        return True
+    for other in packed_words:
+        if len(words & other) / len(words) >= threshold:
+            return True
+    return False
+
+def pack_context(
+    results: List["RagSearchResult"],
+    token_budget: int,
+    duplicate_threshold: float = 0.8
+) -> List["RagSearchResult"]:
+    """
+    Fills a fixed token budget with the best scoring chunks, skipping near duplicates, so the prompt size
+    stays bounded however dense the retrieved pages are.
+
+    Args
+    - results (List[RagSearchResult]): The search results, best first.
+    - token_budget (int): Maximum estimated tokens of retrieved content in the prompt.
+    - duplicate_threshold (float): Word overlap above which a chunk counts as a duplicate of a packed one.
+
+    Returns
+    - packed (List[RagSearchResult]): The chunks to put in the prompt, best first. If even the best chunk
+      is over budget it is truncated to fit.
+    """
+    packed: List["RagSearchResult"] = []
+    packed_words: List[Set[str]] = []
+    used_tokens = 0
+    for r in results:
+        words = _words(r.text)
+        if is_near_duplicate(words, packed_words, duplicate_threshold):
+            continue
+        tokens = estimate_tokens(r.text)
+        if used_tokens + tokens > token_budget:
+            if packed:
+                # A smaller chunk further down may still fit
+                continue
+            r = r.model_copy(update={"text": r.text[:token_budget * CHARS_PER_TOKEN]})
+            tokens = token_budget
+        packed.append(r)
+        packed_words.append(words)
+        used_tokens += tokens
+        if used_tokens >= token_budget:
+            break
+    return packed
@@ -0,0 +1,211 @@
+import os
+import threading
+from array import array
+from collections import OrderedDict
+from time import monotonic
+from typing import List, Optional
+from dotenv import load_dotenv
+from pydantic import BaseModel
+from ..metrics import LLM_SESSION_CONTEXT
+from ..models import Message
+
+load_dotenv()
+
+class SessionStoreStats(BaseModel):
+    """
+    Counters of a SessionStore.
+
+    Attributes:
+        sessions (int): Sessions currently held
+        bytes (int): Estimated memory held by the sessions
+        memory_budget_bytes (int): Memory the sessions may hold before the least recently used are evicted
+        reused (int): Turns that continued from the stored model context
+        rebuilt (int): Turns of a known session whose context was missing, stale or too long
+        evictions (int): Sessions dropped to stay within the memory budget
+        expirations (int): Sessions dropped after being idle for idle_seconds
+    """
+    sessions: int = 0
+    bytes: int = 0
+    memory_budget_bytes: int = 0
+    reused: int = 0
+    rebuilt: int = 0
+    evictions: int = 0
+    expirations: int = 0
+
+class _Session:
+    __slots__ = ("context", "turns", "last_used")
+
+    def __init__(self, context: array, turns: int, last_used: float):
+        # Token ids of the conversation so far as returned by Ollama, 4 bytes each
+        self.context = context
+        # User messages covered by the context, used to check it matches the history sent by the client
+        self.turns = turns
+        self.last_used = last_used
+
+    @property
+    def size_bytes(self) -> int:
+        return self.context.itemsize * len(self.context)
+
+def user_turns(messages: List[Message]) -> int:
+    """The number of user messages in a chat history."""
+    return sum(1 for m in messages if m.role == "user")
+
+class SessionStore:
+    """
+    Keeps the Ollama context of each chat session, the token ids of the conversation so far, so the next
+    turn is sent with only its new prompt and Ollama reuses the prompt state it already evaluated instead
+    of prefilling the whole history again.
+
+    A context is only used when it covers exactly the turns before the latest user message of the history
+    sent by the client, so edited or restarted conversations fall back to a prompt built from the history.
+    Contexts longer than max_context_tokens are dropped as well, before the model window would truncate them.
+    Idle sessions expire after idle_seconds and the least recently used are evicted beyond the memory budget.
+
+    Args
+    - memory_budget_bytes (int): Memory the stored contexts may hold.
+    - idle_seconds (float): Sessions unused for longer are dropped.
+    - max_context_tokens (int): Longest context that is continued, keep it below the num_ctx of the model.
+    """
+    def __init__(
+        self,
+        memory_budget_bytes: int = 64 * 1024 * 1024,
+        idle_seconds: float = 1800.0,
+        max_context_tokens: int = 3072
+    ):
+        self.memory_budget_bytes = memory_budget_bytes
+        self.idle_seconds = idle_seconds
+        self.max_context_tokens = max_context_tokens
+        self._sessions: "OrderedDict[str, _Session]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._stats = SessionStoreStats(memory_budget_bytes=memory_budget_bytes)
+
+    def _drop(self, session_id: str):
+        session = self._sessions.pop(session_id)
+        self._bytes -= session.size_bytes
+
+    def _expire(self, now: float):
+        # Sessions are ordered by last use, so the idle ones are at the front
+        while self._sessions:
+            session_id, session = next(iter(self._sessions.items()))
+            if now - session.last_used <= self.idle_seconds:
+                break
+            self._drop(session_id)
+            self._stats.expirations += 1
+
+    def context_for(self, session_id: Optional[str], messages: List[Message], agent: str) -> Optional[List[int]]:
+        """
+        Returns the stored context to continue a session with, None when the full prompt has to be sent.
+
+        Args
+        - session_id (Optional[str]): Id of the chat session, None for stateless requests.
+        - messages (List[Message]): The chat history sent by the client, ending with the new question.
+        - agent (str): 'rag' or 'chat', used as metric label.
+
+        Returns
+        - context (Optional[List[int]]): Token ids of the conversation before the new question.
+        """
+        if not session_id:
+            return None
+        with self._lock:
+            self._expire(monotonic())
+            session = self._sessions.get(session_id)
+            if session is None:
+                # A new session is not a rebuild
+                if user_turns(messages) <= 1:
+                    return None
+            elif session.turns == user_turns(messages) - 1 and len(session.context) <= self.max_context_tokens:
+                self._sessions.move_to_end(session_id)
+                session.last_used = monotonic()
+                self._stats.reused += 1
+                LLM_SESSION_CONTEXT.inc(agent=agent, result="reused")
+                return session.context.tolist()
+            self._stats.rebuilt += 1
+        LLM_SESSION_CONTEXT.inc(agent=agent, result="rebuilt")
+        return None
+
+    def update(self, session_id: Optional[str], messages: List[Message], context: Optional[List[int]]):
+        """
+        Stores the context returned by Ollama after answering the latest message of a history.
+
+        Args
+        - session_id (Optional[str]): Id of the chat session, nothing is stored when None.
+        - messages (List[Message]): The chat history the answer was generated for.
+        - context (Optional[List[int]]): The context from the final line of the Ollama stream.
+        """
+        if not session_id or not context or self.memory_budget_bytes <= 0:
+            return
+        session = _Session(array("I", context), user_turns(messages), monotonic())
+        with self._lock:
+            if session_id in self._sessions:
+                self._drop(session_id)
+            self._sessions[session_id] = session
+            self._bytes += session.size_bytes
+            self._expire(session.last_used)
+            while self._bytes > self.memory_budget_bytes and len(self._sessions) > 1:
+                self._drop(next(iter(self._sessions)))
+                self._stats.evictions += 1
+
+    def forget(self, session_id: str):
+        """Drops the stored context of a session, e.g. when the user starts a new chat."""
+        with self._lock:
+            if session_id in self._sessions:
+                self._drop(session_id)
+
+    def stats(self) -> SessionStoreStats:
+        """Returns a snapshot of the store counters."""
+        with self._lock:
+            return self._stats.model_copy(update={"sessions": len(self._sessions), "bytes": self._bytes})
+
+def history_prompt(messages: List[Message], max_turns: int = 3, max_chars: int = 1000) -> str:
+    """
+    Formats the turns before the latest message as a transcript to put in front of a prompt,
+    used when no stored context can be continued.
+
+    Args
+    - messages (List[Message]): The chat history, ending with the new question.
+    - max_turns (int): Earlier user questions included, with the answers to them.
+    - max_chars (int): Characters kept of each earlier message.
+
+    Returns
+    - (str): The transcript, empty for the first question of a conversation.
+    """
+    earlier = messages[:-1]
+    starts = [i for i, m in enumerate(earlier) if m.role == "user"]
+    if not starts or max_turns <= 0:
+        return ""
+    recent = earlier[starts[-max_turns:][0]:]
+    lines = [f"{m.role.upper()}: {m.content[:max_chars]}" for m in recent if m.role in ("user", "assistant")]
+    return "CONVERSATION SO FAR:\n" + "\n".join(lines) + "\n\n"
+
+def condense_query(messages: List[Message], max_questions: int = 3, max_chars: int = 1000) -> str:
+    """
+    Builds the retrieval query of the latest question from the recent user questions, so a follow-up
+    like 'and how heavy is it?' still retrieves chunks about the subject of the earlier questions.
+    The latest question comes first and earlier questions are added newest first within max_chars,
+    no LLM call is made so retrieval does not wait on a generation.
+
+    Args
+    - messages (List[Message]): The chat history, ending with the new question.
+    - max_questions (int): User questions used, including the latest.
+    - max_chars (int): Length limit of the query.
+
+    Returns
+    - query (str): The retrieval query.
+    """
+    questions = [m.content for m in reversed(messages) if m.role == "user"][:max_questions]
+    query = questions[0] if questions else messages[-1].content
+    for question in questions[1:]:
+        if len(query) + len(question) + 1 > max_chars:
+            break
+        query = f"{query}\n{question}"
+    return query
+
+# Shared by the agents, SESSION_MEMORY_MB=0 turns session contexts off
+session_store = SessionStore(
+    memory_budget_bytes=int(float(os.getenv("SESSION_MEMORY_MB", "64")) * 1024 * 1024),
+    idle_seconds=float(os.getenv("SESSION_IDLE_SECONDS", "1800")),
+    max_context_tokens=int(os.getenv("SESSION_MAX_CONTEXT_TOKENS", "3072"))
+)
+# Earlier turns put into the prompt when no stored context is continued
+history_turns = int(os.getenv("SESSION_HISTORY_TURNS", "3"))
@@ -0,0 +1,185 @@
+import json
+import os
+from time import perf_counter
+from typing import AsyncIterator, Callable, Dict, List, Optional, Union
+from dotenv import load_dotenv
+from ..http_client import get_http_client, ollama_keep_alive
+from ..metrics import (
+    LLM_ERRORS,
+    LLM_GENERATION_SECONDS,
+    LLM_TIME_TO_FIRST_TOKEN_SECONDS,
+    LLM_TOKENS,
+    LLM_TOKENS_PER_SECOND,
+    RAG_STAGE_SECONDS
+)
+from .scheduler import GenerationLimiter
+
+load_dotenv()
+llm_model = os.getenv("LLM_MODEL")
+llm_generate_url = os.getenv("LLM_GENERATE_URL")
+# Sent with every generation so Ollama does not unload the model between quiet periods
+llm_keep_alive = ollama_keep_alive()
+
+# Shared by all agents so the cap applies to every generation sent to Ollama
+generation_limiter = GenerationLimiter(
+    max_concurrent=int(os.getenv("LLM_MAX_CONCURRENT_GENERATIONS", "4")),
+    max_queue=int(os.getenv("LLM_MAX_QUEUED_GENERATIONS", "64"))
+)
+
+# Fields of the final line of an Ollama generation reported in the stats frame of a stream
+GENERATION_STATS = (
+    "total_duration", "load_duration", "prompt_eval_count", "prompt_eval_duration", "eval_count", "eval_duration"
+)
+
+_RESPONSE_KEY = '"response":'
+
+def decode_generate_line(line: str) -> dict:
+    """
+    Decodes one NDJSON line of an Ollama generate stream. Token lines, all but the last, only have their
+    response string decoded, without building the whole object. Other lines are decoded in full.
+
+    Args
+    - line (str): The line.
+
+    Returns
+    - data (dict): {'response': ...} for a token line, the whole object otherwise.
+
+    Raises
+    - json.JSONDecodeError: If the line is not valid JSON.
+    """
+    # A key with its quotes cannot occur inside a JSON string, where quotes are escaped
+    key = line.find(_RESPONSE_KEY)
+    if key != -1 and ('"done":false' in line or '"done": false' in line):
+        start = key + len(_RESPONSE_KEY)
+        while start < len(line) and line[start] == " ":
+            start += 1
+        if start < len(line) and line[start] == '"':
+            return {"response": json.decoder.scanstring(line, start + 1)[0]}
+    return json.loads(line)
+
+def generation_stats(done: dict) -> dict:
+    """The token counts and durations of the final line of a generation."""
+    return {name: done[name] for name in GENERATION_STATS if name in done}
+
+class GenerationTimer:
+    """
+    Records time to first token, generation time and token counts of one streamed Ollama generation.
+    Token counts and speed come from the final line of the stream, so no tokenizer runs in the API.
+
+    Args
+    - agent (str): 'rag' or 'chat', used as metric label.
+    - timings (Optional[Dict[str, float]]): Per request durations by stage, used for timing headers.
+    """
+    def __init__(self, agent: str, timings: Optional[Dict[str, float]] = None):
+        self.agent = agent
+        self.timings = timings
+        self.start = perf_counter()
+        self.first_token_at: Optional[float] = None
+
+    def on_line(self, data: dict):
+        """Records the first token and the Ollama stats of the final line."""
+        if self.first_token_at is None and data.get("response"):
+            self.first_token_at = perf_counter()
+            ttft = self.first_token_at - self.start
+            LLM_TIME_TO_FIRST_TOKEN_SECONDS.observe(ttft, agent=self.agent)
+            if self.timings is not None:
+                self.timings["ttft"] = ttft
+        if data.get("done"):
+            eval_count = data.get("eval_count", 0)
+            # Ollama reports durations in nanoseconds
+            eval_duration = data.get("eval_duration", 0)
+            LLM_TOKENS.inc(eval_count, agent=self.agent, kind="completion")
+            LLM_TOKENS.inc(data.get("prompt_eval_count", 0), agent=self.agent, kind="prompt")
+            if eval_count and eval_duration:
+                LLM_TOKENS_PER_SECOND.observe(eval_count / (eval_duration / 1e9), agent=self.agent)
+
+    def finish(self, failed: bool = False):
+        """Records the total generation time, or an error."""
+        if failed:
+            LLM_ERRORS.inc(agent=self.agent)
+            return
+        seconds = perf_counter() - self.start
+        LLM_GENERATION_SECONDS.observe(seconds, agent=self.agent)
+        if self.timings is not None:
+            self.timings["generate"] = seconds
+
+async def stream_generate(
+    prompt: str,
+    agent: str = "chat",
+    timings: Optional[Dict[str, float]] = None,
+    context: Optional[List[int]] = None,
+    on_done: Optional[Callable[[dict], None]] = None
+) -> AsyncIterator[str]:
+    """
+    Streams an Ollama generate response over the shared pooled HTTP client.
+    Waits for a slot of the generation_limiter first, so at most a fixed number of generations run at once.
+
+    If the consumer stops iterating or is cancelled, e.g. because the client of the FastAPI endpoint
+    disconnected, the upstream response is closed which makes Ollama abort the generation.
+
+    Args
+    - prompt (str): The prompt for the LLM.
+    - agent (str): 'rag' or 'chat', used as metric label.
+    - timings (Optional[Dict[str, float]]): Per request durations by stage, used for timing headers.
+    - context (Optional[List[int]]): Context of an earlier generation to continue, Ollama then only
+      evaluates the new prompt on top of the conversation it already holds.
+    - on_done (Optional[Callable[[dict], None]]): Called with the final line of the stream, which holds
+      the context to continue this generation with.
+
+    Yields
+    - (str): The response fragments of the LLM.
+
+    Raises
+    - Overloaded: If too many generations are already queued.
+    """
+    client = get_http_client()
+    queued_at = perf_counter()
+    async with generation_limiter.slot():
+        timer = GenerationTimer(agent, timings)
+        RAG_STAGE_SECONDS.observe(timer.start - queued_at, agent=agent, stage="queue")
+        if timings is not None:
+            timings["queue"] = timer.start - queued_at
+        try:
+            async with client.stream(
+                    "POST",
+                    llm_generate_url,
+                    json={
+                        "model": llm_model,
+                        "prompt": prompt,
+                        **({"keep_alive": llm_keep_alive} if llm_keep_alive is not None else {}),
+                        **({"context": context} if context else {})
+                    }
+                ) as r:
+                r.raise_for_status()
+                async for chunk in r.aiter_lines():
+                    if chunk:
+                        try:
+                            data = decode_generate_line(chunk)
+                            timer.on_line(data)
+                        except json.JSONDecodeError:
+                            yield f"Error decoding response chunk: {chunk}"
+                            continue
+                        if "error" in data:
+                            # Ollama reports failures during the generation as a line of their own
+                            raise RuntimeError(f"Ollama: {data['error']}")
+                        if data.get("done") and on_done is not None:
+                            on_done(data)
+                        yield data.get("response", "")
+        except Exception:
+            timer.finish(failed=True)
+            raise
+        timer.finish()
+
+async def preload_model(keep_alive: Optional[Union[int, str]] = None):
+    """
+    Loads the LLM into Ollama memory without generating, so the first request does not pay for it.
+
+    Args
+    - keep_alive (Optional[Union[int, str]]): How long Ollama keeps the model loaded, e.g. '30m' or -1.
+    """
+    payload = {"model": llm_model, "stream": False}
+    if keep_alive is not None:
+        payload["keep_alive"] = keep_alive
+    # A generate request without a prompt only loads the model
+    response = await get_http_client().post(llm_generate_url, json=payload)
+    response.raise_for_status()
@@ -1,44 +1,242 @@
+import asyncio
 import json
 import os
-from typing import List
+import threading
+from time import perf_counter
+from typing import TYPE_CHECKING, Dict, List, Optional
 from dotenv import load_dotenv
 import requests
-from ..semantic_db.semantic_db import SemanticDb
 
-from ..models import ContentStream, Message
+from ..metrics import LLM_ERRORS, RAG_CHUNKS_RETRIEVED, RAG_PROMPT_CHARS, stage_timer
+from ..models import AsyncContentStream, ContentStream, Message, StreamFrame
+from ..streaming import text_fragments
+from .context_packer import pack_context
+from .conversation import condense_query, history_prompt, history_turns, session_store, user_turns
+from .llm import GenerationTimer, decode_generate_line, generation_stats, stream_generate
+from .scheduler import EmbeddingBatcher
 import logging
 
+if TYPE_CHECKING:
+    from ..semantic_db.search_filter import SearchFilter
+    from ..semantic_db.semantic_db import RagSearchResult
+
 logger = logging.getLogger(__name__)
 
 load_dotenv()
 
-# from ..semantic_db.openai_vecs import OpenAIVecs
-# openai_api_key = os.getenv("OPENAI_API_KEY")
-# vecs = OpenAIVecs(api_key=openai_api_key)
-
-from ..semantic_db.ollama_vecs import OllamaVecs
-vecs = OllamaVecs()
-
 semantic_db_path = os.getenv("SEMANTIC_DB_PATH")
 llm_model = os.getenv("LLM_MODEL")
 llm_generate_url = os.getenv("LLM_GENERATE_URL")
+# Number of chunks retrieved and the token budget they are packed into for the prompt
+rag_candidates = int(os.getenv("RAG_CANDIDATES", "12"))
+rag_context_tokens = int(os.getenv("RAG_CONTEXT_TOKENS", "1500"))
+# 'vector' for dense search only, 'hybrid' to fuse it with full-text search
+rag_retrieval_mode = os.getenv("RAG_RETRIEVAL_MODE", "vector")
+# Collections searched when a request does not select any, see COLLECTIONS_CONFIG
+rag_collections = [c.strip() for c in os.getenv("RAG_COLLECTIONS", "default").split(",") if c.strip()]
+
+class RagResources:
+    """
+    The embedding backend, query embedding batcher, semantic db and answer cache of the RAG agent.
+
+    LanceDB, PyArrow, NumPy and the embedding clients are only imported here, so importing the agent
+    stays cheap and the app starts serving before they are loaded. Use get_resources to get the
+    shared instance, the warm-up of app.warmup builds it in a worker thread at startup.
+
+    Attributes:
+        vecs: The embedding backend, wrapped in an EmbeddingCache when EMBEDDING_CACHE_DIR is set
+        query_embedder (EmbeddingBatcher): Embeds concurrent queries together in one batched call
+        semantic_db (SemanticDb): The semantic database
+        answer_cache (AnswerCache): Stored answers of earlier /rag questions
+    """
+    def __init__(self):
+        from ..http_client import ollama_keep_alive
+        from ..semantic_db.dedup import DedupSettings
+        from ..semantic_db.embedding_batches import EmbeddingBatchPolicy
+        from ..semantic_db.ollama_vecs import OllamaVecs
+        from ..semantic_db.semantic_db import SemanticDb
+        from ..semantic_db.sharding import load_collections
+        from ..semantic_db.vector_storage import VectorStorage
+        from .answer_cache import AnswerCache
+
+        # from ..semantic_db.openai_vecs import OpenAIVecs
+        # openai_api_key = os.getenv("OPENAI_API_KEY")
+        # vecs = OpenAIVecs(api_key=openai_api_key, batch_policy=EmbeddingBatchPolicy.from_env())
+        vecs = OllamaVecs(keep_alive=ollama_keep_alive(), batch_policy=EmbeddingBatchPolicy.from_env())
+
+        embedding_cache_dir = os.getenv("EMBEDDING_CACHE_DIR")
+        if embedding_cache_dir:
+            from ..semantic_db.embedding_cache import EmbeddingCache
+            vecs = EmbeddingCache(
+                vecs.get_embeddings,
+                embedding_model=vecs.embedding_model,
+                dimensions=vecs.dimensions,
+                cache_dir=embedding_cache_dir,
+                async_embedding_function=vecs.aget_embeddings
+            )
+        self.vecs = vecs
+
+        # Concurrent queries are embedded together in one batched call
+        self.query_embedder = EmbeddingBatcher(
+            vecs.aget_embeddings,
+            window_ms=float(os.getenv("EMBED_BATCH_WINDOW_MS", "5")),
+            max_batch_size=int(os.getenv("EMBED_MAX_BATCH_SIZE", "64"))
+        )
+
+        chunk_size = os.getenv("CHUNK_SIZE")
+        self.semantic_db = SemanticDb(
+            embedding_function=vecs.get_embeddings,
+            vec_dimension=vecs.dimensions,
+            semantic_db_path=semantic_db_path,
+            # Splits the pages of uploaded documents, set as for the ingestion script
+            chunk_size=int(chunk_size) if chunk_size else None,
+            chunk_overlap=int(os.getenv("CHUNK_OVERLAP", "200")),
+            fts_index=rag_retrieval_mode == "hybrid",
+            # Must match the storage mode the table was written with
+            vector_storage=VectorStorage.from_env(vecs.dimensions),
+            rerank_factor=int(os.getenv("RAG_RERANK_FACTOR", "4")),
+            collections=load_collections(os.getenv("COLLECTIONS_CONFIG")),
+            # 'exact' searches memory-mapped snapshots of the tables, for corpora up to a few 100k chunks
+            search_backend=os.getenv("SEMANTIC_SEARCH_BACKEND", "lancedb"),
+            exact_snapshot_dir=os.getenv("EXACT_SEARCH_DIR") or None,
+            # Must match how the tables were ingested, INGEST_DEDUP=true stores near-duplicate chunks once
+            dedup=DedupSettings.from_env()
+        )
+
+        # Replays answers to near identical questions until the table changes, ANSWER_CACHE_SIZE=0 turns it off
+        self.answer_cache = AnswerCache(
+            max_entries=int(os.getenv("ANSWER_CACHE_SIZE", "1000")),
+            similarity_threshold=float(os.getenv("ANSWER_CACHE_SIMILARITY", "0.95"))
+        )
+
+_resources: Optional[RagResources] = None
+_resources_lock = threading.Lock()
+
+def get_resources() -> RagResources:
+    """
+    Returns the shared RagResources, creating them on first use.
+    Creating them imports LanceDB and opens the database, call it from a worker thread on the event loop.
+    """
+    global _resources
+    if _resources is None:
+        with _resources_lock:
+            if _resources is None:
+                _resources = RagResources()
+    return _resources
+
+def loaded_resources() -> Optional[RagResources]:
+    """Returns the shared RagResources if they were created already, without creating them."""
+    return _resources
 
-semantic_db = SemanticDb(
-    embedding_function=vecs.get_embeddings,
-    vec_dimension=vecs.dimensions,
-    semantic_db_path=semantic_db_path
-)
+async def aget_resources() -> RagResources:
+    """Async version of get_resources that creates the resources in a worker thread."""
+    return _resources or await asyncio.to_thread(get_resources)
+
+def retrieve(
+    query: str,
+    query_vector: List[float],
+    collections: Optional[List[str]] = None,
+    retrieval_mode=rag_retrieval_mode,
+    timings: Optional[Dict[str, float]] = None
+) -> List["RagSearchResult"]:
+    """
+    Retrieves candidate chunks for a question and packs the best of them into the context token budget.
+
+    Args
+    - query (str): The retrieval query, the user question with the earlier questions of the conversation.
+    - query_vector (List[float]): The vectorised user question.
+    - collections (Optional[List[str]]): The collections searched, their shards are searched concurrently. RAG_COLLECTIONS if None.
+    - retrieval_mode (str): 'vector' for dense search, 'hybrid' for full-text and dense search with rank fusion.
+    - timings (Optional[Dict[str, float]]): Per request durations by stage, used for timing headers.
+
+    Returns
+    - results (List[RagSearchResult]): The chunks for the prompt, best first.
+    """
+    semantic_db = get_resources().semantic_db
+    with stage_timer("rag", "search", timings):
+        results_array = semantic_db.collection_query(
+            query,
+            query_vector,
+            collections or rag_collections,
+            N_results=rag_candidates,
+            retrieval_mode=retrieval_mode
+        )
+    with stage_timer("rag", "pack", timings):
+        packed = pack_context(results_array, rag_context_tokens)
+    RAG_CHUNKS_RETRIEVED.observe(len(packed))
+    return packed
+
+async def search(
+    queries: List[str],
+    collections: Optional[List[str]] = None,
+    N_results: int = 4,
+    retrieval_mode=rag_retrieval_mode,
+    where: Optional["SearchFilter"] = None,
+    timings: Optional[Dict[str, float]] = None
+) -> List[List["RagSearchResult"]]:
+    """
+    Retrieves the top chunks of many queries without generating answers, e.g. for evaluation jobs.
+    The queries are embedded in one call to the embedding backend and searched as one batch.
+
+    Args
+    - queries (List[str]): The queries.
+    - collections (Optional[List[str]]): The collections searched, RAG_COLLECTIONS if None.
+    - N_results (int): Results per query.
+    - retrieval_mode (str): 'vector' for dense search, 'hybrid' for full-text and dense search with rank fusion.
+    - where (Optional[SearchFilter]): Metadata conditions the results must meet.
+    - timings (Optional[Dict[str, float]]): Filled with the duration of each stage.
+
+    Returns
+    - results (List[List[RagSearchResult]]): The results of each query, best first.
+    """
+    resources = await aget_resources()
+    with stage_timer("search", "embed", timings):
+        query_vectors = await resources.vecs.aget_embeddings(queries)
+    with stage_timer("search", "search", timings):
+        return await asyncio.to_thread(
+            resources.semantic_db.collection_query_batch,
+            queries,
+            query_vectors,
+            collections or rag_collections,
+            N_results,
+            retrieval_mode,
+            where
+        )
+
+def build_prompt(query: str, results_text_array: List[str]) -> str:
+    """
+    Builds the RAG prompt from the user question and the retrieved content.
+
+    Args
+    - query (str): The user question.
+    - results_text_array (List[str]): The text of the retrieved chunks.
+
+    Returns
+    - prompt (str): The prompt for the LLM.
+    """
+    all_text = ' '.join(results_text_array)
+    return (
+        'Answer this question:'
+        f'\nUSER QUESTION\n{query}\n'
+        'Use this content in your answer:'
+        f'\n\nCONTENT_STARTS:\n"{all_text}"\nCONTENT_ENDS\n\n'
+        'IMPORTANT - The content may be truncated so do not simply continue the sentence, '
+        'always rephrase to give complete sentences when needed. '
+        'Not everything will be relevant so do not comment on anything you do not use to answer the question.'
+    )
     
 def run_agent(
     messages: List[Message],
-    table_name="semantic-db-table"
+    collections: Optional[List[str]] = None,
+    retrieval_mode=rag_retrieval_mode
     ) -> ContentStream:
     """
     Answers a user query with retrieval augmented generation (RAG) over documents in a LanceDB table in S3.
 
     Args
     - messages (List[Message]): The chat history as messages.
-    - table_name (str): The name of the table in the semantic database.
+    - collections (Optional[List[str]]): The collections searched, RAG_COLLECTIONS if None.
+    - retrieval_mode (str): 'vector' for dense search, 'hybrid' for full-text and dense search with rank fusion.
 
     Yields
     - (ContentStream): The stream response from the LLM.
@@ -48,8 +246,12 @@ def run_agent(
     query_vector = []
     query = ""
     try:
-        query = messages[-1].content
-        query_vector = vecs.get_embedding(query)
+        resources = get_resources()
+        question = messages[-1].content
+        # Follow-up questions are searched together with the earlier questions
+        query = condense_query(messages)
+        with stage_timer("rag", "embed"):
+            query_vector = resources.vecs.get_embedding(query)
     except Exception as e:
         err_message = f"There was an error processing the query: {e}"
         logger.error(err_message)
@@ -61,8 +263,8 @@ def run_agent(
     # Retrieve relevant content from the vector db using semantic search
     results_text_array = []
     try:
-        results_array = semantic_db.semantic_query(query_vector, table_name)
-        sources = semantic_db.get_sources(results_array)
+        results_array = retrieve(query, query_vector, collections, retrieval_mode)
+        sources = resources.semantic_db.get_sources(results_array)
         results_text_array = [r.text for r in results_array]
         if not results_text_array:
             raise ValueError('results_text_array cannot be empty')
@@ -76,17 +278,10 @@ def run_agent(
     # Cal LLM to summarise answer based on retrieved content
     try:
         # Define prompt for document summary
-        all_text = ' '.join(results_text_array)
-        prompt =  (
-            'Answer this question:'
-            f'\nUSER QUESTION\n{query}\n'
-            'Use this content in your answer:'
-            f'\n\nCONTENT_STARTS:\n"{all_text}"\nCONTENT_ENDS\n\n'
-            'IMPORTANT - The content may be truncated so do not simply continue the sentence, '
-            'always rephrase to give complete sentences when needed. '
-            'Not everything will be relevant so do not comment on anything you do not use to answer the question.'
-        )
-        
+        prompt = history_prompt(messages, history_turns) + build_prompt(question, results_text_array)
+        RAG_PROMPT_CHARS.observe(len(prompt), agent="rag")
+        timer = GenerationTimer("rag")
+
         # Send the POST request with streaming enabled
         with requests.post(
                 llm_generate_url, 
@@ -101,10 +296,12 @@ def run_agent(
             for chunk in r.iter_lines(decode_unicode=True):
                 if chunk:
                     try:
-                        data = json.loads(chunk)
+                        data = decode_generate_line(chunk)
+                        timer.on_line(data)
                         yield data.get("response", "")
                     except json.JSONDecodeError:
                         yield f"Error decoding response chunk: {chunk}"
+        timer.finish()
 
         # Provide references
         if len(sources):
@@ -113,12 +310,124 @@ def run_agent(
                 yield s
 
     except Exception as e:
+        LLM_ERRORS.inc(agent="rag")
         err_message = f"Error drafting answer: {e}"
         logger.error(err_message)
         yield err_message
         return
 
-    
-        
+async def run_agent_async(
+    messages: List[Message],
+    collections: Optional[List[str]] = None,
+    retrieval_mode=rag_retrieval_mode,
+    timings: Optional[Dict[str, float]] = None,
+    session_id: Optional[str] = None
+    ) -> AsyncContentStream:
+    """
+    Async version of run_agent. The query is embedded and the answer generated over the shared pooled
+    HTTP client, and the LanceDB search runs in a worker thread, so no thread is held while streaming.
+    Cancelling the stream (e.g. when the client disconnects) aborts the upstream generation.
+
+    Args
+    - messages (List[Message]): The chat history as messages.
+    - collections (Optional[List[str]]): The collections searched, RAG_COLLECTIONS if None.
+    - retrieval_mode (str): 'vector' for dense search, 'hybrid' for full-text and dense search with rank fusion.
+    - timings (Optional[Dict[str, float]]): Filled with the duration of each stage, used for timing headers.
+    - session_id (Optional[str]): Id of the chat session, follow-up questions continue the Ollama context
+      of the earlier turns so only the new content and question are evaluated.
+
+    Yields
+    - (AsyncContentStream): The answer as strings, then a references frame and a stats frame.
+      Failures are sent as an error frame.
+    """
+
+    # Embedd the user query
+    query_vector = []
+    query = ""
+    try:
+        resources = await aget_resources()
+        question = messages[-1].content
+        # Follow-up questions are searched together with the earlier questions
+        query = condense_query(messages)
+        with stage_timer("rag", "embed", timings):
+            query_vector = await resources.query_embedder.embed(query)
+    except Exception as e:
+        err_message = f"There was an error processing the query: {e}"
+        logger.error(err_message)
+        yield StreamFrame(event="error", data={"message": err_message})
+        return
+    if not query_vector:
+        return
 
+    # Replay the answer to a near identical earlier question on the same table version,
+    # answers to follow-up questions depend on the conversation so only first questions are cached
+    answer_cache = resources.answer_cache
+    collections = collections or rag_collections
+    cache_scope = ",".join(sorted(collections))
+    table_version = None
+    if answer_cache.max_entries > 0 and user_turns(messages) == 1:
+        try:
+            table_version = await asyncio.to_thread(resources.semantic_db.collection_version, collections)
+            cached = answer_cache.lookup(query_vector, cache_scope, retrieval_mode, table_version)
+        except Exception as e:
+            logger.warning(f"Answer cache lookup failed: {e}")
+            cached = None
+        if cached:
+            # Chunked like a generated answer, so clients render it the same way
+            for fragment in text_fragments(cached.answer):
+                yield fragment
+            yield StreamFrame(event="references", data={"sources": cached.sources})
+            yield StreamFrame(event="stats", data={"cached": True})
+            return
+    started = perf_counter()
 
+    # Retrieve relevant content from the vector db using semantic search
+    results_text_array = []
+    try:
+        results_array = await asyncio.to_thread(retrieve, query, query_vector, collections, retrieval_mode, timings)
+        sources = resources.semantic_db.get_sources(results_array)
+        results_text_array = [r.text for r in results_array]
+        if not results_text_array:
+            raise ValueError('results_text_array cannot be empty')
+    except Exception as e:
+        err_message = f"Error fetching sources: {e}"
+        logger.error(err_message)
+        yield StreamFrame(event="error", data={"message": err_message})
+        return
+
+    # Cal LLM to summarise answer based on retrieved content
+    try:
+        # The earlier turns are either in the stored context or put in front of the prompt
+        context = session_store.context_for(session_id, messages, agent="rag")
+        prompt = build_prompt(question, results_text_array)
+        if not context:
+            prompt = history_prompt(messages, history_turns) + prompt
+        RAG_PROMPT_CHARS.observe(len(prompt), agent="rag")
+        answer_parts = []
+        done = {}
+        async for token in stream_generate(prompt, agent="rag", timings=timings, context=context, on_done=done.update):
+            answer_parts.append(token)
+            yield token
+        session_store.update(session_id, messages, done.get("context"))
+
+        # Provide references
+        yield StreamFrame(event="references", data={"sources": sources})
+
+        # Only complete answers reach this point, not failed or abandoned ones
+        if table_version is not None:
+            answer_cache.store(
+                query_vector,
+                cache_scope,
+                retrieval_mode,
+                table_version,
+                answer="".join(answer_parts),
+                sources=sources,
+                seconds=perf_counter() - started
+            )
+        yield StreamFrame(event="stats", data=generation_stats(done))
+
+    except Exception as e:
+        err_message = f"Error drafting answer: {e}"
+        logger.error(err_message)
+        yield StreamFrame(event="error", data={"message": err_message})
+        return
@@ -0,0 +1,194 @@
+import asyncio
+from collections import deque
+from contextlib import asynccontextmanager
+from time import monotonic
+from typing import AsyncIterator, Awaitable, Callable, Deque, List, Optional, Set, Tuple
+from pydantic import BaseModel
+
+class Overloaded(Exception):
+    """Raised when a request cannot even be queued because the queue is full."""
+
+class EmbeddingBatcherStats(BaseModel):
+    """
+    Counters of an EmbeddingBatcher.
+
+    Attributes:
+        requests (int): Texts submitted for embedding
+        batches (int): Batched calls made to the embedding backend
+        pending (int): Texts waiting for the current batch window to close
+    """
+    requests: int = 0
+    batches: int = 0
+    pending: int = 0
+
+    @property
+    def mean_batch_size(self) -> float:
+        return self.requests / self.batches if self.batches else 0.0
+
+class EmbeddingBatcher:
+    """
+    Gathers concurrent single text embedding requests, e.g. the query of each /rag request,
+    into one batched backend call. A batch is sent when `window_ms` passed since its first text
+    or when it reaches `max_batch_size` texts, whichever comes first.
+
+    Args
+    - embed_function (Callable[[List[str]], Awaitable[List[List[float]]]]): Async batch embedding function.
+    - window_ms (float): Maximum time a text waits for other texts to join its batch.
+    - max_batch_size (int): Maximum number of texts per backend call.
+    """
+    def __init__(
+        self,
+        embed_function: Callable[[List[str]], Awaitable[List[List[float]]]],
+        window_ms: float = 5.0,
+        max_batch_size: int = 64
+    ):
+        self.embed_function = embed_function
+        self.window_ms = window_ms
+        self.max_batch_size = max_batch_size
+        self._pending: List[Tuple[str, asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._tasks: Set[asyncio.Task] = set()
+        self._stats = EmbeddingBatcherStats()
+
+    async def embed(self, text: str) -> List[float]:
+        """
+        Embeds one text as part of the next batch.
+
+        Args
+        - text (str): The text to embed.
+
+        Returns
+        - embedding (List[float]): The embedding of the text.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((text, future))
+        self._stats.requests += 1
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window_ms / 1000, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            self._stats.batches += 1
+            # Keep a reference so the batch task is not garbage collected while it runs
+            task = asyncio.ensure_future(self._run_batch(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run_batch(self, batch: List[Tuple[str, asyncio.Future]]):
+        try:
+            embeddings = await self.embed_function(text_chunks=[text for text, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), embedding in zip(batch, embeddings):
+            if not future.done():
+                future.set_result(embedding)
+
+    def stats(self) -> EmbeddingBatcherStats:
+        """Returns a snapshot of the batcher counters."""
+        return self._stats.model_copy(update={"pending": len(self._pending)})
+
+class GenerationLimiterStats(BaseModel):
+    """
+    Counters of a GenerationLimiter.
+
+    Attributes:
+        active (int): Generations currently running
+        queued (int): Generations waiting for a slot
+        max_concurrent (int): Maximum concurrent generations
+        max_queue (int): Maximum queued generations before requests are rejected
+        admitted (int): Generations that got a slot
+        rejected (int): Requests rejected because the queue was full
+        total_wait_seconds (float): Time admitted generations spent queued
+        max_wait_seconds (float): Longest time a generation spent queued
+    """
+    active: int = 0
+    queued: int = 0
+    max_concurrent: int = 0
+    max_queue: int = 0
+    admitted: int = 0
+    rejected: int = 0
+    total_wait_seconds: float = 0.0
+    max_wait_seconds: float = 0.0
+
+    @property
+    def mean_wait_seconds(self) -> float:
+        return self.total_wait_seconds / self.admitted if self.admitted else 0.0
+
+class GenerationLimiter:
+    """
+    Caps the number of concurrent LLM generations so Ollama is not thrashed under load.
+    Requests beyond the cap wait in a first come first served queue, and once `max_queue`
+    requests are waiting new ones are rejected with Overloaded so the API can answer 503 at once.
+
+    Args
+    - max_concurrent (int): Maximum concurrent generations.
+    - max_queue (int): Maximum generations waiting for a slot.
+    """
+    def __init__(self, max_concurrent: int = 4, max_queue: int = 64):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self._active = 0
+        self._waiters: Deque[asyncio.Future] = deque()
+        self._stats = GenerationLimiterStats(max_concurrent=max_concurrent, max_queue=max_queue)
+
+    def overloaded(self) -> bool:
+        """Whether a new request would be rejected, for a fast check before starting a response."""
+        return self._active >= self.max_concurrent and len(self._waiters) >= self.max_queue
+
+    @asynccontextmanager
+    async def slot(self) -> AsyncIterator[None]:
+        """
+        Waits for a generation slot in arrival order and holds it for the duration of the block.
+
+        Raises
+        - Overloaded: If the queue is full.
+        """
+        start = monotonic()
+        if self._active < self.max_concurrent and not self._waiters:
+            self._active += 1
+        else:
+            if len(self._waiters) >= self.max_queue:
+                self._stats.rejected += 1
+                raise Overloaded("Too many queued generations")
+            future = asyncio.get_running_loop().create_future()
+            self._waiters.append(future)
+            try:
+                # The releasing request hands its slot over by resolving the future
+                await future
+            except asyncio.CancelledError:
+                if future.done() and not future.cancelled():
+                    self._release()
+                elif future in self._waiters:
+                    self._waiters.remove(future)
+                raise
+        wait_seconds = monotonic() - start
+        self._stats.admitted += 1
+        self._stats.total_wait_seconds += wait_seconds
+        self._stats.max_wait_seconds = max(self._stats.max_wait_seconds, wait_seconds)
+        try:
+            yield
+        finally:
+            self._release()
+
+    def _release(self):
+        while self._waiters:
+            future = self._waiters.popleft()
+            if not future.done():
+                future.set_result(None)
+                return
+        self._active -= 1
+
+    def stats(self) -> GenerationLimiterStats:
+        """Returns a snapshot of the limiter counters."""
+        return self._stats.model_copy(update={"active": self._active, "queued": len(self._waiters)})
@@ -0,0 +1,54 @@
+import os
+from typing import Optional, Union
+import httpx
+from dotenv import load_dotenv
+
+load_dotenv()
+
+_client: Optional[httpx.AsyncClient] = None
+
+def get_http_client() -> httpx.AsyncClient:
+    """
+    Returns the process wide async HTTP client used to call Ollama, created on first use.
+    Connections are pooled and kept alive so requests do not open a new TCP connection each time.
+
+    Returns
+    - client (httpx.AsyncClient): The shared client.
+    """
+    global _client
+    if _client is None or _client.is_closed:
+        max_connections = int(os.getenv("LLM_MAX_CONNECTIONS", "200"))
+        _client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections
+            ),
+            # No read timeout, a 3B model can pause for a long time while prefilling a large prompt
+            timeout=httpx.Timeout(connect=10.0, read=None, write=30.0, pool=30.0)
+        )
+    return _client
+
+async def close_http_client():
+    """Closes the shared client and its pooled connections, e.g. on application shutdown."""
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+def ollama_host() -> str:
+    """The base URL of the Ollama server, from OLLAMA_HOST as used by the ollama package."""
+    host = os.getenv("OLLAMA_HOST", "http://localhost:11434")
+    if "://" not in host:
+        host = f"http://{host}"
+    return host.rstrip("/")
+
+def ollama_keep_alive() -> Optional[Union[int, str]]:
+    """
+    How long Ollama keeps a model in memory after a request, from OLLAMA_KEEP_ALIVE,
+    e.g. '30m', or -1 to keep it loaded. None leaves the Ollama default of 5 minutes.
+    """
+    keep_alive = os.getenv("OLLAMA_KEEP_ALIVE")
+    if not keep_alive:
+        return None
+    # Plain numbers are seconds, Ollama only accepts them as JSON numbers
+    return int(keep_alive) if keep_alive.lstrip("-").isdigit() else keep_alive
@@ -1,18 +1,174 @@
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import StreamingResponse
-from .models import Body
-from .agents.chat import run_agent as chat_agent 
-from .agents.rag import run_agent as rag_agent
+import asyncio
+import os
+import threading
+from contextlib import asynccontextmanager, suppress
+from time import perf_counter
+from typing import TYPE_CHECKING, Dict, List, Optional
+from dotenv import load_dotenv
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from .models import AsyncContentStream, Body, SearchBody
+from .http_client import close_http_client, ollama_keep_alive
+from .metrics import registry, server_timing_header
+from .streaming import EVENT_STREAM, coalesce, sse_stream, text_stream, wants_event_stream
+from .agents.chat import run_agent_async as chat_agent
+from .agents.rag import run_agent_async as rag_agent, aget_resources, get_resources, loaded_resources, rag_retrieval_mode
+from .agents.rag import search as rag_search
+from .agents.llm import generation_limiter
+from .agents.conversation import session_store
+from .warmup import WarmupStatus, warm_up
 
-app = FastAPI()
+if TYPE_CHECKING:
+    from .semantic_db.ingest_jobs import IngestJob, IngestJobQueue
+
+load_dotenv()
+# Sends the durations of the stages before the first token as a Server-Timing header
+timing_headers = os.getenv("METRICS_TIMING_HEADERS", "false").lower() == "true"
+# Loads the models, opens the table and runs a dummy search at startup, see GET /ready
+warmup_on_startup = os.getenv("WARMUP_ON_STARTUP", "true").lower() == "true"
+warmup_status = WarmupStatus()
+
+# Uploaded documents are ingested in the background, see IngestJobQueue
+upload_dir = os.getenv("UPLOAD_DIR", "uploads/")
+upload_max_bytes = int(os.getenv("UPLOAD_MAX_BYTES", str(200 * 1024 * 1024)))
+_ingest_jobs: Optional["IngestJobQueue"] = None
+# Limits of a /search request, larger batches are split by the client
+search_max_queries = int(os.getenv("SEARCH_MAX_QUERIES", "1000"))
+search_max_results = int(os.getenv("SEARCH_MAX_RESULTS", "100"))
+# Answer fragments are joined up to this many characters or milliseconds before they are written
+stream_coalesce_chars = int(os.getenv("STREAM_COALESCE_CHARS", "64"))
+stream_coalesce_ms = float(os.getenv("STREAM_COALESCE_MS", "50"))
+_ingest_jobs_lock = threading.Lock()
+
+def get_ingest_jobs() -> "IngestJobQueue":
+    """Returns the ingestion job queue, created with the RAG resources on first use."""
+    global _ingest_jobs
+    with _ingest_jobs_lock:
+        if _ingest_jobs is None:
+            from .semantic_db.ingest_jobs import IngestJobQueue
+            resources = get_resources()
+            _ingest_jobs = IngestJobQueue(
+                resources.semantic_db,
+                embedding_model=resources.vecs.embedding_model,
+                workers=int(os.getenv("INGEST_JOB_WORKERS", "1")),
+                parse_workers=int(os.getenv("INGEST_PARSE_WORKERS", "1"))
+            )
+        return _ingest_jobs
+
+async def ingest_jobs() -> "IngestJobQueue":
+    return _ingest_jobs or await asyncio.to_thread(get_ingest_jobs)
+
+# Gauges of the RAG resources are skipped until they are loaded
+registry.gauge(
+    "llm_generations_active", "Generations currently running", lambda: generation_limiter.stats().active
+)
+registry.gauge(
+    "llm_generations_queued", "Generations waiting for a slot", lambda: generation_limiter.stats().queued
+)
+registry.gauge(
+    "query_embedding_mean_batch_size", "Mean texts per batched query embedding call",
+    lambda: loaded_resources().query_embedder.stats().mean_batch_size
+)
+registry.gauge(
+    "answer_cache_entries", "Answers held by the answer cache", lambda: loaded_resources().answer_cache.stats().entries
+)
+registry.gauge(
+    "semantic_db_table_reuse_ratio", "Share of table lookups served by the table pool",
+    lambda: loaded_resources().semantic_db.table_pool_stats().reuse_ratio
+)
+registry.gauge("llm_sessions", "Chat sessions with a stored LLM context", lambda: session_store.stats().sessions)
+registry.gauge("app_ready", "1 once the startup warm-up finished", lambda: int(warmup_status.ready))
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Warm up in the background so the server answers health checks while the models load
+    warmup = None
+    if warmup_on_startup:
+        warmup = asyncio.create_task(warm_up(warmup_status, keep_alive=ollama_keep_alive()))
+    else:
+        warmup_status.ready = True
+    yield
+    if warmup is not None:
+        warmup.cancel()
+        with suppress(asyncio.CancelledError):
+            await warmup
+    # Close the pooled connections to Ollama
+    await close_http_client()
+    # Let running ingestion jobs finish
+    if _ingest_jobs is not None:
+        await asyncio.to_thread(_ingest_jobs.shutdown)
+
+app = FastAPI(lifespan=lifespan)
+
+async def agent_response(
+    stream: AsyncContentStream,
+    request: Request,
+    timings: Optional[Dict[str, float]] = None
+) -> StreamingResponse:
+    """
+    Streams an agent answer with its fragments coalesced, see coalesce. Clients accepting text/event-stream
+    get Server-Sent Events with typed frames, see sse_stream, others the answer and references as plain text.
+
+    With `timings` the response waits for the first fragment of the stream so the durations of the stages
+    before it, e.g. embedding, search, queueing and time to first token, can be sent as a Server-Timing header.
+
+    Args
+    - stream (AsyncContentStream): The agent stream, filling `timings` as it runs.
+    - request (Request): The request, its Accept header selects the format.
+    - timings (Optional[Dict[str, float]]): Durations in seconds by stage name.
+
+    Returns
+    - (StreamingResponse): Streaming response of the answer.
+    """
+    coalesced = coalesce(stream, stream_coalesce_chars, stream_coalesce_ms / 1000)
+    content = coalesced
+    headers = {}
+    if timings is not None:
+        try:
+            first = [await coalesced.__anext__()]
+        except StopAsyncIteration:
+            first = []
+
+        async def with_first() -> AsyncContentStream:
+            for item in first:
+                yield item
+            async for item in coalesced:
+                yield item
+
+        content = with_first()
+        headers["Server-Timing"] = server_timing_header(timings)
+    if wants_event_stream(request.headers.get("accept")):
+        # Proxies must not buffer the events
+        headers.update({"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+        return StreamingResponse(sse_stream(content), media_type=EVENT_STREAM, headers=headers)
+    return StreamingResponse(text_stream(content), media_type="text/html", headers=headers)
+
+def reject_if_overloaded():
+    """Answers 503 straight away instead of queueing a generation that would wait too long."""
+    if generation_limiter.overloaded():
+        raise HTTPException(
+            status_code=503,
+            detail="Too many requests in progress, retry later",
+            headers={"Retry-After": "1"}
+        )
+
+async def check_collections(collections: List[str]):
+    """Answers 400 if a collection is not configured."""
+    known = (await aget_resources()).semantic_db.collections
+    unknown = [c for c in collections if c not in known]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown collections: {', '.join(unknown)}")
 
 @app.post("/chat")
-def chat(body: Body):
+async def chat(body: Body, request: Request):
     """
     Generates an LLM stream response to a user question.
+    The stream is produced on the event loop, if the client disconnects the upstream generation is aborted.
+    With `Accept: text/event-stream` the answer is sent as Server-Sent Events.
 
     Parameters:
-    - body (Body): Messages from the chat history.
+    - body (Body): Messages from the chat history and the id of the chat session.
+    - request (Request): The request, its Accept header selects the stream format.
 
     Returns:
     - (StreamingResponse): Streaming response of assistant message.
@@ -21,18 +177,23 @@ def chat(body: Body):
     messages = body.messages
     if messages == None or messages == []:
         return None
+    reject_if_overloaded()
     try:
-        return StreamingResponse(chat_agent(messages), media_type="text/html")
+        timings: Optional[Dict[str, float]] = {} if timing_headers else None
+        return await agent_response(chat_agent(messages, timings=timings, session_id=body.session_id), request, timings)
     except HTTPException as e:
         raise HTTPException(status_code=500, detail="Internal server error")
-    
+
 @app.post("/rag")
-def rag(body: Body):
+async def rag(body: Body, request: Request):
     """
     Generates an LLM stream response to a user question using RAG over a vector db.
+    The stream is produced on the event loop, if the client disconnects the upstream generation is aborted.
+    With `Accept: text/event-stream` the answer, references and errors are sent as typed Server-Sent Events.
 
     Parameters:
-    - body (Body): Messages from the chat history.
+    - body (Body): Messages from the chat history, the id of the chat session and the collections to search.
+    - request (Request): The request, its Accept header selects the stream format.
 
     Returns:
     - (StreamingResponse): Streaming response of assistant message.
@@ -41,7 +202,216 @@ def rag(body: Body):
     messages = body.messages
     if messages == None or messages == []:
         return None
+    if body.collections:
+        await check_collections(body.collections)
+    reject_if_overloaded()
     try:
-        return StreamingResponse(rag_agent(messages), media_type="text/html")
+        timings: Optional[Dict[str, float]] = {} if timing_headers else None
+        return await agent_response(
+            rag_agent(messages, collections=body.collections, timings=timings, session_id=body.session_id),
+            request,
+            timings
+        )
     except HTTPException as e:
-        raise HTTPException(status_code=500, detail="Internal server error")
\ No newline at end of file
+        raise HTTPException(status_code=500, detail="Internal server error")
+
+@app.post("/search")
+async def search(body: SearchBody):
+    """
+    Retrieves the top chunks of a batch of queries without generating answers, e.g. for evaluation jobs.
+    The queries are embedded in one call and each shard is searched with the whole batch.
+
+    Parameters:
+    - body (SearchBody): The queries, the collections, the results per query, the retrieval mode and metadata filters.
+
+    Returns:
+    - (dict): The results of each query with distances and scores, the references of its sources, and the throughput.
+    """
+    if not body.queries:
+        raise HTTPException(status_code=400, detail="No queries given")
+    if len(body.queries) > search_max_queries:
+        raise HTTPException(status_code=400, detail=f"At most {search_max_queries} queries per request")
+    if not 1 <= body.n_results <= search_max_results:
+        raise HTTPException(status_code=400, detail=f"n_results must be between 1 and {search_max_results}")
+    retrieval_mode = body.retrieval_mode or rag_retrieval_mode
+    if retrieval_mode not in ("vector", "hybrid"):
+        raise HTTPException(status_code=400, detail="retrieval_mode must be 'vector' or 'hybrid'")
+    if body.collections:
+        await check_collections(body.collections)
+
+    start = perf_counter()
+    timings: Dict[str, float] = {}
+    results = await rag_search(
+        body.queries,
+        body.collections,
+        N_results=body.n_results,
+        retrieval_mode=retrieval_mode,
+        where=body.filters,
+        timings=timings
+    )
+    seconds = perf_counter() - start
+    semantic_db = (await aget_resources()).semantic_db
+    return JSONResponse(
+        {
+            "results": [
+                {
+                    "query": query,
+                    "results": [r.model_dump() for r in query_results],
+                    "sources": semantic_db.get_sources(query_results)
+                }
+                for query, query_results in zip(body.queries, results)
+            ],
+            "seconds": seconds,
+            "queries_per_second": len(body.queries) / seconds if seconds else None
+        },
+        headers={"Server-Timing": server_timing_header(timings)} if timing_headers else None
+    )
+
+@app.get("/scheduler")
+async def scheduler():
+    """
+    Reports the queue depth and wait times of the generation limiter and the batching of query embeddings.
+
+    Returns:
+    - (dict): Stats of the generation limiter and the query embedding batcher.
+    """
+    generation = generation_limiter.stats()
+    embedding = (await aget_resources()).query_embedder.stats()
+    return {
+        "generation": {**generation.model_dump(), "mean_wait_seconds": generation.mean_wait_seconds},
+        "query_embedding": {**embedding.model_dump(), "mean_batch_size": embedding.mean_batch_size}
+    }
+
+def job_response(job: "IngestJob") -> dict:
+    return {**job.model_dump(), "progress": job.progress}
+
+@app.post("/documents", status_code=202)
+async def upload_document(request: Request, file_name: str, collection: Optional[str] = None):
+    """
+    Uploads a pdf as the raw request body and queues its ingestion, returning at once.
+    The body is written to disk as it arrives, so large files are never held in memory.
+
+    Parameters:
+    - request (Request): The request, its body is the pdf.
+    - file_name (str): Name of the document for use in meta data, e.g. ?file_name=manual.pdf
+    - collection (Optional[str]): Collection the document is added to, the default collection if None.
+
+    Returns:
+    - (dict): The queued ingestion job, poll GET /documents/jobs/{job_id} for its progress.
+    """
+    if not file_name.lower().endswith(".pdf"):
+        raise HTTPException(status_code=400, detail="Only pdf files are supported")
+    if collection:
+        await check_collections([collection])
+    jobs = await ingest_jobs()
+    from .semantic_db.ingest_jobs import UploadTooLarge, save_upload
+    try:
+        path, content_hash = await save_upload(request.stream(), upload_dir, upload_max_bytes)
+    except UploadTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    return job_response(jobs.submit_file(path, file_name, content_hash, collection))
+
+@app.delete("/documents/{file_id}", status_code=202)
+async def delete_document(file_id: str, collection: Optional[str] = None):
+    """
+    Queues the deletion of all chunks of a document.
+
+    Parameters:
+    - file_id (str): Id of the document.
+    - collection (Optional[str]): Collection the document is deleted from, the default collection if None.
+
+    Returns:
+    - (dict): The queued deletion job.
+    """
+    if collection:
+        await check_collections([collection])
+    return job_response((await ingest_jobs()).submit_delete(file_id, collection))
+
+@app.get("/documents/jobs")
+async def document_jobs():
+    """
+    Lists the recent ingestion and deletion jobs.
+
+    Returns:
+    - (list): The jobs, oldest first.
+    """
+    return [job_response(job) for job in (await ingest_jobs()).list()]
+
+@app.get("/documents/jobs/{job_id}")
+async def document_job(job_id: str):
+    """
+    Reports the status and progress of an ingestion or deletion job.
+
+    Parameters:
+    - job_id (str): Id of the job.
+
+    Returns:
+    - (dict): The job.
+    """
+    job = (await ingest_jobs()).get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job_response(job)
+
+@app.get("/answer-cache")
+async def answer_cache_stats():
+    """
+    Reports the hit rate and saved time of the /rag answer cache.
+
+    Returns:
+    - (dict): Stats of the answer cache.
+    """
+    stats = (await aget_resources()).answer_cache.stats()
+    return {**stats.model_dump(), "hit_ratio": stats.hit_ratio}
+
+@app.get("/collections")
+async def collections():
+    """
+    Lists the configured collections and their shard tables.
+
+    Returns:
+    - (dict): The shards of each collection by name.
+    """
+    semantic_db = (await aget_resources()).semantic_db
+    return {name: spec.model_dump()["shards"] for name, spec in semantic_db.collections.items()}
+
+@app.get("/sessions")
+async def sessions():
+    """
+    Reports the chat sessions whose LLM context is kept between turns and how often it was continued.
+
+    Returns:
+    - (dict): Stats of the session store.
+    """
+    return session_store.stats().model_dump()
+
+@app.delete("/sessions/{session_id}", status_code=204)
+async def forget_session(session_id: str):
+    """
+    Drops the stored LLM context of a chat session, e.g. when the user starts a new chat.
+
+    Parameters:
+    - session_id (str): Id of the chat session.
+    """
+    session_store.forget(session_id)
+
+@app.get("/ready")
+async def ready():
+    """
+    Reports whether the startup warm-up finished, answering 503 until it has, for use as a readiness probe.
+
+    Returns:
+    - (JSONResponse): The warm-up status with the duration of each step and the steps that failed.
+    """
+    return JSONResponse(warmup_status.model_dump(), status_code=200 if warmup_status.ready else 503)
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    """
+    Exposes latency histograms and counters of the agents, the semantic db, the embedding backends
+    and ingestion in the Prometheus text format.
+
+    Returns:
+    - (PlainTextResponse): The metrics.
+    """
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
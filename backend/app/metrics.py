@@ -0,0 +1,247 @@
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from time import perf_counter
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+# Default latency buckets in seconds, from 1ms to 2 minutes
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+def _label_key(labelnames: Tuple[str, ...], labels: Dict[str, str]) -> Tuple[str, ...]:
+    return tuple(str(labels.get(name, "")) for name in labelnames)
+
+def _format_labels(labelnames: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    parts = [f'{n}="{v}"' for n, v in zip(labelnames, values) if v != ""]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+class Counter:
+    """
+    A monotonically increasing value per label set.
+
+    Args
+    - name (str): Metric name in Prometheus format.
+    - help (str): Description of the metric.
+    - labelnames (Tuple[str, ...]): Names of the labels.
+    """
+    def __init__(self, name: str, help: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = _label_key(self.labelnames, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in self._values.items():
+                lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {value}")
+        return lines
+
+class Gauge:
+    """
+    A value read from a callback when the metrics are scraped, e.g. a queue depth.
+
+    Args
+    - name (str): Metric name in Prometheus format.
+    - help (str): Description of the metric.
+    - callback (Callable[[], float]): Returns the current value.
+    """
+    def __init__(self, name: str, help: str, callback: Callable[[], float]):
+        self.name = name
+        self.help = help
+        self.callback = callback
+
+    def render(self) -> List[str]:
+        try:
+            value = self.callback()
+        except Exception:
+            return []
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge", f"{self.name} {value}"]
+
+class Histogram:
+    """
+    Counts observations into cumulative buckets per label set, plus their sum and count.
+
+    Args
+    - name (str): Metric name in Prometheus format.
+    - help (str): Description of the metric.
+    - labelnames (Tuple[str, ...]): Names of the labels.
+    - buckets (Tuple[float, ...]): Upper bounds of the buckets, ascending.
+    """
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labelnames: Tuple[str, ...] = (),
+        buckets: Tuple[float, ...] = LATENCY_BUCKETS
+    ):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        # Per label set: counts per bucket (last one is +Inf), sum, count
+        self._values: Dict[Tuple[str, ...], Tuple[List[int], List[float]]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = _label_key(self.labelnames, labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.setdefault(key, ([0] * (len(self.buckets) + 1), [0.0]))
+            counts[index] += 1
+            total[0] += value
+
+    @contextmanager
+    def time(self, **labels) -> Iterator[None]:
+        """Observes the duration of the block in seconds."""
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - start, **labels)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (counts, total) in self._values.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float("inf"),), counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else repr(float(bound))
+                    labels = _format_labels(self.labelnames, key, 'le="' + le + '"')
+                    lines.append(f"{self.name}_bucket{labels} {cumulative}")
+                lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {total[0]}")
+                lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {cumulative}")
+        return lines
+
+class Registry:
+    """Holds the metrics of the process and renders them in the Prometheus text format."""
+    def __init__(self):
+        self._metrics: Dict[str, object] = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labelnames: Tuple[str, ...] = ()) -> Counter:
+        return self.register(Counter(name, help, labelnames))
+
+    def histogram(
+        self,
+        name: str,
+        help: str,
+        labelnames: Tuple[str, ...] = (),
+        buckets: Tuple[float, ...] = LATENCY_BUCKETS
+    ) -> Histogram:
+        return self.register(Histogram(name, help, labelnames, buckets))
+
+    def gauge(self, name: str, help: str, callback: Callable[[], float]) -> Gauge:
+        return self.register(Gauge(name, help, callback))
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines: List[str] = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+registry = Registry()
+
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+CHARS_BUCKETS = (500, 1000, 2000, 4000, 8000, 16000, 32000, 64000)
+RATE_BUCKETS = (1, 2, 5, 10, 20, 30, 50, 75, 100, 200)
+
+RAG_STAGE_SECONDS = registry.histogram(
+    "rag_stage_seconds", "Time spent in each stage of answering a question", ("agent", "stage")
+)
+RAG_CHUNKS_RETRIEVED = registry.histogram(
+    "rag_chunks_retrieved", "Chunks put into the prompt per question", buckets=SIZE_BUCKETS
+)
+RAG_PROMPT_CHARS = registry.histogram(
+    "rag_prompt_chars", "Characters in the prompt sent to the LLM", ("agent",), buckets=CHARS_BUCKETS
+)
+LLM_TIME_TO_FIRST_TOKEN_SECONDS = registry.histogram(
+    "llm_time_to_first_token_seconds", "Time from sending the prompt to the first generated token", ("agent",)
+)
+LLM_GENERATION_SECONDS = registry.histogram(
+    "llm_generation_seconds", "Time from sending the prompt to the last generated token", ("agent",)
+)
+LLM_TOKENS_PER_SECOND = registry.histogram(
+    "llm_tokens_per_second", "Generation speed reported by Ollama", ("agent",), buckets=RATE_BUCKETS
+)
+LLM_TOKENS = registry.counter("llm_tokens_total", "Tokens processed by the LLM", ("agent", "kind"))
+LLM_ERRORS = registry.counter("llm_errors_total", "Failed generations", ("agent",))
+LLM_SESSION_CONTEXT = registry.counter(
+    "llm_session_context_total", "Follow-up turns that continued or rebuilt the Ollama context", ("agent", "result")
+)
+EMBEDDING_SECONDS = registry.histogram(
+    "embedding_seconds", "Time of one call to an embedding backend", ("backend",)
+)
+EMBEDDING_TEXTS = registry.counter("embedding_texts_total", "Texts embedded by a backend", ("backend",))
+EMBEDDING_RETRIES = registry.counter(
+    "embedding_retries_total", "Embedding requests retried after an error", ("backend",)
+)
+EMBEDDING_CACHE_LOOKUPS = registry.counter(
+    "embedding_cache_lookups_total", "Embedding cache lookups", ("result",)
+)
+ANSWER_CACHE_LOOKUPS = registry.counter("answer_cache_lookups_total", "Answer cache lookups", ("result",))
+ANSWER_CACHE_SAVED_SECONDS = registry.counter(
+    "answer_cache_saved_seconds_total", "Retrieval and generation time saved by answer cache hits"
+)
+SEMANTIC_DB_QUERY_SECONDS = registry.histogram(
+    "semantic_db_query_seconds", "Time of a semantic db search", ("kind",)
+)
+SEMANTIC_DB_SNAPSHOT_SECONDS = registry.histogram(
+    "semantic_db_snapshot_seconds", "Time to export a table to an exact search snapshot"
+)
+INGEST_PAGES = registry.counter("ingest_pages_total", "PDF pages parsed during ingestion")
+INGEST_CHUNKS = registry.counter("ingest_chunks_total", "Chunks written during ingestion")
+INGEST_FILES = registry.counter("ingest_files_total", "Files ingested", ("result",))
+INGEST_DEDUP_CHUNKS = registry.counter(
+    "ingest_dedup_chunks_total", "Chunks checked for near duplicates during ingestion", ("result",)
+)
+
+def server_timing_header(timings: Dict[str, float]) -> str:
+    """
+    Formats stage durations as a Server-Timing header value.
+
+    Args
+    - timings (Dict[str, float]): Durations in seconds by stage name.
+
+    Returns
+    - (str): e.g. 'embed;dur=12.1, search;dur=3.4'
+    """
+    return ", ".join(f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in timings.items())
+
+@contextmanager
+def stage_timer(
+    agent: str,
+    stage: str,
+    timings: Optional[Dict[str, float]] = None
+) -> Iterator[None]:
+    """
+    Observes the duration of a stage of an agent, and records it in a per request timings dict if given.
+
+    Args
+    - agent (str): 'rag', 'chat' or 'search'.
+    - stage (str): Name of the stage, e.g. 'embed' or 'search'.
+    - timings (Optional[Dict[str, float]]): Per request durations by stage, used for timing headers.
+    """
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        seconds = perf_counter() - start
+        RAG_STAGE_SECONDS.observe(seconds, agent=agent, stage=stage)
+        if timings is not None:
+            timings[stage] = seconds
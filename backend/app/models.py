@@ -1,7 +1,29 @@
 from pydantic import BaseModel
-from typing import AsyncIterable, Iterable, List, Union
+from typing import AsyncIterable, Iterable, List, Optional, Union
+from .semantic_db.search_filter import SearchFilter
 
-Content = Union[str, bytes]
+class StreamFrame(BaseModel):
+    """
+    A typed part of an agent stream other than answer text, which is streamed as plain strings.
+
+    Attributes:
+        event (str): 'references', 'error' or 'stats'
+        data (dict): {'sources': [...]} for references, {'message': ...} for errors,
+            the Ollama token counts and durations of the generation for stats
+    """
+    event: str
+    data: dict = {}
+
+    def text(self) -> str:
+        """The frame as part of a plain text answer, stats are not shown."""
+        if self.event == "references":
+            sources = self.data.get("sources", [])
+            return '\n\n\n**References:**\n\n' + "".join(sources) if sources else ""
+        if self.event == "error":
+            return self.data.get("message", "")
+        return ""
+
+Content = Union[str, bytes, StreamFrame]
 SyncContentStream = Iterable[Content]
 AsyncContentStream = AsyncIterable[Content]
 ContentStream = Union[AsyncContentStream, SyncContentStream]
@@ -23,5 +45,26 @@ class Body(BaseModel):
 
     Attributes:
         messages (List[Message]): List of messages from the chat
+        session_id (Optional[str]): Id of the chat session, lets the server continue the LLM context of earlier turns
+        collections (Optional[List[str]]): Collections /rag searches, the configured default collections if None
+    """
+    messages: List[Message]
+    session_id: Optional[str] = None
+    collections: Optional[List[str]] = None
+
+class SearchBody(BaseModel):
+    """
+    The payload of a /search request, retrieval only without generation
+
+    Attributes:
+        queries (List[str]): The queries, embedded together in one call
+        collections (Optional[List[str]]): Collections searched, the configured default collections if None
+        n_results (int): Results per query
+        retrieval_mode (Optional[str]): 'vector' or 'hybrid', RAG_RETRIEVAL_MODE if None
+        filters (Optional[SearchFilter]): Metadata conditions the results must meet
     """
-    messages: List[Message]
\ No newline at end of file
+    queries: List[str]
+    collections: Optional[List[str]] = None
+    n_results: int = 4
+    retrieval_mode: Optional[str] = None
+    filters: Optional[SearchFilter] = None
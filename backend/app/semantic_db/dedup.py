@@ -0,0 +1,417 @@
+import logging
+import os
+import re
+import threading
+import uuid
+import zlib
+from typing import TYPE_CHECKING, Dict, Iterable, List, Optional, Set, Tuple
+import numpy as np
+from pydantic import BaseModel
+from ..metrics import INGEST_DEDUP_CHUNKS
+from .pdf_utils import TaggedChunk
+from .search_filter import sql_in
+
+if TYPE_CHECKING:
+    from lancedb.pydantic import LanceModel
+    from lancedb.table import Table
+    from .semantic_db import SemanticDb
+
+logger = logging.getLogger(__name__)
+
+# Columns of deduplicated tables listing every (file, page) a chunk occurs on, the row's own first
+OCCURRENCE_COLUMNS = ["occurrence_file_names", "occurrence_file_ids", "occurrence_page_labels", "occurrence_page_indices"]
+
+_MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+_MAX_HASH = np.uint64((1 << 32) - 1)
+
+class DedupSettings(BaseModel):
+    """
+    How near-identical chunks are detected at ingestion. The settings are fixed per table,
+    the signatures stored with the chunks are only comparable with the same ones.
+
+    Attributes:
+        threshold (float): Estimated Jaccard similarity of the word shingles from which two chunks count as one
+        num_perm (int): MinHash values per signature, more give a more precise similarity estimate
+        bands (int): LSH bands the signature is split into, num_perm must be a multiple of it.
+            Chunks sharing a band are compared, more bands find candidates of lower similarity
+        shingle_words (int): Words per shingle
+    """
+    threshold: float = 0.9
+    num_perm: int = 64
+    bands: int = 16
+    shingle_words: int = 5
+
+    @classmethod
+    def from_env(cls) -> Optional["DedupSettings"]:
+        """Reads INGEST_DEDUP and INGEST_DEDUP_THRESHOLD, None when deduplication is off."""
+        if os.getenv("INGEST_DEDUP", "false").lower() != "true":
+            return None
+        return cls(threshold=float(os.getenv("INGEST_DEDUP_THRESHOLD", "0.9")))
+
+class Occurrence(BaseModel):
+    """
+    A page a deduplicated chunk occurs on.
+
+    Attributes:
+        file_name (str): Name of the document
+        file_id (str): Id of the document
+        page_label (str): Label of the page
+        page_index (int): Index of the page
+    """
+    file_name: str
+    file_id: str
+    page_label: str
+    page_index: int
+
+class DedupStats(BaseModel):
+    """
+    Counts of the near-duplicate detection of an ingestion run.
+
+    Attributes:
+        chunks (int): Chunks checked
+        unique_chunks (int): Chunks embedded and stored
+        duplicates_in_file (int): Chunks near-identical to an earlier chunk of the same document
+        duplicates_across_files (int): Chunks near-identical to a chunk of another document of the run
+        duplicates_of_stored (int): Chunks near-identical to a chunk stored before the run
+        orphaned_references (int): Occurrences dropped because the document holding their chunk failed
+    """
+    chunks: int = 0
+    unique_chunks: int = 0
+    duplicates_in_file: int = 0
+    duplicates_across_files: int = 0
+    duplicates_of_stored: int = 0
+    orphaned_references: int = 0
+
+    @property
+    def duplicate_ratio(self) -> float:
+        return 1.0 - self.unique_chunks / self.chunks if self.chunks else 0.0
+
+    def add(self, other: "DedupStats") -> "DedupStats":
+        """The sum of two stats, e.g. of the shards of a collection."""
+        return DedupStats(**{name: getattr(self, name) + getattr(other, name) for name in DedupStats.model_fields})
+
+class DedupPlan(BaseModel):
+    """
+    The chunks of a batch split into the ones to embed and store, and back-references for the others.
+
+    Attributes:
+        chunks (List[TaggedChunk]): Chunks to embed and store
+        columns (List[dict]): Chunk id, signature and occurrence columns of each of them
+        references (List[Tuple[str, Occurrence]]): Chunk id of the stored copy and occurrence of every near duplicate
+    """
+    chunks: List[TaggedChunk] = []
+    columns: List[dict] = []
+    references: List[Tuple[str, Occurrence]] = []
+
+def occurrence_columns(occurrences: List[Occurrence]) -> dict:
+    """The occurrence columns of a row holding the given occurrences."""
+    return {
+        "occurrence_file_names": [o.file_name for o in occurrences],
+        "occurrence_file_ids": [o.file_id for o in occurrences],
+        "occurrence_page_labels": [o.page_label for o in occurrences],
+        "occurrence_page_indices": [o.page_index for o in occurrences]
+    }
+
+def row_occurrences(row: dict) -> List[Occurrence]:
+    """The occurrences stored in the occurrence columns of a row."""
+    return [
+        Occurrence(file_name=name, file_id=file_id, page_label=label, page_index=index)
+        for name, file_id, label, index in zip(*(row[c] for c in OCCURRENCE_COLUMNS))
+    ]
+
+def merge_occurrences(occurrences: List[Occurrence], added: Iterable[Occurrence]) -> List[Occurrence]:
+    """Appends occurrences, keeping one per page of a document."""
+    merged = list(occurrences)
+    seen = {(o.file_id, o.page_index) for o in merged}
+    for o in added:
+        if (o.file_id, o.page_index) not in seen:
+            seen.add((o.file_id, o.page_index))
+            merged.append(o)
+    return merged
+
+def chunk_ids_filter(chunk_ids: List[str]) -> str:
+    """SQL filter matching the rows of the given chunk ids."""
+    return sql_in("chunk_id", chunk_ids)
+
+class MinHasher:
+    """
+    MinHash signatures of the word shingles of texts. The permutations are derived from a fixed seed,
+    so signatures computed in different processes and runs can be compared.
+
+    Args
+    - num_perm (int): Values per signature.
+    - shingle_words (int): Words per shingle, texts with fewer words are one shingle.
+    - seed (int): Seed of the permutations.
+    """
+    def __init__(self, num_perm: int = 64, shingle_words: int = 5, seed: int = 1):
+        self.num_perm = num_perm
+        self.shingle_words = shingle_words
+        rng = np.random.RandomState(seed)
+        self._a = rng.randint(1, int(_MERSENNE_PRIME), size=num_perm, dtype=np.uint64)
+        self._b = rng.randint(0, int(_MERSENNE_PRIME), size=num_perm, dtype=np.uint64)
+
+    def signature(self, text: str) -> np.ndarray:
+        """
+        Computes the signature of a text, insensitive to case, punctuation and whitespace.
+
+        Args
+        - text (str): The text.
+
+        Returns
+        - signature (np.ndarray): num_perm uint32 values.
+        """
+        words = re.findall(r"\w+", text.lower())
+        k = self.shingle_words
+        shingles = {" ".join(words[i:i + k]) for i in range(max(1, len(words) - k + 1))}
+        hashes = np.fromiter((zlib.crc32(s.encode("utf-8")) for s in shingles), dtype=np.uint64, count=len(shingles))
+        # Universal hashing modulo a Mersenne prime, the products wrap around like in the usual implementations
+        permuted = (np.outer(hashes, self._a) + self._b) % _MERSENNE_PRIME
+        return (permuted & _MAX_HASH).min(axis=0).astype(np.uint32)
+
+class NearDuplicateIndex:
+    """
+    Locality sensitive hashing of MinHash signatures. Signatures are split into bands and the keys
+    sharing a band with a query are compared on the whole signature.
+
+    Args
+    - settings (DedupSettings): Threshold, signature length and bands.
+    """
+    def __init__(self, settings: DedupSettings):
+        if settings.num_perm % settings.bands:
+            raise ValueError("num_perm must be a multiple of bands")
+        self.threshold = settings.threshold
+        self.bands = settings.bands
+        self.rows = settings.num_perm // settings.bands
+        self._buckets: Dict[Tuple[int, bytes], List[int]] = {}
+        self._keys: List[str] = []
+        self._signatures: List[np.ndarray] = []
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def _band_keys(self, signature: np.ndarray) -> Iterable[Tuple[int, bytes]]:
+        for band in range(self.bands):
+            yield band, signature[band * self.rows:(band + 1) * self.rows].tobytes()
+
+    def add(self, key: str, signature: np.ndarray):
+        """Adds a signature under a key."""
+        position = len(self._keys)
+        self._keys.append(key)
+        self._signatures.append(signature)
+        for band_key in self._band_keys(signature):
+            self._buckets.setdefault(band_key, []).append(position)
+
+    def find(self, signature: np.ndarray, exclude: Set[str] = frozenset()) -> Optional[str]:
+        """
+        Returns the key of the most similar signature whose estimated similarity reaches the threshold.
+
+        Args
+        - signature (np.ndarray): The signature to look up.
+        - exclude (Set[str]): Keys not to return.
+
+        Returns
+        - key (Optional[str]): The key, None if there is no near duplicate.
+        """
+        candidates: Set[int] = set()
+        for band_key in self._band_keys(signature):
+            candidates.update(self._buckets.get(band_key, ()))
+        best, best_similarity = None, self.threshold
+        for position in candidates:
+            if self._keys[position] in exclude:
+                continue
+            similarity = float(np.mean(self._signatures[position] == signature))
+            if similarity >= best_similarity:
+                best, best_similarity = position, similarity
+        return self._keys[best] if best is not None else None
+
+def table_fingerprint(table: "Table") -> Tuple[str, ...]:
+    """The fragments of a table with their data and deletion files, changed by writes but not by index builds."""
+    return tuple(str(fragment.metadata) for fragment in table.to_lance().get_fragments())
+
+class StoredSignatures:
+    """
+    The MinHash signatures of the chunks stored in a deduplicated table, loaded once per process and
+    extended by the writes of SemanticDb.write_deduplicated_chunks, so an ingestion run does not read
+    every signature of the table. The fragments of the table are compared before each run, and the
+    signatures are reloaded when anything else changed the table, e.g. another process or a compaction.
+    Deletions and replaced documents also mark them for a reload, they move chunks between documents.
+
+    Args
+    - settings (DedupSettings): Threshold, signature length and bands.
+    """
+    def __init__(self, settings: DedupSettings):
+        self.settings = settings
+        self.index = NearDuplicateIndex(settings)
+        # File id of every stored chunk, by chunk id
+        self.file_ids: Dict[str, str] = {}
+        # Fragments the signatures match, None once they are stale
+        self.fingerprint: Optional[Tuple[str, ...]] = None
+        # Held while the signatures are read, reloaded or the table is written
+        self.lock = threading.Lock()
+
+    def __contains__(self, chunk_id: str) -> bool:
+        return chunk_id in self.file_ids
+
+    def add(self, chunk_id: str, file_id: str, signature: np.ndarray):
+        """Adds the signature of a stored chunk."""
+        if chunk_id not in self.file_ids:
+            self.file_ids[chunk_id] = file_id
+            self.index.add(chunk_id, signature)
+
+    def sync(self, table: "Table"):
+        """Reloads the signatures, without the text or vectors of the chunks, if the table changed. Must be called with the lock held."""
+        fingerprint = table_fingerprint(table)
+        if fingerprint == self.fingerprint:
+            return
+        self.index = NearDuplicateIndex(self.settings)
+        self.file_ids = {}
+        data = table.to_lance().to_table(columns=["chunk_id", "file_id", "minhash"])
+        for chunk_id, file_id, minhash in zip(
+            data["chunk_id"].to_pylist(), data["file_id"].to_pylist(), data["minhash"].to_pylist()
+        ):
+            self.add(chunk_id, file_id, np.asarray(minhash, dtype=np.uint32))
+        self.fingerprint = fingerprint
+        if self.file_ids:
+            logger.info(f"Loaded {len(self.file_ids)} chunk signatures of {table.name} for deduplication")
+
+class ChunkDeduplicator:
+    """
+    Stores near-identical chunks of a table once during an ingestion run, e.g. cover sheets, legal
+    boilerplate and the unchanged pages of revised manuals. A chunk whose MinHash signature matches a
+    chunk stored before or earlier in the run is not embedded, its (file, page) is added to the occurrence
+    columns of the stored copy instead, so get_sources still cites every page it occurs on.
+
+    Planning and writing are separate steps so they can run in different pipeline stages. A back-reference
+    is written in the commit of its own document: into the stored copy if that is in the same commit or
+    already in the table, otherwise once the commit holding the copy is written. References to copies
+    whose document fails are dropped and counted as orphaned.
+
+    Args
+    - semantic_db (SemanticDb): The semantic db holding the table, created with dedup settings.
+    - table_name (str): The name of the table in the semantic database.
+    - replaced_file_ids (Iterable[str]): Documents replaced in this run, their chunks are not matched against.
+    """
+    def __init__(self, semantic_db: "SemanticDb", table_name: str, replaced_file_ids: Iterable[str] = ()):
+        if semantic_db.dedup is None:
+            raise ValueError("The semantic db has no dedup settings")
+        self.semantic_db = semantic_db
+        self.table_name = table_name
+        self.hasher = MinHasher(semantic_db.dedup.num_perm, semantic_db.dedup.shingle_words)
+        # Chunks in the table, stored before or during the run, shared with the other runs of the process
+        self.stored = semantic_db.stored_signatures(table_name)
+        # Chunks planned in this run, they may still fail before they are written
+        self.index = NearDuplicateIndex(semantic_db.dedup)
+        self._stats = DedupStats()
+        # File id of the chunks added in this run, by chunk id
+        self._owners: Dict[str, str] = {}
+        # Back-references of written documents waiting for the commit of their stored copy
+        self._waiting: Dict[str, List[Occurrence]] = {}
+        self._lock = threading.Lock()
+        # Stored chunks of the replaced documents are not matched against
+        replaced = set(replaced_file_ids)
+        with self.stored.lock:
+            self._excluded = {chunk_id for chunk_id, file_id in self.stored.file_ids.items() if file_id in replaced} if replaced else set()
+
+    def plan(self, text_chunks: List[TaggedChunk]) -> DedupPlan:
+        """
+        Splits chunks into the ones to store and back-references to near-identical stored or planned ones.
+
+        Args
+        - text_chunks (List[TaggedChunk]): Chunks of one or more documents.
+
+        Returns
+        - plan (DedupPlan): Chunks to embed with their extra columns, and the back-references.
+        """
+        plan = DedupPlan()
+        signatures = [self.hasher.signature(c.text) for c in text_chunks]
+        with self._lock, self.stored.lock:
+            for chunk, signature in zip(text_chunks, signatures):
+                self._stats.chunks += 1
+                occurrence = Occurrence(
+                    file_name=chunk.file_name, file_id=chunk.file_id, page_label=chunk.page_label, page_index=chunk.page_index
+                )
+                chunk_id = self.stored.index.find(signature, self._excluded) or self.index.find(signature)
+                if chunk_id is None:
+                    chunk_id = uuid.uuid4().hex
+                    self.index.add(chunk_id, signature)
+                    self._owners[chunk_id] = chunk.file_id
+                    self._stats.unique_chunks += 1
+                    INGEST_DEDUP_CHUNKS.inc(result="unique")
+                    plan.chunks.append(chunk)
+                    plan.columns.append({
+                        "chunk_id": chunk_id, "minhash": signature.tolist(), **occurrence_columns([occurrence])
+                    })
+                    continue
+                owner = self._owners.get(chunk_id)
+                if owner is None:
+                    self._stats.duplicates_of_stored += 1
+                    INGEST_DEDUP_CHUNKS.inc(result="stored")
+                elif owner == chunk.file_id:
+                    self._stats.duplicates_in_file += 1
+                    INGEST_DEDUP_CHUNKS.inc(result="in_file")
+                else:
+                    self._stats.duplicates_across_files += 1
+                    INGEST_DEDUP_CHUNKS.inc(result="across_files")
+                plan.references.append((chunk_id, occurrence))
+        return plan
+
+    def write(
+        self,
+        rows: List["LanceModel"],
+        references: List[Tuple[str, Occurrence]],
+        replaced_file_ids: Optional[List[str]] = None
+    ):
+        """
+        Writes embedded chunks of planned documents with their back-references in one commit.
+
+        Args
+        - rows (List[EmbeddedChunk]): Embedded chunks of the documents, with the columns of their plans.
+        - references (List[Tuple[str, Occurrence]]): The back-references of the plans of the same documents.
+        - replaced_file_ids (Optional[List[str]]): Ids of earlier versions of the documents, deleted in the same commit.
+        """
+        with self._lock:
+            batch = {row.chunk_id: row for row in rows}
+            added: Dict[str, List[Occurrence]] = {}
+            waiting: List[Tuple[str, Occurrence]] = []
+            for chunk_id in batch:
+                if chunk_id in self._waiting:
+                    added[chunk_id] = list(self._waiting[chunk_id])
+            for chunk_id, occurrence in references:
+                if chunk_id in batch or chunk_id in self.stored:
+                    added.setdefault(chunk_id, []).append(occurrence)
+                else:
+                    waiting.append((chunk_id, occurrence))
+
+            new_rows = [
+                row.model_copy(update=occurrence_columns(merge_occurrences(row_occurrences(row.model_dump()), added[chunk_id])))
+                if chunk_id in added else row
+                for chunk_id, row in batch.items()
+            ]
+            stored_added = {chunk_id: occurrences for chunk_id, occurrences in added.items() if chunk_id not in batch}
+            updated_rows = self.semantic_db.add_occurrences(stored_added, self.table_name)
+            self.semantic_db.write_deduplicated_chunks(new_rows, updated_rows, replaced_file_ids or [], self.table_name)
+            # Stored copies deleted since the run started, e.g. by a concurrent deletion job
+            missing = stored_added.keys() - {row.chunk_id for row in updated_rows}
+            if missing:
+                self._stats.orphaned_references += sum(len(stored_added[chunk_id]) for chunk_id in missing)
+
+            # Only after the commit, a failed one leaves the state as it was
+            for chunk_id in batch:
+                self._waiting.pop(chunk_id, None)
+            for chunk_id, occurrence in waiting:
+                self._waiting.setdefault(chunk_id, []).append(occurrence)
+
+    def finish(self) -> DedupStats:
+        """Ends the run, counting the back-references whose stored copy was never written."""
+        with self._lock:
+            orphaned = sum(len(occurrences) for occurrences in self._waiting.values())
+            if orphaned:
+                logger.warning(f"Dropped {orphaned} occurrences in {self.table_name} whose chunk was not written")
+            self._stats.orphaned_references += orphaned
+            self._waiting.clear()
+            return self._stats.model_copy()
+
+    def stats(self) -> DedupStats:
+        """Returns a snapshot of the counts so far."""
+        with self._lock:
+            return self._stats.model_copy()
@@ -0,0 +1,225 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Awaitable, Callable, Dict, List, Optional
+import numpy as np
+from pydantic import BaseModel
+from ..metrics import EMBEDDING_RETRIES
+from .vector_storage import truncate_and_normalise
+
+logger = logging.getLogger(__name__)
+
+class EmbeddingBatchPolicy(BaseModel):
+    """
+    How an embedding backend splits texts into requests.
+
+    Attributes:
+        max_texts (int): Texts per request at most
+        max_chars (int): Characters per request at most, a longer single text is sent alone.
+            Lowered while requests fail, e.g. on timeouts, and raised back while they succeed
+        concurrency (int): Requests of one call in flight at once
+        max_retries (int): Retries of a failing text before the error is raised.
+            A failing request of several texts is split in halves for its retry
+        retry_backoff (float): Seconds before the first retry, doubled for each further one
+    """
+    max_texts: int = 1000
+    max_chars: int = 50_000
+    concurrency: int = 2
+    max_retries: int = 3
+    retry_backoff: float = 0.5
+
+    @classmethod
+    def from_env(cls) -> "EmbeddingBatchPolicy":
+        """Reads EMBED_REQUEST_MAX_TEXTS, EMBED_REQUEST_MAX_CHARS, EMBED_REQUEST_CONCURRENCY and EMBED_REQUEST_RETRIES."""
+        return cls(
+            max_texts=int(os.getenv("EMBED_REQUEST_MAX_TEXTS", "1000")),
+            max_chars=int(os.getenv("EMBED_REQUEST_MAX_CHARS", "50000")),
+            concurrency=int(os.getenv("EMBED_REQUEST_CONCURRENCY", "2")),
+            max_retries=int(os.getenv("EMBED_REQUEST_RETRIES", "3"))
+        )
+
+def fit_dimensions(embeddings: List[List[float]], dimensions: Optional[int]) -> List[List[float]]:
+    """
+    Makes embeddings match the configured dimensions. Longer vectors of matryoshka models are truncated
+    and renormalised, shorter ones mean a misconfigured model and raise.
+
+    Args
+    - embeddings (List[List[float]]): Vectors returned by the embedding model.
+    - dimensions (Optional[int]): The configured dimensions, None keeps the vectors as they are.
+
+    Returns
+    - embeddings (List[List[float]]): Vectors with the configured dimensions.
+    """
+    if not dimensions or not embeddings or len(embeddings[0]) == dimensions:
+        return embeddings
+    if len(embeddings[0]) < dimensions:
+        raise ValueError(f"The embedding model returned {len(embeddings[0])} dimensions, {dimensions} are configured")
+    return truncate_and_normalise(np.asarray(embeddings, dtype=np.float32), dimensions).tolist()
+
+class AdaptiveBatcher:
+    """
+    Sends the texts of an embedding call as several requests, packed by character count so long pages
+    and short chunks give requests of similar cost. Up to `concurrency` requests of a call are in flight at once
+    and the embeddings are returned in input order. Failed requests are retried with exponential backoff,
+    split in halves so one oversized or bad batch does not fail the whole call. Failures halve the
+    character budget of the following requests and successes double it back up to max_chars,
+    the budget is shared by all calls of the backend.
+
+    Args
+    - policy (EmbeddingBatchPolicy): Request size, concurrency and retry limits.
+    - backend (str): Backend name for the metrics, e.g. 'ollama'.
+    """
+    def __init__(self, policy: EmbeddingBatchPolicy, backend: str):
+        self.policy = policy
+        self.backend = backend
+        self._max_chars = policy.max_chars
+        self._lock = threading.Lock()
+
+    @property
+    def max_chars(self) -> int:
+        """The current character budget of a request."""
+        return self._max_chars
+
+    def _batch_end(self, texts: List[str], start: int) -> int:
+        max_chars = self._max_chars
+        end, chars = start, 0
+        while end < len(texts) and end - start < self.policy.max_texts:
+            chars += len(texts[end])
+            if chars > max_chars and end > start:
+                break
+            end += 1
+        return end
+
+    def _failed(self, texts: List[str], attempt: int, error: Exception) -> float:
+        with self._lock:
+            self._max_chars = max(1, min(self._max_chars, sum(len(t) for t in texts)) // 2)
+        EMBEDDING_RETRIES.inc(backend=self.backend)
+        delay = self.policy.retry_backoff * 2 ** attempt
+        logger.warning(
+            f"Embedding {len(texts)} texts with {self.backend} failed ({error}), retrying in {delay:.1f}s"
+            + (" in two halves" if len(texts) > 1 else "")
+        )
+        return delay
+
+    def _succeeded(self):
+        if self._max_chars < self.policy.max_chars:
+            with self._lock:
+                self._max_chars = min(self.policy.max_chars, self._max_chars * 2)
+
+    def _check(self, texts: List[str], embeddings: List[List[float]]) -> List[List[float]]:
+        if len(embeddings) != len(texts):
+            raise ValueError(f"Got {len(embeddings)} embeddings for {len(texts)} texts")
+        return embeddings
+
+    def _embed_with_retry(
+        self,
+        embed_batch: Callable[[List[str]], List[List[float]]],
+        texts: List[str],
+        attempt: int = 0
+    ) -> List[List[float]]:
+        try:
+            embeddings = self._check(texts, embed_batch(texts))
+        except Exception as e:
+            if attempt >= self.policy.max_retries:
+                raise
+            time.sleep(self._failed(texts, attempt, e))
+            if len(texts) == 1:
+                return self._embed_with_retry(embed_batch, texts, attempt + 1)
+            middle = len(texts) // 2
+            return (
+                self._embed_with_retry(embed_batch, texts[:middle], attempt + 1)
+                + self._embed_with_retry(embed_batch, texts[middle:], attempt + 1)
+            )
+        self._succeeded()
+        return embeddings
+
+    async def _aembed_with_retry(
+        self,
+        aembed_batch: Callable[[List[str]], Awaitable[List[List[float]]]],
+        texts: List[str],
+        attempt: int = 0
+    ) -> List[List[float]]:
+        try:
+            embeddings = self._check(texts, await aembed_batch(texts))
+        except Exception as e:
+            if attempt >= self.policy.max_retries:
+                raise
+            await asyncio.sleep(self._failed(texts, attempt, e))
+            if len(texts) == 1:
+                return await self._aembed_with_retry(aembed_batch, texts, attempt + 1)
+            middle = len(texts) // 2
+            return (
+                await self._aembed_with_retry(aembed_batch, texts[:middle], attempt + 1)
+                + await self._aembed_with_retry(aembed_batch, texts[middle:], attempt + 1)
+            )
+        self._succeeded()
+        return embeddings
+
+    def embed(self, embed_batch: Callable[[List[str]], List[List[float]]], texts: List[str]) -> List[List[float]]:
+        """
+        Embeds texts with concurrent requests.
+
+        Args
+        - embed_batch (Callable[[List[str]], List[List[float]]]): Sends one request, e.g. to the Ollama embed API.
+        - texts (List[str]): The texts to embed.
+
+        Returns
+        - embeddings (List[List[float]]): The embeddings in the order of the texts.
+        """
+        if not texts:
+            return []
+        if self._batch_end(texts, 0) == len(texts):
+            return self._embed_with_retry(embed_batch, texts)
+        results: Dict[int, List[List[float]]] = {}
+        pending: Dict[Future, int] = {}
+        start = 0
+        with ThreadPoolExecutor(max_workers=self.policy.concurrency, thread_name_prefix=f"embed-{self.backend}") as executor:
+            while start < len(texts) or pending:
+                # Batches are cut when they are sent, so they follow the current character budget
+                while start < len(texts) and len(pending) < self.policy.concurrency:
+                    end = self._batch_end(texts, start)
+                    pending[executor.submit(self._embed_with_retry, embed_batch, texts[start:end])] = start
+                    start = end
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    results[pending.pop(future)] = future.result()
+        return [e for start in sorted(results) for e in results[start]]
+
+    async def aembed(
+        self,
+        aembed_batch: Callable[[List[str]], Awaitable[List[List[float]]]],
+        texts: List[str]
+    ) -> List[List[float]]:
+        """
+        Async version of embed, the requests run as concurrent tasks.
+
+        Args
+        - aembed_batch (Callable[[List[str]], Awaitable[List[List[float]]]]): Sends one request.
+        - texts (List[str]): The texts to embed.
+
+        Returns
+        - embeddings (List[List[float]]): The embeddings in the order of the texts.
+        """
+        if not texts:
+            return []
+        if self._batch_end(texts, 0) == len(texts):
+            return await self._aembed_with_retry(aembed_batch, texts)
+        results: Dict[int, List[List[float]]] = {}
+        pending: Dict[asyncio.Task, int] = {}
+        start = 0
+        try:
+            while start < len(texts) or pending:
+                while start < len(texts) and len(pending) < self.policy.concurrency:
+                    end = self._batch_end(texts, start)
+                    pending[asyncio.ensure_future(self._aembed_with_retry(aembed_batch, texts[start:end]))] = start
+                    start = end
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    results[pending.pop(task)] = task.result()
+        finally:
+            for task in pending:
+                task.cancel()
+        return [e for start in sorted(results) for e in results[start]]
@@ -0,0 +1,291 @@
+import atexit
+import hashlib
+import logging
+import os
+import re
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+import numpy as np
+from pydantic import BaseModel
+from ..metrics import EMBEDDING_CACHE_LOOKUPS
+
+try:
+    import fcntl
+except ImportError:  # Windows, the cache is then only safe within one process
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+class EmbeddingCacheStats(BaseModel):
+    """
+    Counters of an EmbeddingCache.
+
+    Attributes:
+        hits (int): Texts served from the cache
+        misses (int): Texts sent to the embedding backend
+        backend_calls (int): Batched calls made to the embedding backend
+        evictions (int): Entries dropped to stay within max_entries
+        entries (int): Entries currently in the cache
+        max_entries (int): Capacity of the cache
+    """
+    hits: int = 0
+    misses: int = 0
+    backend_calls: int = 0
+    evictions: int = 0
+    entries: int = 0
+    max_entries: int = 0
+
+    @property
+    def hit_ratio(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+class EmbeddingCache:
+    """
+    Content addressed on-disk cache in front of an embedding function, e.g. OllamaVecs.get_embeddings.
+
+    Vectors live in a memory mapped float32 array with one slot per entry, and an LRU ordered index maps
+    the key of each text (a hash of model, dimensions and text) to its slot. Each slot also stores its key,
+    so index entries whose slot was reused after the last flush are detected and dropped on load,
+    and a hit whose slot no longer holds its key is treated as a miss.
+    Several processes, e.g. the API and an ingestion run, can share a cache_dir: writes and index saves are
+    serialised with a file lock, and a process only takes free slots no other process has filled.
+    When the cache is full the least recently used slot is reused. Texts missing from a batch are sent to the backend in one call.
+    It has the same get_embeddings/get_embedding interface as the embedding classes so it can stand in for them.
+
+    Args
+    - embedding_function (Callable[[List[str]], List[List[float]]]): The backend embedding function.
+    - embedding_model (str): Model id of the backend, part of the cache key.
+    - dimensions (int): Vector dimension of the backend, part of the cache key.
+    - cache_dir (str): Folder for the cache files. One sub folder is used per model and dimension.
+    - max_entries (int): Maximum number of cached vectors.
+    - flush_every (int): Persist the index after this many new entries. The index is also saved at exit.
+    - async_embedding_function (Optional[Callable]): Async backend used by aget_embeddings, e.g. OllamaVecs.aget_embeddings.
+    """
+    def __init__(
+        self,
+        embedding_function: Callable[[List[str]], List[List[float]]],
+        embedding_model: str,
+        dimensions: int,
+        cache_dir: str,
+        max_entries: int = 200_000,
+        flush_every: int = 1000,
+        async_embedding_function: Optional[Callable[[List[str]], Awaitable[List[List[float]]]]] = None
+    ):
+        self.embedding_function = embedding_function
+        self.async_embedding_function = async_embedding_function
+        self.embedding_model = embedding_model
+        self.dimensions = dimensions
+        self.max_entries = max_entries
+        self.flush_every = flush_every
+        self.cache_dir = os.path.join(cache_dir, f"{re.sub(r'[^A-Za-z0-9_.-]', '_', embedding_model)}-{dimensions}")
+        self._vectors_path = os.path.join(self.cache_dir, "vectors.f32")
+        self._slot_keys_path = os.path.join(self.cache_dir, "slot_keys.u8")
+        self._index_path = os.path.join(self.cache_dir, "index.npz")
+        self._lock_path = os.path.join(self.cache_dir, "lock")
+        self._lock = threading.Lock()
+        self._index: "OrderedDict[bytes, int]" = OrderedDict()
+        self._free_slots: List[int] = []
+        self._unflushed = 0
+        self._stats = EmbeddingCacheStats(max_entries=max_entries)
+        self._open()
+        atexit.register(self.flush)
+
+    @contextmanager
+    def _file_lock(self):
+        # Serialises writers of all processes sharing the cache folder
+        if fcntl is None:
+            yield
+            return
+        with open(self._lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _open(self):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # Another process must not create the files while this one opens them
+        with self._file_lock():
+            self._open_files()
+
+    def _open_files(self):
+        shape = (self.max_entries, self.dimensions)
+        expected_size = self.max_entries * self.dimensions * np.dtype(np.float32).itemsize
+        # Files of the right size are opened in place even without an index, another process may
+        # have mapped them and not saved its index yet, creating them again would truncate its entries
+        reuse = (os.path.exists(self._vectors_path) and os.path.exists(self._slot_keys_path)
+                 and os.path.getsize(self._vectors_path) == expected_size
+                 and os.path.getsize(self._slot_keys_path) == self.max_entries * 16)
+        mode = "r+" if reuse else "w+"
+        self._vectors = np.memmap(self._vectors_path, dtype=np.float32, mode=mode, shape=shape)
+        self._slot_keys = np.memmap(self._slot_keys_path, dtype=np.uint8, mode=mode, shape=(self.max_entries, 16))
+        if reuse and os.path.exists(self._index_path):
+            try:
+                with np.load(self._index_path) as data:
+                    # Stored from least to most recently used
+                    for key, slot in zip(data["keys"], data["slots"]):
+                        if np.array_equal(self._slot_keys[slot], key):
+                            self._index[key.tobytes()] = int(slot)
+            except Exception as e:
+                logger.warning(f"Discarding unreadable embedding cache index {self._index_path}: {e}")
+                self._index.clear()
+        used = set(self._index.values())
+        self._free_slots = [s for s in range(self.max_entries - 1, -1, -1) if s not in used]
+
+    def _key(self, text: str) -> bytes:
+        return hashlib.blake2b(
+            f"{self.embedding_model}\0{self.dimensions}\0{text}".encode(),
+            digest_size=16
+        ).digest()
+
+    def get_embeddings(self, text_chunks: List[str]) -> List[List[float]]:
+        """
+        Returns embeddings for a list of strings, calling the backend once for the texts that are not cached.
+
+        Args
+        - text_chunks (List[str]): A list of strings for which embeddings are to be generated.
+
+        Returns
+        - embeddings (List[List[float]]): A list of embeddings in the order of text_chunks.
+        """
+        embeddings, missing = self._lookup(text_chunks)
+        if not missing:
+            return embeddings
+        # One batched backend call for all distinct misses
+        miss_texts = [text_chunks[indices[0]] for indices in missing.values()]
+        new_vectors = self.embedding_function(text_chunks=miss_texts)
+        self._fill(embeddings, missing, new_vectors)
+        return embeddings
+
+    async def aget_embeddings(self, text_chunks: List[str]) -> List[List[float]]:
+        """
+        Async version of get_embeddings using the async backend.
+
+        Args
+        - text_chunks (List[str]): A list of strings for which embeddings are to be generated.
+
+        Returns
+        - embeddings (List[List[float]]): A list of embeddings in the order of text_chunks.
+        """
+        if self.async_embedding_function is None:
+            raise ValueError("EmbeddingCache has no async_embedding_function")
+        embeddings, missing = self._lookup(text_chunks)
+        if not missing:
+            return embeddings
+        miss_texts = [text_chunks[indices[0]] for indices in missing.values()]
+        new_vectors = await self.async_embedding_function(text_chunks=miss_texts)
+        self._fill(embeddings, missing, new_vectors)
+        return embeddings
+
+    def _lookup(self, text_chunks: List[str]) -> Tuple[List, Dict[bytes, List[int]]]:
+        # Returns the cached vectors in input order (None for misses) and the input positions of each missing key
+        keys = [self._key(t) for t in text_chunks]
+        embeddings: List = [None] * len(text_chunks)
+        missing: Dict[bytes, List[int]] = {}
+        with self._lock:
+            for i, key in enumerate(keys):
+                slot = self._index.get(key)
+                vector = self._read_slot(key, slot) if slot is not None else None
+                if vector is not None:
+                    self._index.move_to_end(key)
+                    embeddings[i] = vector
+                    self._stats.hits += 1
+                else:
+                    if slot is not None:
+                        # The slot was reused by another process
+                        del self._index[key]
+                    missing.setdefault(key, []).append(i)
+                    self._stats.misses += 1
+        misses = sum(len(positions) for positions in missing.values())
+        EMBEDDING_CACHE_LOOKUPS.inc(len(text_chunks) - misses, result="hit")
+        EMBEDDING_CACHE_LOOKUPS.inc(misses, result="miss")
+        return embeddings, missing
+
+    def _read_slot(self, key: bytes, slot: int) -> Optional[List[float]]:
+        # The key is checked before and after the read, so a vector another process overwrites meanwhile is not returned
+        expected = np.frombuffer(key, dtype=np.uint8)
+        if not np.array_equal(self._slot_keys[slot], expected):
+            return None
+        vector = self._vectors[slot].tolist()
+        if not np.array_equal(self._slot_keys[slot], expected):
+            return None
+        return vector
+
+    def _fill(self, embeddings: List, missing: Dict[bytes, List[int]], new_vectors: List[List[float]]):
+        miss_keys = list(missing)
+        with self._lock, self._file_lock():
+            self._stats.backend_calls += 1
+            for key, vector in zip(miss_keys, new_vectors):
+                for i in missing[key]:
+                    embeddings[i] = vector
+                self._store(key, vector)
+            flush = self._unflushed >= self.flush_every
+        if flush:
+            self.flush()
+
+    def _store(self, key: bytes, vector: List[float]):
+        # Must be called with self._lock and the file lock held
+        if key in self._index:
+            self._index.move_to_end(key)
+            return
+        # Slots free here may have been filled by another process sharing the folder
+        while self._free_slots and self._slot_keys[self._free_slots[-1]].any():
+            self._free_slots.pop()
+        if self._free_slots:
+            slot = self._free_slots.pop()
+        else:
+            _, slot = self._index.popitem(last=False)
+            self._stats.evictions += 1
+        # Clear the slot key first so a crash mid write never pairs a key with another text's vector
+        self._slot_keys[slot] = 0
+        self._vectors[slot] = vector
+        self._slot_keys[slot] = np.frombuffer(key, dtype=np.uint8)
+        self._index[key] = slot
+        self._unflushed += 1
+
+    def get_embedding(self, text: str) -> List[float]:
+        return self.get_embeddings([text])[0]
+
+    async def aget_embedding(self, text: str) -> List[float]:
+        return (await self.aget_embeddings([text]))[0]
+
+    def flush(self):
+        """Persists the vectors and the LRU index to disk."""
+        with self._lock:
+            if not self._unflushed:
+                return
+            with self._file_lock():
+                self._flush_files()
+
+    def _flush_files(self):
+        # Must be called with self._lock and the file lock held
+        self._vectors.flush()
+        self._slot_keys.flush()
+        index = self._index
+        if os.path.exists(self._index_path):
+            # Keeps the still valid entries other processes saved, as least recently used
+            index = OrderedDict()
+            try:
+                with np.load(self._index_path) as data:
+                    for key, slot in zip(data["keys"], data["slots"]):
+                        key_bytes = key.tobytes()
+                        if key_bytes not in self._index and np.array_equal(self._slot_keys[slot], key):
+                            index[key_bytes] = int(slot)
+            except Exception as e:
+                logger.warning(f"Overwriting unreadable embedding cache index {self._index_path}: {e}")
+            index.update(self._index)
+        keys = np.frombuffer(b"".join(index.keys()), dtype=np.uint8).reshape(-1, 16)
+        slots = np.fromiter(index.values(), dtype=np.int64, count=len(index))
+        tmp_path = f"{self._index_path}.tmp.npz"
+        np.savez(tmp_path, keys=keys, slots=slots)
+        os.replace(tmp_path, self._index_path)
+        self._unflushed = 0
+
+    def stats(self) -> EmbeddingCacheStats:
+        """Returns a snapshot of the cache counters."""
+        with self._lock:
+            return self._stats.model_copy(update={"entries": len(self._index)})
@@ -0,0 +1,402 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+from time import perf_counter
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+from pydantic import BaseModel
+from ..metrics import SEMANTIC_DB_SNAPSHOT_SECONDS
+from .dedup import OCCURRENCE_COLUMNS, Occurrence
+from .search_filter import SearchFilter
+from .table_pool import TablePool
+
+logger = logging.getLogger(__name__)
+
+# Queries scored at once, and rows scored at once per query block, so the similarity matrix of a
+# search stays at most QUERY_BLOCK x ROW_BLOCK floats whatever the number of queries and rows
+QUERY_BLOCK = 64
+ROW_BLOCK = 65536
+
+class ExactSnapshotInfo(BaseModel):
+    """
+    A vector snapshot of one table version.
+
+    Attributes:
+        table_name (str): The name of the table
+        version (int): Table version the snapshot was exported from
+        num_rows (int): Rows in the snapshot
+        dimensions (int): Dimensions of the stored vectors
+        vector_column (str): Column the vectors were exported from
+        bytes (int): Size of the snapshot files
+    """
+    table_name: str
+    version: int
+    num_rows: int
+    dimensions: int
+    vector_column: str
+    bytes: int = 0
+
+def _write_strings(path: str, values: List[str]):
+    # One utf-8 blob and the offsets of every value in it
+    encoded = [v.encode("utf-8") for v in values]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(e) for e in encoded], out=offsets[1:])
+    with open(path + ".bin", "wb") as f:
+        f.write(b"".join(encoded))
+    np.save(path + ".offsets.npy", offsets)
+
+def _top_k(similarities: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    # Columns and similarities of the k largest similarities of each row, unordered
+    if k < similarities.shape[1]:
+        top = np.argpartition(-similarities, k - 1, axis=1)[:, :k]
+    else:
+        top = np.broadcast_to(np.arange(similarities.shape[1]), similarities.shape)
+    return top, np.take_along_axis(similarities, top, axis=1)
+
+def _dictionary_encode(values: List) -> Tuple[List, np.ndarray]:
+    codes: Dict = {}
+    encoded = np.fromiter((codes.setdefault(v, len(codes)) for v in values), dtype=np.int32, count=len(values))
+    return list(codes), encoded
+
+class ExactSnapshot:
+    """
+    The memory-mapped files of a snapshot: a contiguous matrix of unit length float32 vectors, the chunk
+    texts as one utf-8 blob with offsets, and file names, file ids and page labels dictionary encoded.
+    Snapshots of deduplicated tables also hold the occurrences of every row, flattened with offsets.
+    The files are mapped read only, so every worker process searching them shares one page cache copy.
+
+    Args
+    - path (str): Folder of the snapshot.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, "snapshot.json")) as f:
+            self.info = ExactSnapshotInfo(**json.load(f))
+        self.vectors = np.load(os.path.join(path, "vectors.npy"), mmap_mode="r")
+        self.text_offsets = np.load(os.path.join(path, "text.offsets.npy"), mmap_mode="r")
+        self.text = np.memmap(os.path.join(path, "text.bin"), dtype=np.uint8, mode="r") if self.text_offsets[-1] else b""
+        self.file_codes = np.load(os.path.join(path, "file_codes.npy"), mmap_mode="r")
+        self.page_label_codes = np.load(os.path.join(path, "page_label_codes.npy"), mmap_mode="r")
+        self.page_index = np.load(os.path.join(path, "page_index.npy"), mmap_mode="r")
+        self.occurrence_offsets = None
+        if os.path.exists(os.path.join(path, "occurrence_offsets.npy")):
+            self.occurrence_offsets = np.load(os.path.join(path, "occurrence_offsets.npy"), mmap_mode="r")
+            self.occurrence_file_codes = np.load(os.path.join(path, "occurrence_file_codes.npy"), mmap_mode="r")
+            self.occurrence_page_label_codes = np.load(os.path.join(path, "occurrence_page_label_codes.npy"), mmap_mode="r")
+            self.occurrence_page_index = np.load(os.path.join(path, "occurrence_page_index.npy"), mmap_mode="r")
+        with open(os.path.join(path, "dictionaries.json")) as f:
+            dictionaries = json.load(f)
+        self.files: List[Tuple[str, str]] = [tuple(f) for f in dictionaries["files"]]
+        self.page_labels: List[str] = dictionaries["page_labels"]
+
+    def matching_rows(self, where: SearchFilter) -> np.ndarray:
+        """
+        The rows meeting the conditions of a filter, matched on the dictionaries before the row arrays.
+
+        Args
+        - where (SearchFilter): The conditions.
+
+        Returns
+        - rows (np.ndarray): Indices of the matching rows, ascending.
+        """
+        mask = np.ones(len(self.vectors), dtype=bool)
+        if where.file_ids is not None or where.file_names is not None:
+            file_ids = set(where.file_ids) if where.file_ids is not None else None
+            file_names = set(where.file_names) if where.file_names is not None else None
+            codes = [
+                code for code, (file_name, file_id) in enumerate(self.files)
+                if (file_ids is None or file_id in file_ids) and (file_names is None or file_name in file_names)
+            ]
+            if self.occurrence_offsets is not None and len(mask):
+                # A deduplicated chunk matches every document it occurs in, each row has at least its own occurrence
+                mask &= np.logical_or.reduceat(np.isin(self.occurrence_file_codes, codes), self.occurrence_offsets[:-1])
+            else:
+                mask &= np.isin(self.file_codes, codes)
+        if where.page_min is not None:
+            mask &= self.page_index >= where.page_min
+        if where.page_max is not None:
+            mask &= self.page_index <= where.page_max
+        return np.flatnonzero(mask)
+
+    def search(
+        self,
+        query_vectors: np.ndarray,
+        N_results: int,
+        where: Optional[SearchFilter] = None
+    ) -> List[List[Tuple[int, float]]]:
+        """
+        Finds the closest rows of several queries with matrix products. Queries are scored in blocks of
+        QUERY_BLOCK against blocks of ROW_BLOCK rows, and the top rows of each block are merged.
+
+        Args
+        - query_vectors (np.ndarray): Queries as rows, of the dimensions of the snapshot.
+        - N_results (int): Results per query.
+        - where (Optional[SearchFilter]): Only rows meeting these conditions are searched.
+
+        Returns
+        - results (List[List[Tuple[int, float]]]): Row and squared L2 distance of the results of each query, closest first.
+        """
+        rows = self.matching_rows(where) if where is not None else None
+        vectors = self.vectors if rows is None else self.vectors[rows]
+        num_rows = len(vectors)
+        k = min(N_results, num_rows)
+        if k <= 0 or len(query_vectors) == 0:
+            return [[] for _ in range(len(query_vectors))]
+        norms = np.linalg.norm(query_vectors, axis=1, keepdims=True)
+        queries = query_vectors / np.where(norms == 0, 1, norms)
+        results: List[List[Tuple[int, float]]] = []
+        for query_start in range(0, len(queries), QUERY_BLOCK):
+            block = queries[query_start:query_start + QUERY_BLOCK]
+            top: Optional[np.ndarray] = None
+            for row_start in range(0, num_rows, ROW_BLOCK):
+                block_top, block_similarities = _top_k(block @ vectors[row_start:row_start + ROW_BLOCK].T, k)
+                block_top = block_top + row_start
+                if top is None:
+                    top, top_similarities = block_top, block_similarities
+                else:
+                    merged_top = np.concatenate([top, block_top], axis=1)
+                    merged_similarities = np.concatenate([top_similarities, block_similarities], axis=1)
+                    keep, top_similarities = _top_k(merged_similarities, k)
+                    top = np.take_along_axis(merged_top, keep, axis=1)
+            order = np.argsort(-top_similarities, axis=1, kind="stable")
+            top = np.take_along_axis(top, order, axis=1)
+            if rows is not None:
+                top = rows[top]
+            # Squared L2 distance of unit vectors, the metric of the LanceDB search
+            distances = 2.0 - 2.0 * np.take_along_axis(top_similarities, order, axis=1)
+            results.extend(list(zip(r.tolist(), d.tolist())) for r, d in zip(top, distances))
+        return results
+
+    def row(self, i: int) -> dict:
+        """The result columns of a row."""
+        start, end = int(self.text_offsets[i]), int(self.text_offsets[i + 1])
+        file_name, file_id = self.files[self.file_codes[i]]
+        row = {
+            "text": bytes(self.text[start:end]).decode("utf-8"),
+            "file_name": file_name,
+            "file_id": file_id,
+            "page_label": self.page_labels[self.page_label_codes[i]],
+            "page_index": int(self.page_index[i])
+        }
+        if self.occurrence_offsets is not None:
+            occurrences = []
+            for j in range(int(self.occurrence_offsets[i]), int(self.occurrence_offsets[i + 1])):
+                file_name, file_id = self.files[self.occurrence_file_codes[j]]
+                occurrences.append(Occurrence(
+                    file_name=file_name,
+                    file_id=file_id,
+                    page_label=self.page_labels[self.occurrence_page_label_codes[j]],
+                    page_index=int(self.occurrence_page_index[j])
+                ))
+            row["occurrences"] = occurrences
+        return row
+
+class ExactSearch:
+    """
+    Exact vector search over memory-mapped snapshots of the tables, for corpora small enough that a
+    matrix product over all vectors is cheaper than the per query overhead of a LanceDB search.
+
+    A table is exported once per version to a snapshot folder and mapped read only. The first search of a
+    table builds its snapshot before searching. When a later search finds the table at a newer version it
+    is served from the previous snapshot, while the new one is built on a background thread and swapped in
+    once complete, so searches never wait for an export but may miss the latest writes for the duration of
+    one build. At most one build per table runs at a time. Snapshots are written to a
+    temporary folder and renamed into place, so worker processes building the same version at once do not
+    see partial files and the one that loses the race loads the winner's. Older versions are removed after
+    a rebuild, processes still mapping them keep reading until they switch.
+
+    Args
+    - table_pool (TablePool): The pool used to open tables.
+    - snapshot_dir (str): Local folder of the snapshots.
+    - vector_column (str): Column the vectors are exported from, e.g. 'full_vector' for full precision.
+    - occurrences (bool): Also export the occurrence columns of deduplicated tables.
+    """
+    def __init__(self, table_pool: TablePool, snapshot_dir: str, vector_column: str = "vector", occurrences: bool = False):
+        self.table_pool = table_pool
+        self.snapshot_dir = snapshot_dir
+        self.vector_column = vector_column
+        self.occurrences = occurrences
+        self._snapshots: Dict[str, ExactSnapshot] = {}
+        self._locks: Dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+        self._rebuilding: Dict[str, Future] = {}
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="exact-snapshot")
+
+    def _table_dir(self, table_name: str) -> str:
+        # Tables of different databases may share a snapshot folder
+        digest = hashlib.sha1(self.table_pool.semantic_db_path.encode("utf-8")).hexdigest()[:8]
+        return os.path.join(self.snapshot_dir, f"{table_name}-{digest}")
+
+    def _table_lock(self, table_name: str) -> threading.Lock:
+        with self._lock:
+            return self._locks.setdefault(table_name, threading.Lock())
+
+    def snapshot(self, table_name: str) -> ExactSnapshot:
+        """
+        Returns the snapshot to search a table with. The first call loads or builds the snapshot of the
+        current version, later calls return the loaded one and start a background rebuild if it is stale.
+
+        Args
+        - table_name (str): The name of the table in the semantic database.
+
+        Returns
+        - snapshot (ExactSnapshot): The mapped snapshot.
+        """
+        version = self.table_pool.table_version(table_name)
+        snapshot = self._snapshots.get(table_name)
+        if snapshot is None:
+            return self._load(table_name, version)
+        if snapshot.info.version != version:
+            self.refresh_in_background(table_name, version)
+        return snapshot
+
+    def refresh_in_background(self, table_name: str, version: int) -> Future:
+        """
+        Queues loading or building the snapshot of a table version, unless a rebuild of the table is queued already.
+
+        Args
+        - table_name (str): The name of the table in the semantic database.
+        - version (int): The table version to load.
+
+        Returns
+        - future (Future): Resolves to the new snapshot, or the queued rebuild.
+        """
+        with self._lock:
+            if table_name in self._rebuilding:
+                return self._rebuilding[table_name]
+            future = self._executor.submit(self._load, table_name, version)
+            self._rebuilding[table_name] = future
+        future.add_done_callback(lambda f: self._refresh_done(table_name, f))
+        return future
+
+    def _refresh_done(self, table_name: str, future: Future):
+        with self._lock:
+            self._rebuilding.pop(table_name, None)
+        if future.exception():
+            logger.error(f"Rebuilding the exact search snapshot of {table_name} failed: {future.exception()}")
+
+    def _load(self, table_name: str, version: int) -> ExactSnapshot:
+        with self._table_lock(table_name):
+            snapshot = self._snapshots.get(table_name)
+            if snapshot is not None and snapshot.info.version == version:
+                return snapshot
+            path = os.path.join(self._table_dir(table_name), f"v{version}")
+            if not os.path.exists(os.path.join(path, "snapshot.json")):
+                path = self._build(table_name)
+            snapshot = ExactSnapshot(path)
+            # Searches started before this hold on to the previous snapshot, later ones get the new one
+            self._snapshots[table_name] = snapshot
+            return snapshot
+
+    def _build(self, table_name: str) -> str:
+        start = perf_counter()
+        dataset = self.table_pool.get_table(table_name).to_lance()
+        version = dataset.version
+        columns = [self.vector_column, "text", "file_name", "file_id", "page_label", "page_index"]
+        data = dataset.to_table(columns=columns + (OCCURRENCE_COLUMNS if self.occurrences else []))
+        num_rows = len(data)
+        if num_rows:
+            vectors = (data[self.vector_column]
+                .combine_chunks()
+                .flatten()
+                .to_numpy()
+                .reshape(num_rows, -1)
+                .astype(np.float32))
+        else:
+            vectors = np.zeros((0, 0), dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors /= np.where(norms == 0, 1, norms)
+
+        table_dir = self._table_dir(table_name)
+        final_path = os.path.join(table_dir, f"v{version}")
+        tmp_path = os.path.join(table_dir, f".tmp-{uuid.uuid4().hex}")
+        os.makedirs(tmp_path)
+        try:
+            np.save(os.path.join(tmp_path, "vectors.npy"), vectors)
+            _write_strings(os.path.join(tmp_path, "text"), data["text"].to_pylist())
+            file_keys = list(zip(data["file_name"].to_pylist(), data["file_id"].to_pylist()))
+            page_label_keys = data["page_label"].to_pylist()
+            if self.occurrences:
+                # The occurrences of all rows in one flat list, row i owns offsets[i]:offsets[i + 1]
+                occurrence_offsets = np.zeros(num_rows + 1, dtype=np.int64)
+                np.cumsum(data["occurrence_file_ids"].combine_chunks().value_lengths().to_numpy(), out=occurrence_offsets[1:])
+                flat = {c: data[c].combine_chunks().flatten().to_pylist() for c in OCCURRENCE_COLUMNS}
+                file_keys += list(zip(flat["occurrence_file_names"], flat["occurrence_file_ids"]))
+                page_label_keys += flat["occurrence_page_labels"]
+            files, file_codes = _dictionary_encode(file_keys)
+            page_labels, page_label_codes = _dictionary_encode(page_label_keys)
+            np.save(os.path.join(tmp_path, "file_codes.npy"), file_codes[:num_rows])
+            np.save(os.path.join(tmp_path, "page_label_codes.npy"), page_label_codes[:num_rows])
+            np.save(os.path.join(tmp_path, "page_index.npy"), np.asarray(data["page_index"].to_pylist(), dtype=np.int32))
+            if self.occurrences:
+                np.save(os.path.join(tmp_path, "occurrence_offsets.npy"), occurrence_offsets)
+                np.save(os.path.join(tmp_path, "occurrence_file_codes.npy"), file_codes[num_rows:])
+                np.save(os.path.join(tmp_path, "occurrence_page_label_codes.npy"), page_label_codes[num_rows:])
+                np.save(
+                    os.path.join(tmp_path, "occurrence_page_index.npy"),
+                    np.asarray(flat["occurrence_page_indices"], dtype=np.int32)
+                )
+            with open(os.path.join(tmp_path, "dictionaries.json"), "w") as f:
+                json.dump({"files": files, "page_labels": page_labels}, f)
+            size = sum(os.path.getsize(os.path.join(tmp_path, name)) for name in os.listdir(tmp_path))
+            info = ExactSnapshotInfo(
+                table_name=table_name,
+                version=version,
+                num_rows=num_rows,
+                dimensions=vectors.shape[1],
+                vector_column=self.vector_column,
+                bytes=size
+            )
+            # Written last, a folder without it is incomplete
+            with open(os.path.join(tmp_path, "snapshot.json"), "w") as f:
+                f.write(info.model_dump_json())
+            os.rename(tmp_path, final_path)
+        except OSError:
+            # Another process renamed the same version into place first
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            if not os.path.exists(os.path.join(final_path, "snapshot.json")):
+                raise
+        SEMANTIC_DB_SNAPSHOT_SECONDS.observe(perf_counter() - start)
+        logger.info(f"Built exact search snapshot of {table_name} v{version} ({num_rows} rows) in {perf_counter() - start:.1f}s")
+        self._remove_older(table_dir, version)
+        return final_path
+
+    @staticmethod
+    def _remove_older(table_dir: str, version: int):
+        # Newer versions may have been built by another process in the meantime
+        for name in os.listdir(table_dir):
+            if name.startswith("v") and name[1:].isdigit() and int(name[1:]) < version:
+                shutil.rmtree(os.path.join(table_dir, name), ignore_errors=True)
+
+    def search(
+        self,
+        table_name: str,
+        query_vectors: List[List[float]],
+        N_results: int,
+        where: Optional[SearchFilter] = None
+    ) -> Tuple[ExactSnapshot, List[List[Tuple[int, float]]]]:
+        """
+        Searches the current snapshot of a table with several queries at once.
+
+        Args
+        - table_name (str): The name of the table in the semantic database.
+        - query_vectors (List[List[float]]): The vectorised queries, of the dimensions of the exported column.
+        - N_results (int): Results per query.
+        - where (Optional[SearchFilter]): Only rows meeting these conditions are searched.
+
+        Returns
+        - (Tuple[ExactSnapshot, List[List[Tuple[int, float]]]]): The snapshot searched, whose `row` gives the
+          result columns, and the rows and squared L2 distances of the results of each query, closest first.
+        """
+        snapshot = self.snapshot(table_name)
+        return snapshot, snapshot.search(np.asarray(query_vectors, dtype=np.float32), N_results, where)
+
+    def info(self, table_name: str) -> Optional[ExactSnapshotInfo]:
+        """The loaded snapshot of a table, None before its first search."""
+        snapshot = self._snapshots.get(table_name)
+        return snapshot.info if snapshot else None
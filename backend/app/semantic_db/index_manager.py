@@ -0,0 +1,309 @@
+import logging
+import math
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from time import time
+from typing import Dict, List, Optional
+from pydantic import BaseModel
+from .table_pool import TablePool
+
+logger = logging.getLogger(__name__)
+
+# Product quantisation trains 256 centroids per sub-vector, so it needs at least as many rows
+PQ_MIN_ROWS = 256
+
+class IndexStatus(BaseModel):
+    """
+    The state of the vector index of a table.
+
+    Attributes:
+        table_name (str): The name of the table
+        num_rows (int): Total number of rows in the table
+        index_name (Optional[str]): Name of the vector index, None when the table has no index
+        index_type (Optional[str]): Type of the vector index e.g. 'IVF_PQ'
+        num_indexed_rows (int): Rows covered by the index
+        num_unindexed_rows (int): Rows added since the last build, searched by a flat scan until the next build
+        building (bool): Whether a background vector index build is running for the table
+        fts_index_name (Optional[str]): Name of the full-text index on the text column, None when there is none
+        fts_unindexed_rows (int): Rows not yet in the full-text index
+        last_build_seconds (Optional[float]): Duration of the last build run by this manager
+        last_error (Optional[str]): Error message of the last failed build
+    """
+    table_name: str
+    num_rows: int
+    index_name: Optional[str] = None
+    index_type: Optional[str] = None
+    num_indexed_rows: int = 0
+    num_unindexed_rows: int = 0
+    building: bool = False
+    fts_index_name: Optional[str] = None
+    fts_unindexed_rows: int = 0
+    last_build_seconds: Optional[float] = None
+    last_error: Optional[str] = None
+
+class TableIndex(BaseModel):
+    """
+    An index of a table.
+
+    Attributes:
+        name (str): The name of the index
+        index_type (str): Type of the index e.g. 'IVF_PQ' or 'Inverted'
+        columns (List[str]): The indexed columns
+        num_indexed_rows (int): Rows covered by the index
+        num_unindexed_rows (int): Rows added since the index was built or optimised
+    """
+    name: str
+    index_type: str
+    columns: List[str]
+    num_indexed_rows: int = 0
+    num_unindexed_rows: int = 0
+
+def table_indices(table) -> List[TableIndex]:
+    """
+    Lists the indices of a LanceDB table with their row counts. LanceTable of lancedb 0.16 has no
+    list_indices or index_stats, they are read from the underlying Lance dataset.
+
+    Args
+    - table (LanceTable): The table.
+
+    Returns
+    - indices (List[TableIndex]): The indices of the table.
+    """
+    dataset = table.to_lance()
+    indices = []
+    for index in dataset.list_indices():
+        stats = dataset.stats.index_stats(index["name"])
+        indices.append(TableIndex(
+            name=index["name"],
+            index_type=str(index["type"]),
+            columns=list(index["fields"]),
+            num_indexed_rows=stats.get("num_indexed_rows", 0),
+            num_unindexed_rows=stats.get("num_unindexed_rows", 0)
+        ))
+    return indices
+
+class IndexManager:
+    """
+    Builds and rebuilds the ANN vector index, and optionally the full-text (BM25) index, of semantic db tables.
+
+    A table gets no index until it holds `min_rows` rows, below that a brute force scan is fast enough.
+    PQ index types also need PQ_MIN_ROWS rows to train on, whatever `min_rows` is set to.
+    Rows added after a build are not in the index but LanceDB still searches them with a flat scan,
+    so they stay searchable until a rebuild, which is triggered once they exceed `rebuild_fraction` of the indexed rows.
+    With `fts` enabled the full-text index is built in the background once the table has rows. Rows added after
+    a build are found by a flat search too, so it is only rebuilt once they exceed `rebuild_fraction` of the indexed rows.
+
+    Args
+    - table_pool (TablePool): The pool used to open tables.
+    - vector_column (str): Name of the vector column to index.
+    - index_type (str): 'IVF_PQ' or 'IVF_HNSW_SQ'.
+    - metric (str): Distance metric of the index, 'L2' matches the default distance of the semantic search.
+    - min_rows (int): Minimum number of rows before an index is built.
+    - rebuild_fraction (float): Fraction of unindexed to indexed rows that triggers a rebuild, of either index.
+    - text_column (str): Name of the text column for the full-text index.
+    - fts (bool): Keep a full-text index on the text column up to date.
+    """
+    def __init__(
+        self,
+        table_pool: TablePool,
+        vector_column: str = "vector",
+        index_type: str = "IVF_PQ",
+        metric: str = "L2",
+        min_rows: int = 50_000,
+        rebuild_fraction: float = 0.2,
+        text_column: str = "text",
+        fts: bool = False
+    ):
+        self.table_pool = table_pool
+        self.vector_column = vector_column
+        self.index_type = index_type
+        self.metric = metric
+        self.min_rows = min_rows
+        self.rebuild_fraction = rebuild_fraction
+        self.text_column = text_column
+        self.fts = fts
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="index-build")
+        self._lock = threading.Lock()
+        self._building: Dict[str, Future] = {}
+        self._last_build_seconds: Dict[str, float] = {}
+        self._last_error: Dict[str, str] = {}
+
+    def status(self, table_name: str) -> IndexStatus:
+        """
+        Reports the row counts covered and not covered by the vector index of a table.
+
+        Args
+        - table_name (str): The name of the table in the semantic database.
+
+        Returns
+        - status (IndexStatus): The index state of the table.
+        """
+        table = self.table_pool.get_table(table_name)
+        status = IndexStatus(
+            table_name=table_name,
+            num_rows=table.count_rows(),
+            building=table_name in self._building,
+            last_build_seconds=self._last_build_seconds.get(table_name),
+            last_error=self._last_error.get(table_name)
+        )
+        status.num_unindexed_rows = status.num_rows
+        status.fts_unindexed_rows = status.num_rows
+        for index in table_indices(table):
+            if self.vector_column in index.columns:
+                status.index_name = index.name
+                status.index_type = index.index_type
+                status.num_indexed_rows = index.num_indexed_rows
+                status.num_unindexed_rows = index.num_unindexed_rows
+            elif self.text_column in index.columns:
+                status.fts_index_name = index.name
+                status.fts_unindexed_rows = index.num_unindexed_rows
+        return status
+
+    def needs_build(self, status: IndexStatus) -> bool:
+        """Whether the index of a table is missing or stale enough to (re)build."""
+        if status.num_rows < self.min_rows:
+            return False
+        if self.index_type.endswith("PQ") and status.num_rows < PQ_MIN_ROWS:
+            return False
+        if status.index_name is None:
+            return True
+        return status.num_unindexed_rows > self.rebuild_fraction * max(status.num_indexed_rows, 1)
+
+    def needs_fts_build(self, status: IndexStatus) -> bool:
+        """Whether the full-text index of a table is missing or stale enough to (re)build."""
+        if not self.fts or not status.num_rows:
+            return False
+        if status.fts_index_name is None:
+            return True
+        return status.fts_unindexed_rows > self.rebuild_fraction * max(status.num_rows - status.fts_unindexed_rows, 1)
+
+    def build_index(self, table_name: str) -> IndexStatus:
+        """
+        Builds (or replaces) the vector index of a table and blocks until it is done.
+        The build runs on its own table handle so queries on the pooled handle keep running
+        against the previous version and pick up the index with their next version check.
+
+        Args
+        - table_name (str): The name of the table in the semantic database.
+
+        Returns
+        - status (IndexStatus): The index state after the build.
+
+        Raises
+        - ValueError: When a PQ index is requested for a table with fewer than PQ_MIN_ROWS rows.
+        """
+        table = self.table_pool.connection.open_table(table_name)
+        num_rows = table.count_rows()
+        if self.index_type.endswith("PQ") and num_rows < PQ_MIN_ROWS:
+            raise ValueError(
+                f"Cannot build an {self.index_type} index on {table_name}: it has {num_rows} rows, "
+                f"product quantisation needs at least {PQ_MIN_ROWS}. Use IVF_HNSW_SQ or add more documents."
+            )
+        dimension = table.schema.field(self.vector_column).type.list_size
+        params = dict(
+            metric=self.metric,
+            vector_column_name=self.vector_column,
+            replace=True,
+            index_type=self.index_type,
+            # Roughly sqrt(N) partitions keeps each probed partition small as the table grows
+            num_partitions=max(1, min(4096, int(math.sqrt(num_rows)))),
+        )
+        if self.index_type.endswith("PQ"):
+            params["num_sub_vectors"] = self._num_sub_vectors(dimension)
+        logger.info(f"Building {self.index_type} index on {table_name} ({num_rows} rows)")
+        start = time()
+        try:
+            table.create_index(**params)
+        except Exception as e:
+            self._last_error[table_name] = str(e)
+            raise
+        self._last_build_seconds[table_name] = time() - start
+        self._last_error.pop(table_name, None)
+        logger.info(f"Built index on {table_name} in {self._last_build_seconds[table_name]:.1f}s")
+        return self.status(table_name)
+
+    def build_index_in_background(self, table_name: str) -> Future:
+        """
+        Queues an index build on the background build thread. Only one build per table is queued at a time.
+
+        Args
+        - table_name (str): The name of the table in the semantic database.
+
+        Returns
+        - future (Future): Resolves to the IndexStatus after the build.
+        """
+        return self.submit(table_name, self.build_index, table_name)
+
+    def build_fts_index(self, table_name: str) -> IndexStatus:
+        """
+        Builds (or replaces) the full-text index on the text column of a table, on its own table handle.
+
+        Args
+        - table_name (str): The name of the table in the semantic database.
+
+        Returns
+        - status (IndexStatus): The index state after the build.
+        """
+        table = self.table_pool.connection.open_table(table_name)
+        logger.info(f"Building full-text index on {table_name}.{self.text_column}")
+        table.create_fts_index(self.text_column, replace=True, use_tantivy=False)
+        return self.status(table_name)
+
+    def submit(self, key: str, build, table_name: str) -> Future:
+        """
+        Queues work on a table on the background build thread, so it never runs at the same time as an index build.
+        Work with the same key is only queued once at a time, the queued future is returned instead.
+
+        Args
+        - key (str): Identifies the work, e.g. the table name for vector index builds.
+        - build (Callable[[str], Any]): Called with the table name.
+        - table_name (str): The name of the table in the semantic database.
+
+        Returns
+        - future (Future): Resolves to the result of the work.
+        """
+        with self._lock:
+            if key in self._building:
+                return self._building[key]
+            future = self._executor.submit(build, table_name)
+            self._building[key] = future
+        future.add_done_callback(lambda f: self._build_done(key, f))
+        return future
+
+    def _build_done(self, key: str, future: Future):
+        with self._lock:
+            self._building.pop(key, None)
+        if future.exception():
+            logger.error(f"Background work {key} failed: {future.exception()}")
+
+    def maybe_build_index(self, table_name: str) -> Optional[Future]:
+        """
+        Starts a background (re)build when the table passed the row threshold or has too many unindexed rows,
+        and (re)builds the full-text index when it is enabled and missing or too stale, see needs_fts_build.
+
+        Args
+        - table_name (str): The name of the table in the semantic database.
+
+        Returns
+        - future (Optional[Future]): The build that was queued, None when the index is up to date.
+        """
+        status = self.status(table_name)
+        future = None
+        if self.needs_fts_build(status):
+            future = self.submit(f"{table_name}#fts", self.build_fts_index, table_name)
+        if not status.building and self.needs_build(status):
+            future = self.build_index_in_background(table_name)
+        return future
+
+    def wait(self):
+        """Blocks until all queued background builds finished."""
+        for future in list(self._building.values()):
+            future.exception()
+
+    @staticmethod
+    def _num_sub_vectors(dimension: int) -> int:
+        # PQ needs sub vectors that divide the dimension, aim for 16 dimensions per sub vector
+        for num_sub_vectors in range(max(1, dimension // 16), 0, -1):
+            if dimension % num_sub_vectors == 0:
+                return num_sub_vectors
+        return 1
@@ -0,0 +1,318 @@
+import asyncio
+import hashlib
+import logging
+import multiprocessing
+import os
+import threading
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from time import time
+from typing import AsyncIterator, Iterator, List, Optional, Tuple
+from pydantic import BaseModel
+from .dedup import DedupStats
+from .ingest_pipeline import IngestFile, parse_pages
+from .manifest import content_file_id
+from .pdf_utils import TaggedChunk, pdf_page_count
+from .semantic_db import SemanticDb
+from .sharding import DEFAULT_COLLECTION
+
+logger = logging.getLogger(__name__)
+
+# Pages parsed per task of the parse processes, the chunks of at most two ranges are held at once
+PARSE_PAGES = 50
+
+class UploadTooLarge(Exception):
+    """Raised when an upload exceeds the maximum size."""
+
+class IngestJob(BaseModel):
+    """
+    A background ingestion or deletion of a document.
+
+    Attributes:
+        job_id (str): Id of the job
+        kind (str): 'ingest' or 'delete'
+        file_id (str): Id of the document
+        file_name (Optional[str]): Name of the uploaded document
+        collection (str): Collection the document is written to or deleted from
+        status (str): 'queued', 'parsing', 'embedding', 'deleting', 'done', 'skipped' or 'failed'
+        pages_total (int): Pages of the document
+        pages_parsed (int): Pages parsed so far
+        chunks_total (int): Chunks parsed so far, of the whole document once pages_parsed reaches pages_total
+        chunks_written (int): Chunks embedded and written so far
+        error (Optional[str]): Why the job failed
+        created_at (float): Unix time the job was queued
+        started_at (Optional[float]): Unix time a worker picked the job up
+        finished_at (Optional[float]): Unix time the job finished
+        dedup (Optional[DedupStats]): Near-duplicate counts of the document, None without deduplication
+    """
+    job_id: str
+    kind: str
+    file_id: str
+    file_name: Optional[str] = None
+    collection: str = DEFAULT_COLLECTION
+    status: str = "queued"
+    pages_total: int = 0
+    pages_parsed: int = 0
+    chunks_total: int = 0
+    chunks_written: int = 0
+    error: Optional[str] = None
+    created_at: float
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    dedup: Optional[DedupStats] = None
+
+    @property
+    def progress(self) -> float:
+        if self.status in ("done", "skipped"):
+            return 1.0
+        if not self.chunks_total:
+            return 0.0
+        # The chunks of the pages not parsed yet are estimated from the parsed ones
+        chunks_total = self.chunks_total * self.pages_total / max(self.pages_parsed, 1)
+        return min(1.0, self.chunks_written / max(chunks_total, self.chunks_total))
+
+async def save_upload(
+    chunks: AsyncIterator[bytes],
+    upload_dir: str,
+    max_bytes: int
+) -> Tuple[str, str]:
+    """
+    Writes an uploaded document to disk as it arrives, without holding the whole file in memory.
+    File writes run in a worker thread so they never block the event loop.
+
+    Args
+    - chunks (AsyncIterator[bytes]): The request body, e.g. `request.stream()`.
+    - upload_dir (str): Folder the upload is written to.
+    - max_bytes (int): Maximum size of the upload.
+
+    Returns
+    - (Tuple[str, str]): Path of the saved file and the sha256 hex digest of its content.
+
+    Raises
+    - UploadTooLarge: If the upload exceeds max_bytes, the partial file is removed.
+    """
+    os.makedirs(upload_dir, exist_ok=True)
+    path = os.path.join(upload_dir, f"{uuid.uuid4().hex}.pdf")
+    digest = hashlib.sha256()
+    size = 0
+    f = await asyncio.to_thread(open, path, "wb")
+    try:
+        async for chunk in chunks:
+            size += len(chunk)
+            if size > max_bytes:
+                raise UploadTooLarge(f"Upload exceeds {max_bytes} bytes")
+            digest.update(chunk)
+            await asyncio.to_thread(f.write, chunk)
+    except BaseException:
+        f.close()
+        os.remove(path)
+        raise
+    f.close()
+    return path, digest.hexdigest()
+
+def _lower_priority():
+    # Parse processes yield the CPU to the processes serving chat requests
+    try:
+        os.nice(10)
+    except (AttributeError, OSError):
+        pass
+
+class IngestJobQueue:
+    """
+    Runs document ingestion and deletion as background jobs so API requests return immediately.
+
+    Pdfs are parsed in a small pool of low priority processes, so parsing never holds the GIL of the
+    server process, and embedding and writing run in job threads that mostly wait on Ollama and LanceDB.
+    Jobs on the same queue run in submission order when `workers` is 1, so a delete queued after an
+    upload of the same file happens after it. Finished jobs are kept for status queries up to `max_jobs`.
+
+    Args
+    - semantic_db (SemanticDb): The semantic database to write to.
+    - embedding_model (str): Name of the embedding model, part of the file id of a document.
+    - workers (int): Jobs run at the same time.
+    - parse_workers (int): Processes parsing pdfs.
+    - collection (str): Collection of the jobs that do not name one.
+    - max_jobs (int): Jobs kept for status queries, the oldest finished jobs are dropped first.
+    """
+    def __init__(
+        self,
+        semantic_db: SemanticDb,
+        embedding_model: str,
+        workers: int = 1,
+        parse_workers: int = 1,
+        collection: str = DEFAULT_COLLECTION,
+        max_jobs: int = 1000
+    ):
+        self.semantic_db = semantic_db
+        self.embedding_model = embedding_model
+        self.parse_workers = parse_workers
+        self.collection = collection
+        self.max_jobs = max_jobs
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ingest-job")
+        self._parse_pool: Optional[ProcessPoolExecutor] = None
+        self._jobs: "OrderedDict[str, IngestJob]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get_parse_pool(self) -> ProcessPoolExecutor:
+        # Started on first use, with spawn since forking a threaded server is unsafe
+        with self._lock:
+            if self._parse_pool is None:
+                self._parse_pool = ProcessPoolExecutor(
+                    max_workers=self.parse_workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=_lower_priority
+                )
+            return self._parse_pool
+
+    def file_id(self, file_name: str, content_hash: str) -> str:
+        """The file id of a document, the same one process_pdf_directory.py gives it."""
+        storage = self.semantic_db.vector_storage.describe()
+        chunk_size = self.semantic_db.chunk_size
+        return content_file_id(
+            file_name,
+            content_hash,
+            "@".join(filter(None, [self.embedding_model, storage])),
+            f"{chunk_size}/{self.semantic_db.chunk_overlap}" if chunk_size else ""
+        )
+
+    def _add_job(self, job: IngestJob) -> IngestJob:
+        with self._lock:
+            self._jobs[job.job_id] = job
+            finished = [j.job_id for j in self._jobs.values() if j.finished_at is not None]
+            for job_id in finished[:max(0, len(self._jobs) - self.max_jobs)]:
+                del self._jobs[job_id]
+        return job.model_copy()
+
+    def _update(self, job_id: str, **fields):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                self._jobs[job_id] = job.model_copy(update=fields)
+
+    def submit_file(self, path: str, file_name: str, content_hash: str, collection: Optional[str] = None) -> IngestJob:
+        """
+        Queues the ingestion of a saved upload. The file is removed once the job finishes.
+
+        Args
+        - path (str): Path of the saved pdf.
+        - file_name (str): Name of the document for use in meta data.
+        - content_hash (str): sha256 hex digest of the file content.
+        - collection (Optional[str]): Collection the document is added to, the queue's collection if None.
+
+        Returns
+        - job (IngestJob): The queued job.
+        """
+        job = self._add_job(IngestJob(
+            job_id=uuid.uuid4().hex,
+            kind="ingest",
+            file_id=self.file_id(file_name, content_hash),
+            file_name=file_name,
+            collection=collection or self.collection,
+            created_at=time()
+        ))
+        self._executor.submit(self._run_ingest, job.job_id, path)
+        return job
+
+    def submit_delete(self, file_id: str, collection: Optional[str] = None) -> IngestJob:
+        """
+        Queues the deletion of the rows of a document.
+
+        Args
+        - file_id (str): Id of the document.
+        - collection (Optional[str]): Collection the document is deleted from, the queue's collection if None.
+
+        Returns
+        - job (IngestJob): The queued job.
+        """
+        job = self._add_job(IngestJob(
+            job_id=uuid.uuid4().hex,
+            kind="delete",
+            file_id=file_id,
+            collection=collection or self.collection,
+            created_at=time()
+        ))
+        self._executor.submit(self._run_delete, job.job_id)
+        return job
+
+    def get(self, job_id: str) -> Optional[IngestJob]:
+        """Returns a snapshot of a job, None if it is unknown."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return job.model_copy() if job else None
+
+    def list(self) -> List[IngestJob]:
+        """Returns snapshots of the known jobs, oldest first."""
+        with self._lock:
+            return [job.model_copy() for job in self._jobs.values()]
+
+    def _run_ingest(self, job_id: str, path: str):
+        job = self.get(job_id)
+        self._update(job_id, status="parsing", started_at=time())
+        try:
+            db, table_name = self.semantic_db.shard_for(job.collection, job.file_name)
+            table = db.table_pool.get_table(table_name, schema=db.EmbeddedChunk)
+            if table.count_rows(db.files_filter([job.file_id])):
+                self._update(job_id, status="skipped", finished_at=time())
+                return
+            file = IngestFile(path=path, file_name=job.file_name, file_id=job.file_id)
+            # Earlier versions of the document are replaced once the new one is written
+            replaced_file_ids = [file_id for file_id in db.file_ids_named(job.file_name, table_name) if file_id != job.file_id]
+            pages_total = self._get_parse_pool().submit(pdf_page_count, path).result()
+            self._update(job_id, status="embedding", pages_total=pages_total)
+            deduplicator = db.deduplicator(table_name, replaced_file_ids) if db.dedup is not None else None
+            chunks_written = db.add_chunks_to_semantic_db(
+                self._parsed_chunks(job_id, file, pages_total),
+                job.file_id,
+                table_name,
+                on_progress=lambda written: self._update(job_id, chunks_written=written),
+                deduplicator=deduplicator,
+                replaced_file_ids=replaced_file_ids
+            )
+            dedup = deduplicator.finish() if deduplicator is not None else None
+            self._update(job_id, status="done", finished_at=time(), dedup=dedup)
+            logger.info(
+                f"Ingested {job.file_name} ({chunks_written} chunks)"
+                + (f", replacing {len(replaced_file_ids)} earlier versions" if replaced_file_ids else "")
+            )
+        except Exception as e:
+            logger.error(f"Failed to ingest {job.file_name}: {e}")
+            self._update(job_id, status="failed", error=str(e), finished_at=time())
+        finally:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def _parsed_chunks(self, job_id: str, file: IngestFile, pages_total: int) -> Iterator[TaggedChunk]:
+        # Parses the document a range of pages at a time in the parse processes, the next range while the
+        # chunks of the current one are embedded, so memory is bounded by two ranges instead of the document
+        pool = self._get_parse_pool()
+        chunk_size, chunk_overlap = self.semantic_db.chunk_size, self.semantic_db.chunk_overlap
+        chunks_total = 0
+        if pages_total:
+            future = pool.submit(parse_pages, file, chunk_size, chunk_overlap, 0, PARSE_PAGES)
+        for start_page in range(0, pages_total, PARSE_PAGES):
+            text_chunks = future.result()
+            stop_page = start_page + PARSE_PAGES
+            if stop_page < pages_total:
+                future = pool.submit(parse_pages, file, chunk_size, chunk_overlap, stop_page, stop_page + PARSE_PAGES)
+            chunks_total += len(text_chunks)
+            self._update(job_id, pages_parsed=min(stop_page, pages_total), chunks_total=chunks_total)
+            yield from text_chunks
+
+    def _run_delete(self, job_id: str):
+        job = self.get(job_id)
+        self._update(job_id, status="deleting", started_at=time())
+        try:
+            self.semantic_db.delete_files_from_collection([job.file_id], job.collection)
+            self._update(job_id, status="done", finished_at=time())
+        except Exception as e:
+            logger.error(f"Failed to delete {job.file_id}: {e}")
+            self._update(job_id, status="failed", error=str(e), finished_at=time())
+
+    def shutdown(self):
+        """Stops accepting jobs, waits for running ones and stops the parse processes."""
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        if self._parse_pool is not None:
+            self._parse_pool.shutdown()
@@ -0,0 +1,307 @@
+import logging
+import multiprocessing
+import queue
+import threading
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from typing import Callable, Dict, List, Optional, Tuple
+from lancedb.pydantic import LanceModel
+from pydantic import BaseModel
+from ..metrics import INGEST_CHUNKS, INGEST_FILES, INGEST_PAGES
+from .dedup import ChunkDeduplicator, DedupPlan, DedupStats, Occurrence
+from .pdf_utils import TaggedChunk, iter_pdf_chunks
+from .semantic_db import SemanticDb
+
+logger = logging.getLogger(__name__)
+
+class IngestFile(BaseModel):
+    """
+    A file queued for ingestion.
+
+    Attributes:
+        path (str): Path of the file on disk
+        file_name (str): Name of the document for use in meta data
+        file_id (str): Id of the document for use in meta data
+        replaces_file_id (Optional[str]): Id of an earlier version of the document whose rows the new rows replace
+    """
+    path: str
+    file_name: str
+    file_id: str
+    replaces_file_id: Optional[str] = None
+
+class IngestResult(BaseModel):
+    """
+    The outcome of an ingestion run.
+
+    Attributes:
+        processed_files (List[str]): Names of the files written to the table
+        failed_files (List[str]): Names of the files that failed in any stage
+        chunks_written (int): Number of chunks written to the table
+        pages_parsed (int): Number of pdf pages with text parsed
+        dedup (Optional[DedupStats]): Near-duplicate counts of all tables written, None without deduplication
+    """
+    processed_files: List[str] = []
+    failed_files: List[str] = []
+    chunks_written: int = 0
+    pages_parsed: int = 0
+    dedup: Optional[DedupStats] = None
+
+def parse_file(file: IngestFile, chunk_size: Optional[int], chunk_overlap: int) -> List[TaggedChunk]:
+    """Reads and chunks one pdf. Runs in a worker process so it must stay a module level function."""
+    return list(iter_pdf_chunks(
+        file.path,
+        file_name=file.file_name,
+        file_id=file.file_id,
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap
+    ))
+
+def parse_pages(
+    file: IngestFile,
+    chunk_size: Optional[int],
+    chunk_overlap: int,
+    start_page: int,
+    stop_page: int
+) -> List[TaggedChunk]:
+    """Reads and chunks a range of pages of one pdf. Runs in a worker process so it must stay a module level function."""
+    return list(iter_pdf_chunks(
+        file.path,
+        file_name=file.file_name,
+        file_id=file.file_id,
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap,
+        start_page=start_page,
+        stop_page=stop_page
+    ))
+
+# Marks the end of the stream on a stage queue
+_DONE = None
+
+class IngestPipeline:
+    """
+    Staged ingestion of pdf files into a semantic db table.
+
+    Files are parsed in a process pool, handed over a bounded queue to embedding threads,
+    then a single writer thread batches the embedded chunks of many files into large table adds.
+    The bounded queues give backpressure, parsing pauses while the embedders are behind
+    and embedding pauses while the writer is behind.
+    If the semantic db deduplicates, parsed chunks are checked for near duplicates before they are
+    queued for embedding, so only the chunks without a stored copy are embedded.
+
+    Args
+    - semantic_db (SemanticDb): The semantic database to write to.
+    - parse_workers (int): Number of processes parsing pdfs.
+    - embed_workers (int): Number of threads calling the embedding function concurrently.
+    - queue_size (int): Maximum number of files waiting between two stages.
+    - write_batch_rows (int): Number of chunks collected before the writer adds them to the table.
+    - table_name (str): The name of the table in the semantic database, when no collection is given.
+    - collection (Optional[str]): Write to the shards of this collection instead, each file to the shard
+      of its file name, see SemanticDb.shard_for.
+    - on_batch_written (Optional[Callable]): Called by the writer with the files of each committed batch
+      and their chunk counts by file_id, e.g. to record them in a manifest.
+    """
+    def __init__(
+        self,
+        semantic_db: SemanticDb,
+        parse_workers: int = 4,
+        embed_workers: int = 2,
+        queue_size: int = 8,
+        write_batch_rows: int = 5000,
+        table_name="semantic-db-table",
+        collection: Optional[str] = None,
+        on_batch_written: Optional[Callable[[List[IngestFile], Dict[str, int]], None]] = None
+    ):
+        self.semantic_db = semantic_db
+        self.parse_workers = parse_workers
+        self.embed_workers = embed_workers
+        self.queue_size = queue_size
+        self.write_batch_rows = write_batch_rows
+        self.table_name = table_name
+        self.collection = collection
+        self.on_batch_written = on_batch_written
+        self._result = IngestResult()
+        self._result_lock = threading.Lock()
+        self._deduplicators: Dict[Tuple[str, str], ChunkDeduplicator] = {}
+        self._replaced_file_ids: List[str] = []
+
+    def run(self, files: List[IngestFile]) -> IngestResult:
+        """
+        Ingests files through the parse, embed and write stages and waits until all are written.
+
+        Args
+        - files (List[IngestFile]): The files to ingest.
+
+        Returns
+        - result (IngestResult): Processed and failed files of the run.
+        """
+        self._result = IngestResult()
+        self._deduplicators = {}
+        self._replaced_file_ids = [f.replaces_file_id for f in files if f.replaces_file_id]
+        embed_queue: queue.Queue = queue.Queue(maxsize=self.queue_size)
+        write_queue: queue.Queue = queue.Queue(maxsize=self.queue_size)
+
+        embedders = [
+            threading.Thread(target=self._embed_worker, args=(embed_queue, write_queue), name=f"embed-{i}")
+            for i in range(self.embed_workers)
+        ]
+        writer = threading.Thread(target=self._write_worker, args=(write_queue,), name="writer")
+        for t in embedders + [writer]:
+            t.start()
+
+        try:
+            self._parse_stage(files, embed_queue)
+        finally:
+            for _ in embedders:
+                embed_queue.put(_DONE)
+            for t in embedders:
+                t.join()
+            write_queue.put(_DONE)
+            writer.join()
+        if self._deduplicators:
+            self._result.dedup = DedupStats()
+            for deduplicator in self._deduplicators.values():
+                self._result.dedup = self._result.dedup.add(deduplicator.finish())
+        return self._result
+
+    def _shard(self, file_name: str) -> Tuple[SemanticDb, str]:
+        if self.collection is None:
+            return self.semantic_db, self.table_name
+        return self.semantic_db.shard_for(self.collection, file_name)
+
+    def _deduplicator(self, semantic_db: SemanticDb, table_name: str) -> ChunkDeduplicator:
+        # One per table for the whole run, so documents of the run are matched against each other
+        key = (semantic_db.semantic_db_path, table_name)
+        with self._result_lock:
+            if key not in self._deduplicators:
+                self._deduplicators[key] = semantic_db.deduplicator(table_name, self._replaced_file_ids)
+            return self._deduplicators[key]
+
+    def _parse_stage(self, files: List[IngestFile], embed_queue: queue.Queue):
+        pending: Dict[Future, IngestFile] = {}
+        remaining = list(reversed(files))
+        # Spawned, the embed and write threads are already running and forking a threaded process is unsafe
+        with ProcessPoolExecutor(max_workers=self.parse_workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+            while remaining or pending:
+                # Keep only a bounded number of parsed documents in flight
+                while remaining and len(pending) < self.parse_workers + self.queue_size:
+                    file = remaining.pop()
+                    future = pool.submit(
+                        parse_file,
+                        file,
+                        self.semantic_db.chunk_size,
+                        self.semantic_db.chunk_overlap
+                    )
+                    pending[future] = file
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    file = pending.pop(future)
+                    try:
+                        text_chunks = future.result()
+                    except Exception as e:
+                        self._fail([file], "parse", e)
+                        continue
+                    pages = len({c.page_index for c in text_chunks})
+                    INGEST_PAGES.inc(pages)
+                    with self._result_lock:
+                        self._result.pages_parsed += pages
+                    logger.info(f"Parsed: {file.file_name} ({pages} pages, {len(text_chunks)} chunks)")
+                    plan = DedupPlan(chunks=text_chunks)
+                    if self.semantic_db.dedup is not None:
+                        try:
+                            plan = self._deduplicator(*self._shard(file.file_name)).plan(text_chunks)
+                        except Exception as e:
+                            self._fail([file], "deduplicate", e)
+                            continue
+                    # Blocks while the embedders are behind
+                    embed_queue.put((file, plan))
+
+    def _embed_worker(self, embed_queue: queue.Queue, write_queue: queue.Queue):
+        while True:
+            item: Optional[Tuple[IngestFile, DedupPlan]] = embed_queue.get()
+            if item is _DONE:
+                return
+            file, plan = item
+            try:
+                embedded_chunks = self.semantic_db.embed_chunks(plan.chunks, plan.columns)
+            except Exception as e:
+                self._fail([file], "embed", e)
+                continue
+            # Blocks while the writer is behind
+            write_queue.put((file, embedded_chunks, plan.references))
+
+    def _write_worker(self, write_queue: queue.Queue):
+        batch_files: List[IngestFile] = []
+        batch_rows: List[LanceModel] = []
+        batch_references: List[Tuple[str, Occurrence]] = []
+        while True:
+            item: Optional[Tuple[IngestFile, List[LanceModel], List[Tuple[str, Occurrence]]]] = write_queue.get()
+            if item is not _DONE:
+                file, embedded_chunks, references = item
+                batch_files.append(file)
+                batch_rows.extend(embedded_chunks)
+                batch_references.extend(references)
+            if batch_files and (item is _DONE or len(batch_rows) >= self.write_batch_rows):
+                self._write_batch(batch_files, batch_rows, batch_references)
+                batch_files, batch_rows, batch_references = [], [], []
+            if item is _DONE:
+                return
+
+    def _write_batch(self, files: List[IngestFile], rows: List[LanceModel], references: List[Tuple[str, Occurrence]]):
+        if self.collection is None:
+            self._write_shard(self.semantic_db, self.table_name, files, rows, references)
+            return
+        # Files of a collection are spread over its shards by file name, one commit per shard
+        shards: Dict[Tuple[str, str], Tuple[SemanticDb, List[IngestFile], List[LanceModel], List[Tuple[str, Occurrence]]]] = {}
+        shard_of_file: Dict[str, Tuple[str, str]] = {}
+        for file in files:
+            db, table_name = self.semantic_db.shard_for(self.collection, file.file_name)
+            key = (db.semantic_db_path, table_name)
+            shards.setdefault(key, (db, [], [], []))[1].append(file)
+            shard_of_file[file.file_id] = key
+        for row in rows:
+            shards[shard_of_file[row.file_id]][2].append(row)
+        for reference in references:
+            shards[shard_of_file[reference[1].file_id]][3].append(reference)
+        for (_, table_name), (db, shard_files, shard_rows, shard_references) in shards.items():
+            self._write_shard(db, table_name, shard_files, shard_rows, shard_references)
+
+    def _write_shard(
+        self,
+        semantic_db: SemanticDb,
+        table_name: str,
+        files: List[IngestFile],
+        rows: List[LanceModel],
+        references: List[Tuple[str, Occurrence]]
+    ):
+        replaced_file_ids = [f.replaces_file_id for f in files if f.replaces_file_id]
+        try:
+            if semantic_db.dedup is not None:
+                # New rows, occurrences added to stored rows and deleted old versions in one commit
+                self._deduplicator(semantic_db, table_name).write(rows, references, replaced_file_ids)
+            elif replaced_file_ids:
+                # New rows are added and the old versions deleted in one commit
+                semantic_db.replace_files_in_semantic_db(rows, replaced_file_ids, table_name)
+            else:
+                semantic_db.add_embedded_chunks(rows, table_name)
+        except Exception as e:
+            self._fail(files, "write", e)
+            return
+        logger.info(f"Wrote {len(rows)} chunks from {len(files)} files" + (
+            f", {len(references)} more as occurrences of stored chunks" if references else ""
+        ))
+        if self.on_batch_written:
+            chunk_counts: Dict[str, int] = {}
+            for file_id in [row.file_id for row in rows] + [o.file_id for _, o in references]:
+                chunk_counts[file_id] = chunk_counts.get(file_id, 0) + 1
+            self.on_batch_written(files, chunk_counts)
+        with self._result_lock:
+            self._result.processed_files.extend(f.file_name for f in files)
+            self._result.chunks_written += len(rows) + len(references)
+        INGEST_CHUNKS.inc(len(rows) + len(references))
+        INGEST_FILES.inc(len(files), result="processed")
+
+    def _fail(self, files: List[IngestFile], stage: str, error: Exception):
+        for file in files:
+            logger.error(f"Failed to {stage} {file.file_name}: {str(error)}")
+        INGEST_FILES.inc(len(files), result="failed")
+        with self._result_lock:
+            self._result.failed_files.extend(f.file_name for f in files)
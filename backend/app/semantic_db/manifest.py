@@ -0,0 +1,177 @@
+import hashlib
+import json
+import os
+import threading
+from typing import Dict, List, Optional
+from pydantic import BaseModel
+from .ingest_pipeline import IngestFile
+
+class ManifestEntry(BaseModel):
+    """
+    What was ingested for one file.
+
+    Attributes:
+        file_name (str): Name of the file relative to the ingested directory
+        file_id (str): Id of the file's rows in the table
+        content_hash (str): sha256 of the file content
+        size (int): File size in bytes
+        mtime (float): File modification time
+        chunk_count (int): Number of chunks written for the file
+        embedding_model (str): Embedding model used for the chunks
+        chunking (str): Chunking settings used for the file, e.g. '1200/200' for size/overlap
+    """
+    file_name: str
+    file_id: str
+    content_hash: str
+    size: int
+    mtime: float
+    chunk_count: int = 0
+    embedding_model: str
+    chunking: str = ""
+
+class ManifestPlan(BaseModel):
+    """
+    The work needed to bring a table in line with a directory.
+
+    Attributes:
+        to_ingest (List[IngestFile]): New and changed files, changed files carry the file_id they replace
+        unchanged (List[str]): Names of files that can be skipped
+        deleted (List[ManifestEntry]): Entries of files that no longer exist
+    """
+    to_ingest: List[IngestFile] = []
+    unchanged: List[str] = []
+    deleted: List[ManifestEntry] = []
+
+def content_file_id(file_name: str, content_hash: str, embedding_model: str, chunking: str = "") -> str:
+    """Id of a version of a document, it changes with its content, the embedding model or the chunking."""
+    return hashlib.sha256(f"{file_name}:{content_hash}:{embedding_model}:{chunking}".encode()).hexdigest()[:20]
+
+def hash_file(file_path: str, block_size: int = 1 << 20) -> str:
+    """Returns the sha256 hex digest of a file, read in blocks."""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        while block := f.read(block_size):
+            digest.update(block)
+    return digest.hexdigest()
+
+class IngestManifest:
+    """
+    Records the content hash, size, mtime, chunk count and embedding model of every ingested file
+    in a json file next to the LanceDB table, so re-runs only touch what changed.
+    The file is written with local file operations, so a semantic db on object storage
+    (e.g. an s3:// path) needs a local manifest_dir.
+
+    Args
+    - semantic_db_path (str): Folder path of the semantic db.
+    - table_name (str): The name of the table in the semantic database.
+    - manifest_dir (Optional[str]): Local folder of the manifest file, the semantic db folder if None.
+
+    Raises
+    - ValueError: If the semantic db path is a remote URI and no manifest_dir is given.
+    """
+    def __init__(self, semantic_db_path: str, table_name="semantic-db-table", manifest_dir: Optional[str] = None):
+        if manifest_dir is None:
+            if "://" in semantic_db_path:
+                raise ValueError(
+                    f"The ingest manifest is a local file and cannot be stored next to the remote semantic db "
+                    f"{semantic_db_path}, give a local manifest folder (--manifest-dir)"
+                )
+            manifest_dir = semantic_db_path
+        self.path = os.path.join(manifest_dir, f"{table_name}.manifest.json")
+        self.entries: Dict[str, ManifestEntry] = {}
+        self._pending: Dict[str, ManifestEntry] = {}
+        self._lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        """Reads the manifest file, an absent file is an empty manifest."""
+        if not os.path.exists(self.path):
+            self.entries = {}
+            return
+        with open(self.path) as f:
+            data = json.load(f)
+        self.entries = {e["file_name"]: ManifestEntry(**e) for e in data["files"]}
+
+    def save(self):
+        """Writes the manifest atomically so an interrupted run never leaves a partial file."""
+        with self._lock:
+            data = {"files": [e.model_dump() for e in self.entries.values()]}
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, self.path)
+
+    def plan(self, pdf_dir_path: str, file_names: List[str], embedding_model: str, chunking: str = "") -> ManifestPlan:
+        """
+        Compares files on disk with the manifest. Files with the same size and mtime are skipped without
+        being read, otherwise the content hash decides whether a file changed.
+
+        Args
+        - pdf_dir_path (str): Directory containing the files.
+        - file_names (List[str]): Names of the files in the directory to ingest.
+        - embedding_model (str): The current embedding model, files embedded with another model are re-ingested.
+        - chunking (str): The current chunking settings, files chunked differently are re-ingested.
+
+        Returns
+        - plan (ManifestPlan): The files to ingest, skip and delete.
+        """
+        plan = ManifestPlan()
+        for file_name in file_names:
+            full_path = os.path.join(pdf_dir_path, file_name)
+            stat = os.stat(full_path)
+            entry = self.entries.get(file_name)
+            same_settings = entry is not None and entry.embedding_model == embedding_model and entry.chunking == chunking
+            if same_settings and entry.size == stat.st_size and entry.mtime == stat.st_mtime:
+                plan.unchanged.append(file_name)
+                continue
+            content_hash = hash_file(full_path)
+            if same_settings and entry.content_hash == content_hash:
+                # Touched but not modified
+                entry.mtime = stat.st_mtime
+                plan.unchanged.append(file_name)
+                continue
+            file_id = content_file_id(file_name, content_hash, embedding_model, chunking)
+            self._pending[file_id] = ManifestEntry(
+                file_name=file_name,
+                file_id=file_id,
+                content_hash=content_hash,
+                size=stat.st_size,
+                mtime=stat.st_mtime,
+                embedding_model=embedding_model,
+                chunking=chunking
+            )
+            plan.to_ingest.append(IngestFile(
+                path=full_path,
+                file_name=file_name,
+                file_id=file_id,
+                replaces_file_id=entry.file_id if entry else None
+            ))
+        present = set(file_names)
+        plan.deleted = [e for name, e in self.entries.items() if name not in present]
+        return plan
+
+    def record_written(self, files: List[IngestFile], chunk_counts: Dict[str, int]):
+        """
+        Moves files from the plan into the manifest once their rows are committed and saves it.
+        Used as the on_batch_written callback of the IngestPipeline.
+
+        Args
+        - files (List[IngestFile]): The files whose rows were written.
+        - chunk_counts (Dict[str, int]): Number of chunks written per file_id.
+        """
+        with self._lock:
+            for file in files:
+                entry = self._pending.pop(file.file_id, None)
+                if entry is None:
+                    continue
+                entry.chunk_count = chunk_counts.get(file.file_id, 0)
+                self.entries[entry.file_name] = entry
+        self.save()
+
+    def remove(self, file_names: List[str]):
+        """Drops entries of files whose rows were deleted and saves the manifest."""
+        with self._lock:
+            for file_name in file_names:
+                self.entries.pop(file_name, None)
+        self.save()
@@ -1,40 +1,83 @@
-from typing import List, Optional
+from typing import List, Optional, Union
 import ollama
+from ..http_client import get_http_client, ollama_host
+from ..metrics import EMBEDDING_SECONDS, EMBEDDING_TEXTS
+from .embedding_batches import AdaptiveBatcher, EmbeddingBatchPolicy, fit_dimensions
 
 class OllamaVecs:
-    def __init__(self, 
+    def __init__(self,
                 dimensions: Optional[int] = 768,
                 batch_size=1000,
-                embedding_model="nomic-embed-text"
+                embedding_model="nomic-embed-text",
+                keep_alive: Optional[Union[int, str]] = None,
+                batch_policy: Optional[EmbeddingBatchPolicy] = None
                 ):
         self.dimensions = dimensions
         self.batch_size = batch_size
         self.embedding_model = embedding_model
-        
+        # How long Ollama keeps the model loaded after a call, None for the Ollama default
+        self.keep_alive = keep_alive
+        # Requests packed by characters, sent concurrently and retried, batch_size caps the texts per request
+        self.batcher = AdaptiveBatcher(batch_policy or EmbeddingBatchPolicy(max_texts=batch_size), backend="ollama")
+
     def get_embeddings(
             self,
             text_chunks: List[str]
         ) -> List[List[float]]:
             """
             Generate embeddings for a list of text strings using a specified model in batches.
+            The batches are sent concurrently, see AdaptiveBatcher. Vectors longer than dimensions are
+            truncated and renormalised, nomic-embed-text is a matryoshka model.
 
             Args:
                 text_chunks (List[str]): A list of strings for which embeddings are to be generated.
-                dimensions (Optional[int]): Integer for dimensions of embeddings. Trade off computationally efficiency for performance.
-                batch_size (int): Size of batches for controlling parallel queries to Ollama
-                embedding_model (str): Ollama model id for embeddings
             Returns:
                 embeddings (List[List[float]]): A list of embeddings corresponding to each string in 'text_array'.
             """
+            return fit_dimensions(self.batcher.embed(self._embed_batch, text_chunks), self.dimensions)
+
+    def _embed_batch(self, batch: List[str]) -> List[List[float]]:
+        with EMBEDDING_SECONDS.time(backend="ollama"):
+            response = ollama.embed(
+                 model=self.embedding_model,
+                 input=batch,
+                 keep_alive=self.keep_alive
+            )
+        EMBEDDING_TEXTS.inc(len(response["embeddings"]), backend="ollama")
+        return response["embeddings"]
 
-            embeddings = []
-            for batch_start in range(0, len(text_chunks), self.batch_size):
-                response = ollama.embed(
-                     model=self.embedding_model,
-                     input=text_chunks[batch_start: batch_start + self.batch_size]
-                )
-                embeddings.extend(response["embeddings"])   
-            return embeddings
-    
     def get_embedding(self, text: str) -> List[float]:
-        return self.get_embeddings([text])[0]
\ No newline at end of file
+        return self.get_embeddings([text])[0]
+
+    async def aget_embeddings(
+            self,
+            text_chunks: List[str]
+        ) -> List[List[float]]:
+            """
+            Async version of get_embeddings that calls the Ollama embed API over the shared pooled HTTP client.
+
+            Args:
+                text_chunks (List[str]): A list of strings for which embeddings are to be generated.
+            Returns:
+                embeddings (List[List[float]]): A list of embeddings corresponding to each string in 'text_array'.
+            """
+            return fit_dimensions(await self.batcher.aembed(self._aembed_batch, text_chunks), self.dimensions)
+
+    async def _aembed_batch(self, batch: List[str]) -> List[List[float]]:
+        client = get_http_client()
+        with EMBEDDING_SECONDS.time(backend="ollama"):
+            response = await client.post(
+                f"{ollama_host()}/api/embed",
+                json={
+                    "model": self.embedding_model,
+                    "input": batch,
+                    **({"keep_alive": self.keep_alive} if self.keep_alive is not None else {})
+                }
+            )
+            response.raise_for_status()
+        batch_embeddings = response.json()["embeddings"]
+        EMBEDDING_TEXTS.inc(len(batch_embeddings), backend="ollama")
+        return batch_embeddings
+
+    async def aget_embedding(self, text: str) -> List[float]:
+        return (await self.aget_embeddings([text]))[0]
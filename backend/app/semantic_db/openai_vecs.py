@@ -1,43 +1,77 @@
 from typing import Dict, List, Optional
-from openai import OpenAI
+from openai import AsyncOpenAI, OpenAI
+from ..metrics import EMBEDDING_SECONDS, EMBEDDING_TEXTS
+from .embedding_batches import AdaptiveBatcher, EmbeddingBatchPolicy, fit_dimensions
 
 class OpenAIVecs:
-    def __init__(self, 
+    def __init__(self,
                 api_key: str,
                 dimensions: Optional[int] = 1536,
                 batch_size=1000,
-                embedding_model="text-embedding-3-small" 
+                embedding_model="text-embedding-3-small",
+                batch_policy: Optional[EmbeddingBatchPolicy] = None
                 ):
         self.api_key = api_key
-        self.openai_client = OpenAI(api_key=self.api_key)
+        # Retries are done by the batcher, which splits failing batches
+        self.openai_client = OpenAI(api_key=self.api_key, max_retries=0)
+        # The async client keeps its own pool of connections to the OpenAI API
+        self.async_openai_client = AsyncOpenAI(api_key=self.api_key, max_retries=0)
         self.dimensions = dimensions
         self.batch_size = batch_size
         self.embedding_model = embedding_model
-        
+        # Requests packed by characters, sent concurrently and retried, batch_size caps the texts per request
+        self.batcher = AdaptiveBatcher(batch_policy or EmbeddingBatchPolicy(max_texts=batch_size), backend="openai")
+
+    def _params(self, batch: List[str]) -> Dict:
+        params: Dict = {'model': self.embedding_model, 'input': batch}
+        if self.dimensions:
+            # text-embedding-3 models shorten their vectors server side
+            params['dimensions'] = self.dimensions
+        return params
+
     def get_embeddings(
             self,
             text_chunks: List[str]
         ) -> List[List[float]]:
             """
             Generate embeddings for a list of text strings using a specified model in batches.
+            The batches are sent concurrently, see AdaptiveBatcher.
 
             Args:
                 text_chunks (List[str]): A list of strings for which embeddings are to be generated.
-                dimensions (Optional[int]): Integer for dimensions of embeddings. Trade off computationally efficiency for performance.
-                batch_size (int): Size of batches for controlling parallel queries to OpenAI
-                embedding_model (str): OpenAI model id for embeddings
             Returns:
                 embeddings (List[List[float]]): A list of embeddings corresponding to each string in 'text_array'.
             """
-            params: Dict = {'model': self.embedding_model}
-            if self.dimensions:
-                params['dimensions'] = self.dimensions
-            embeddings = []
-            for batch_start in range(0, len(text_chunks), self.batch_size):
-                params['input'] = text_chunks[batch_start: batch_start + self.batch_size]
-                response = self.openai_client.embeddings.create(**params)
-                embeddings.extend([e.embedding for e in response.data])   
-            return embeddings
-    
+            return fit_dimensions(self.batcher.embed(self._embed_batch, text_chunks), self.dimensions)
+
+    def _embed_batch(self, batch: List[str]) -> List[List[float]]:
+        with EMBEDDING_SECONDS.time(backend="openai"):
+            response = self.openai_client.embeddings.create(**self._params(batch))
+        EMBEDDING_TEXTS.inc(len(batch), backend="openai")
+        return [e.embedding for e in response.data]
+
     def get_embedding(self, text: str) -> List[float]:
-        return self.get_embeddings([text])[0]
\ No newline at end of file
+        return self.get_embeddings([text])[0]
+
+    async def aget_embeddings(
+            self,
+            text_chunks: List[str]
+        ) -> List[List[float]]:
+            """
+            Async version of get_embeddings.
+
+            Args:
+                text_chunks (List[str]): A list of strings for which embeddings are to be generated.
+            Returns:
+                embeddings (List[List[float]]): A list of embeddings corresponding to each string in 'text_array'.
+            """
+            return fit_dimensions(await self.batcher.aembed(self._aembed_batch, text_chunks), self.dimensions)
+
+    async def _aembed_batch(self, batch: List[str]) -> List[List[float]]:
+        with EMBEDDING_SECONDS.time(backend="openai"):
+            response = await self.async_openai_client.embeddings.create(**self._params(batch))
+        EMBEDDING_TEXTS.inc(len(batch), backend="openai")
+        return [e.embedding for e in response.data]
+
+    async def aget_embedding(self, text: str) -> List[float]:
+        return (await self.aget_embeddings([text]))[0]
@@ -1,5 +1,6 @@
 import io
-from typing import List
+from itertools import islice
+from typing import Iterable, Iterator, List, Optional, Union
 import pymupdf
 from pydantic import BaseModel
 
@@ -10,51 +11,166 @@ class TaggedChunk(BaseModel):
     page_label: str
     page_index: int
 
+def check_chunking(chunk_size: Optional[int], chunk_overlap: int):
+    """
+    Raises ValueError unless 0 <= chunk_overlap < chunk_size // 2. Windows can end at whitespace half way
+    into chunk_size, so a larger overlap would move the next window forward by a few characters only and
+    repeat most of the text in every window.
+
+    Args
+    - chunk_size (Optional[int]): Maximum number of characters per window, None keeps whole pages and is not checked.
+    - chunk_overlap (int): Number of characters shared by consecutive windows.
+    """
+    if chunk_size is None:
+        return
+    if chunk_size <= 0:
+        raise ValueError(f"chunk_size must be positive, got {chunk_size}")
+    if not 0 <= chunk_overlap < chunk_size // 2:
+        raise ValueError(f"chunk_overlap must be at least 0 and below half of chunk_size ({chunk_size // 2}), got {chunk_overlap}")
+
+def split_text(text: str, chunk_size: int, chunk_overlap: int = 0) -> List[str]:
+    """
+    Splits text into sliding windows of at most chunk_size characters that overlap by about chunk_overlap characters.
+    Windows end at whitespace where possible so words are not cut in half.
+
+    Args
+    - text (str): The text to split.
+    - chunk_size (int): Maximum number of characters per window.
+    - chunk_overlap (int): Number of characters repeated at the start of the next window.
+
+    Returns
+    - windows (List[str]): The text windows in order.
+    """
+    check_chunking(chunk_size, chunk_overlap)
+    if len(text) <= chunk_size:
+        return [text]
+    windows = []
+    start = 0
+    while start < len(text):
+        end = min(start + chunk_size, len(text))
+        if end < len(text):
+            cut = max(text.rfind(" ", start + chunk_size // 2, end), text.rfind("\n", start + chunk_size // 2, end))
+            if cut > start:
+                end = cut
+        windows.append(text[start:end])
+        if end >= len(text):
+            break
+        start = max(end - chunk_overlap, start + 1)
+    return windows
+
+def iter_pdf_chunks(
+    doc: Union[str, bytes],
+    file_name: str,
+    file_id: str,
+    min_chunk_length=10,
+    chunk_size: Optional[int] = None,
+    chunk_overlap: int = 200,
+    start_page: int = 0,
+    stop_page: Optional[int] = None
+    ) -> Iterator[TaggedChunk]:
+    """
+    Yields the chunks of a pdf document in page order, tagged with meta data.
+    Opened from a path, MuPDF reads the file on demand instead of holding a copy of it, and each page
+    is extracted once and released before the next one, so memory does not grow with the document size.
+
+    Args
+    - doc (Union[str, bytes]): Path of the pdf file, or the pdf document in bytes.
+    - file_name (str): Name of document for use in meta data.
+    - file_id (str): Id of document for use in meta data.
+    - min_chunk_length (int): Drop any chunk that is smaller than this minimum length.
+    - chunk_size (Optional[int]): Split pages into sliding windows of at most this many characters. None keeps one chunk per page.
+    - chunk_overlap (int): Number of characters shared by consecutive windows of a page.
+    - start_page (int): Index of the first page to read, counted from 0.
+    - stop_page (Optional[int]): Index of the page to stop before, None reads to the end.
+
+    Yields
+    - text_chunk (TaggedChunk): A text chunk with attached page and file meta data.
+    """
+
+    # Check if the file type is PDF
+    file_type =  file_name.split(".")[-1]
+    if file_type.lower() != "pdf":
+        error_msg = "File type is not a pdf"
+        print(error_msg)
+        raise ValueError(error_msg)
+
+    pdf_document = pymupdf.open(doc) if isinstance(doc, str) else pymupdf.open(stream=doc)
+    try:
+        # Treat every page, or every window of a page, as a chunk
+        for i, p in enumerate(pdf_document.pages(start_page, stop_page), start=start_page):
+            page_text = p.get_text()
+            if len(page_text) <= min_chunk_length:
+                continue
+            page_label = p.get_label()
+            windows = split_text(page_text, chunk_size, chunk_overlap) if chunk_size else [page_text]
+            for w in windows:
+                if len(w) > min_chunk_length:
+                    yield TaggedChunk(
+                        text=w,
+                        file_name=file_name,
+                        file_id=file_id,
+                        page_label=page_label,
+                        page_index=i + 1
+                    )
+    finally:
+        pdf_document.close()
+
+def pdf_page_count(path: str) -> int:
+    """The number of pages of a pdf file."""
+    with pymupdf.open(path) as pdf_document:
+        return pdf_document.page_count
+
 def pdf_bytes_to_chunks(
     doc_as_bytes: bytes,
     file_name: str,
     file_id: str,
-    min_chunk_length=10
+    min_chunk_length=10,
+    chunk_size: Optional[int] = None,
+    chunk_overlap: int = 200
     ) -> List[TaggedChunk]:
     """
     Processes a bytes representation of a pdf document.
     Returns an array of chunks from its pages tagged with meta data.
+    Use iter_pdf_chunks with a file path for large documents.
 
     Args
     - doc_as_bytes (bytes): Representation of a pdf document in bytes.
     - file_name (str): Name of document for use in meta data.
     - min_chunk_length (int): Drop any chunk that is smaller than this minimum length.
+    - chunk_size (Optional[int]): Split pages into sliding windows of at most this many characters. None keeps one chunk per page.
+    - chunk_overlap (int): Number of characters shared by consecutive windows of a page.
 
     Returns
     - text_chunks (List[TaggedChunk]): An array of text chunks with attached page and file meta data
     """
+    return list(iter_pdf_chunks(
+        doc_as_bytes,
+        file_name=file_name,
+        file_id=file_id,
+        min_chunk_length=min_chunk_length,
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap
+    ))
 
-    # Check if the file type is PDF
-    file_type =  file_name.split(".")[-1]
-    if file_type.lower() != "pdf":
-        error_msg = "File type is not a pdf"
-        print(error_msg)
-        raise ValueError(error_msg)
-    
-    # Open the PDF document from bytes
-    pdf_document = pymupdf.open(stream = doc_as_bytes)
-    # Treat every page as a chunk
-    text_chunks = [
-        TaggedChunk(
-            text=p.get_text(), 
-            file_name=file_name,
-            file_id=file_id,
-            page_label=p.get_label(),
-            page_index=i + 1
-        ) 
-        for i, p in enumerate(pdf_document.pages()) if len(p.get_text()) > min_chunk_length
-    ]
-
-    return text_chunks
+def batched(items: Iterable, batch_size: int) -> Iterator[List]:
+    """
+    Groups an iterable into lists of at most batch_size items, consuming it lazily.
+
+    Args
+    - items (Iterable): The items, e.g. a chunk generator.
+    - batch_size (int): Maximum number of items per list.
+
+    Yields
+    - batch (List): The next items.
+    """
+    iterator = iter(items)
+    while batch := list(islice(iterator, batch_size)):
+        yield batch
 
 def get_pdf_bytes(file_path: str) -> bytes:
     """
     Opens a document using PyMuPDF and returns its bytes representation.
+    Prefer passing the path to iter_pdf_chunks, which avoids this in memory copy.
     
     Args:
         file_path (str): Path to the document file
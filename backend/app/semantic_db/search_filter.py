@@ -0,0 +1,54 @@
+from typing import List, Optional
+from pydantic import BaseModel
+
+def _quoted(values: List[str]) -> str:
+    return ", ".join("'" + value.replace("'", "''") + "'" for value in values)
+
+def sql_in(column: str, values: List[str]) -> str:
+    """SQL filter matching the rows whose column is any of the given strings."""
+    return f"{column} IN ({_quoted(values)})"
+
+def sql_has_any(column: str, values: List[str]) -> str:
+    """SQL filter matching the rows whose list column holds any of the given strings."""
+    return f"array_has_any({column}, [{_quoted(values)}])"
+
+class SearchFilter(BaseModel):
+    """
+    Metadata conditions a search result must meet, all given conditions apply.
+    They are pushed down into the search, so the top results are taken from the matching rows only.
+
+    Attributes:
+        file_ids (Optional[List[str]]): Only chunks of these documents
+        file_names (Optional[List[str]]): Only chunks of documents with these names
+        page_min (Optional[int]): Only chunks from this page index on
+        page_max (Optional[int]): Only chunks up to and including this page index
+    """
+    file_ids: Optional[List[str]] = None
+    file_names: Optional[List[str]] = None
+    page_min: Optional[int] = None
+    page_max: Optional[int] = None
+
+    def sql(self, occurrences: bool = False) -> Optional[str]:
+        """
+        The conditions as a LanceDB SQL filter, None if there are none.
+
+        Args
+        - occurrences (bool): Match documents on the occurrence columns of a deduplicated table, so a chunk
+          stored once matches every document it occurs in. Pages are matched on the stored copy.
+        """
+        conditions = []
+        if self.file_ids is not None:
+            if not self.file_ids:
+                conditions.append("false")
+            else:
+                conditions.append(sql_has_any("occurrence_file_ids", self.file_ids) if occurrences else sql_in("file_id", self.file_ids))
+        if self.file_names is not None:
+            if not self.file_names:
+                conditions.append("false")
+            else:
+                conditions.append(sql_has_any("occurrence_file_names", self.file_names) if occurrences else sql_in("file_name", self.file_names))
+        if self.page_min is not None:
+            conditions.append(f"page_index >= {int(self.page_min)}")
+        if self.page_max is not None:
+            conditions.append(f"page_index <= {int(self.page_max)}")
+        return " AND ".join(conditions) or None
@@ -1,28 +1,133 @@
-from typing import List, Callable
-import lancedb
+import logging
+import os
+import tempfile
+import threading
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Callable, Optional, Tuple, Union
+import pyarrow as pa
 from lancedb.pydantic import Vector, LanceModel
-from pydantic import BaseModel
-from .pdf_utils import pdf_bytes_to_chunks
+from pydantic import BaseModel, ConfigDict, Field, model_validator
+from ..metrics import SEMANTIC_DB_QUERY_SECONDS
+from .pdf_utils import TaggedChunk, batched, check_chunking, iter_pdf_chunks
+from .dedup import (
+    OCCURRENCE_COLUMNS, ChunkDeduplicator, DedupSettings, Occurrence, StoredSignatures,
+    merge_occurrences, occurrence_columns, row_occurrences, table_fingerprint
+)
+from .exact_search import ExactSearch
+from .index_manager import IndexManager, IndexStatus
+from .search_filter import SearchFilter, sql_has_any, sql_in
+from .sharding import CollectionSpec, load_collections, merge_by_distance, merge_by_score
+from .table_maintenance import MaintenanceReport, TableHealth, TableMaintainer
+from .table_pool import TablePool, TablePoolStats
+from .vector_storage import VectorRecallReport, VectorStorage, rerank_by_full_vectors
+
+logger = logging.getLogger(__name__)
 
 class RagSearchResult(BaseModel):
+    """
+    A chunk found by a search.
+
+    Attributes:
+        text (str): The chunk text
+        file_name (str): Name of the document
+        file_id (str): Id of the document
+        page_label (str): Label of the page
+        page_index (int): Index of the page
+        distance (Optional[float]): Vector distance to the query, read from the '_distance' column
+        score (Optional[float]): BM25 score of a full-text search, read from the '_score' column
+        occurrences (Optional[List[Occurrence]]): Every page the chunk occurs on in a deduplicated table
+    """
+    model_config = ConfigDict(populate_by_name=True)
+
     text: str
     file_name: str
     file_id: str
     page_label: str
     page_index: int
-    _distance: float
+    distance: Optional[float] = Field(default=None, alias="_distance")
+    score: Optional[float] = Field(default=None, alias="_score")
+    occurrences: Optional[List[Occurrence]] = None
 
-def create_embedded_chunk_type(dimension: int):
-    """Create an EmbeddedChunk class with a specific vector dimension"""
+    @model_validator(mode="before")
+    @classmethod
+    def _read_occurrences(cls, data):
+        # Deduplicated tables store the occurrences as parallel list columns
+        if isinstance(data, dict) and OCCURRENCE_COLUMNS[0] in data:
+            occurrences = row_occurrences(data)
+            data = {k: v for k, v in data.items() if k not in OCCURRENCE_COLUMNS}
+            data["occurrences"] = occurrences
+        return data
+
+# Columns returned by searches, the vector columns are only read when needed
+RESULT_COLUMNS = ["text", "file_name", "file_id", "page_label", "page_index"]
+
+def create_embedded_chunk_type(
+    dimension: int,
+    value_type: pa.DataType = pa.float32(),
+    full_dimension: Optional[int] = None,
+    dedup: bool = False
+):
+    """
+    Create an EmbeddedChunk class with a specific vector dimension and float type,
+    with a 'full_vector' column of full_dimension float32 values if given, and with
+    the chunk id, MinHash signature and occurrence columns of deduplicated tables if dedup.
+    """
     class EmbeddedChunk(LanceModel):
         text: str
-        vector: Vector(dimension) # type: ignore
+        vector: Vector(dimension, value_type=value_type) # type: ignore
         file_name: str
         file_id: str
         page_label: str
         page_index: int
-    
-    return EmbeddedChunk
+
+    chunk_type = EmbeddedChunk
+    if full_dimension is not None:
+        class EmbeddedChunkWithFullVector(EmbeddedChunk):
+            full_vector: Vector(full_dimension) # type: ignore
+        chunk_type = EmbeddedChunkWithFullVector
+
+    if dedup:
+        class DeduplicatedChunk(chunk_type):
+            chunk_id: str
+            minhash: List[int]
+            occurrence_file_names: List[str]
+            occurrence_file_ids: List[str]
+            occurrence_page_labels: List[str]
+            occurrence_page_indices: List[int]
+        chunk_type = DeduplicatedChunk
+
+    return chunk_type
+
+def file_ids_filter(file_ids: List[str]) -> str:
+    """SQL filter matching the rows of any of the given file ids."""
+    return sql_in("file_id", file_ids)
+
+def reciprocal_rank_fusion(
+    result_lists: List[List[RagSearchResult]],
+    N_results: int,
+    k: int = 60
+) -> List[RagSearchResult]:
+    """
+    Merges ranked result lists by summing 1 / (k + rank) for every list a chunk appears in.
+
+    Args
+    - result_lists (List[List[RagSearchResult]]): Ranked results, best first, e.g. from lexical and vector search.
+    - N_results (int): The number of merged results to return.
+    - k (int): Damping constant, larger values flatten the advantage of the top ranks.
+
+    Returns
+    - results (List[RagSearchResult]): The fused results, best first.
+    """
+    scores: Dict[Tuple[str, int, str], float] = {}
+    chunks: Dict[Tuple[str, int, str], RagSearchResult] = {}
+    for results in result_lists:
+        for rank, r in enumerate(results):
+            key = (r.file_id, r.page_index, r.text)
+            scores[key] = scores.get(key, 0.0) + 1.0 / (k + rank + 1)
+            chunks.setdefault(key, r)
+    ranked = sorted(scores, key=scores.get, reverse=True)
+    return [chunks[key] for key in ranked[:N_results]]
 
 class SemanticDb:
     """
@@ -32,49 +137,304 @@ class SemanticDb:
     - semantic_db_path (str): Folder path where the semantic db should be created. Examples:
         * A local folder path, e.g. 'test_semantic_db/'
         * An S3 folder path, e.g. 's3://my-bucket/my-folder/'
+    - table_refresh_interval (float): Minimum seconds between checks for a newer version of an open table.
+    - index_type (str): Type of the ANN vector index, 'IVF_PQ' or 'IVF_HNSW_SQ'.
+    - index_min_rows (int): Row count from which a table gets a vector index.
+    - auto_index (bool): Build or rebuild the vector index in the background after files are added.
+    - auto_maintenance (bool): Compact the table and clean up old versions in the background once it needs it, see TableMaintainer.
+    - chunk_size (Optional[int]): Split pages into overlapping windows of at most this many characters. None keeps one chunk per page.
+    - chunk_overlap (int): Number of characters shared by consecutive windows of a page, below half of chunk_size.
+    - fts_index (bool): Keep a full-text (BM25) index on the text column up to date for lexical and hybrid queries.
+    - query_workers (int): Threads used to run the searches of a hybrid query, a query batch or a collection concurrently.
+    - file_batch_rows (int): Chunks of a document embedded and written at a time by add_file_to_semantic_db.
+    - vector_storage (Optional[VectorStorage]): Truncation and precision of the stored search vectors, full float32 vectors if None.
+    - rerank_factor (int): With full vectors stored, rerank N_results * rerank_factor candidates of the compact search exactly.
+    - collections (Optional[Dict[str, CollectionSpec]]): Named collections and their shard tables, see load_collections.
+      Shards on another path are served by a SemanticDb with the same settings at that path.
+    - search_backend (str): 'lancedb' to search the tables, 'exact' for exact search over memory-mapped
+      snapshots of them, faster for tables up to a few hundred thousand rows, see ExactSearch.
+    - exact_snapshot_dir (Optional[str]): Local folder of the exact search snapshots, next to the tables by default.
+    - dedup (Optional[DedupSettings]): Store near-identical chunks once with the pages they occur on, see
+      ChunkDeduplicator. Like the vector storage it is fixed per table, None writes every chunk.
     """
     def __init__(
         self,
         embedding_function: Callable[[List[str]], List[List[float]]],
         vec_dimension: int,
-        semantic_db_path: str
+        semantic_db_path: str,
+        table_refresh_interval: float = 1.0,
+        index_type: str = "IVF_PQ",
+        index_min_rows: int = 50_000,
+        auto_index: bool = True,
+        auto_maintenance: bool = True,
+        chunk_size: Optional[int] = None,
+        chunk_overlap: int = 200,
+        fts_index: bool = False,
+        query_workers: int = 8,
+        file_batch_rows: int = 256,
+        vector_storage: Optional[VectorStorage] = None,
+        rerank_factor: int = 4,
+        collections: Optional[Dict[str, CollectionSpec]] = None,
+        search_backend: str = "lancedb",
+        exact_snapshot_dir: Optional[str] = None,
+        dedup: Optional[DedupSettings] = None
     ):
+        check_chunking(chunk_size, chunk_overlap)
         self.embedding_function = embedding_function
         self.vec_dimension = vec_dimension
         self.semantic_db_path = semantic_db_path
-        self.EmbeddedChunk = create_embedded_chunk_type(vec_dimension)
+        self.vector_storage = vector_storage or VectorStorage(full_dimensions=vec_dimension)
+        self.rerank_factor = rerank_factor
+        self.dedup = dedup
+        self.EmbeddedChunk = create_embedded_chunk_type(
+            self.vector_storage.search_dimensions,
+            value_type=self.vector_storage.value_type,
+            full_dimension=vec_dimension if self.vector_storage.keep_full_vectors else None,
+            dedup=dedup is not None
+        )
+        self.result_columns = RESULT_COLUMNS + (OCCURRENCE_COLUMNS if dedup is not None else [])
+        self.table_pool = TablePool(semantic_db_path, refresh_interval=table_refresh_interval)
+        self.index_manager = IndexManager(
+            self.table_pool,
+            index_type=index_type,
+            min_rows=index_min_rows,
+            fts=fts_index
+        )
+        self.auto_index = auto_index
+        self.maintainer = TableMaintainer(self.table_pool, self.index_manager)
+        self.auto_maintenance = auto_maintenance
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.query_executor = ThreadPoolExecutor(max_workers=query_workers, thread_name_prefix="semantic-query")
+        self.file_batch_rows = file_batch_rows
+        self.collections = collections or load_collections()
+        self.exact_search: Optional[ExactSearch] = None
+        if search_backend == "exact":
+            if exact_snapshot_dir is None:
+                # Snapshots are memory-mapped, so they need a local folder
+                local = "://" not in semantic_db_path
+                exact_snapshot_dir = os.path.join(semantic_db_path if local else tempfile.gettempdir(), ".exact-search")
+            self.exact_search = ExactSearch(
+                self.table_pool,
+                exact_snapshot_dir,
+                vector_column="full_vector" if self.vector_storage.keep_full_vectors else "vector",
+                occurrences=dedup is not None
+            )
+        elif search_backend != "lancedb":
+            raise ValueError(f"Unknown search backend: {search_backend}")
+        # Settings of the databases serving shards on other paths
+        self._settings = dict(
+            embedding_function=embedding_function,
+            vec_dimension=vec_dimension,
+            table_refresh_interval=table_refresh_interval,
+            index_type=index_type,
+            index_min_rows=index_min_rows,
+            auto_index=auto_index,
+            auto_maintenance=auto_maintenance,
+            chunk_size=chunk_size,
+            chunk_overlap=chunk_overlap,
+            fts_index=fts_index,
+            query_workers=2,
+            file_batch_rows=file_batch_rows,
+            vector_storage=vector_storage,
+            rerank_factor=rerank_factor,
+            collections=self.collections,
+            search_backend=search_backend,
+            exact_snapshot_dir=exact_snapshot_dir,
+            dedup=dedup
+        )
+        self._path_dbs: Dict[str, "SemanticDb"] = {}
+        self._path_dbs_lock = threading.Lock()
+        # Signatures of the deduplicated tables, kept across ingestion runs
+        self._stored_signatures: Dict[str, StoredSignatures] = {}
+        self._stored_signatures_lock = threading.Lock()
 
     def add_file_to_semantic_db(
         self,
-        doc_as_bytes: bytes,
+        doc_as_bytes: Union[bytes, str],
         file_name: str,
         file_id: str,
         table_name="semantic-db-table"
     ):
         """
         Embedds text_chunks using a vectoriser algorithm and writes it to a LanceDB table for semantic search.
+        Chunks are extracted page by page and embedded and written file_batch_rows at a time,
+        so peak memory does not depend on the size of the document. If a batch fails the rows
+        already written for the file are deleted again before the error is raised.
 
         Args
-        - doc_as_bytes (bytes): Representation of a pdf document in bytes.
+        - doc_as_bytes (Union[bytes, str]): Representation of a pdf document in bytes, or the path of the pdf file.
         - file_name (str): Name of document for use in meta data.
         - file_id (str): Id of document for use in meta data.
         - table_name (str): The name of the table in the semantic database.
         """
-        text_chunks = pdf_bytes_to_chunks(
-            doc_as_bytes=doc_as_bytes,
+        text_chunks = iter_pdf_chunks(
+            doc_as_bytes,
             file_name=file_name,
-            file_id=file_id
+            file_id=file_id,
+            chunk_size=self.chunk_size,
+            chunk_overlap=self.chunk_overlap
         )
+        self.add_chunks_to_semantic_db(text_chunks, file_id, table_name)
+
+    def add_chunks_to_semantic_db(
+        self,
+        text_chunks: Iterable[TaggedChunk],
+        file_id: str,
+        table_name="semantic-db-table",
+        on_progress: Optional[Callable[[int], None]] = None,
+        deduplicator: Optional[ChunkDeduplicator] = None,
+        replaced_file_ids: Optional[List[str]] = None
+    ) -> int:
+        """
+        Embeds and writes the chunks of one file file_batch_rows at a time.
+        If a batch fails the rows already written for the file are deleted again before the error is raised.
+        Earlier versions of the file are deleted in one commit once all its chunks are written, so readers
+        may see both versions in between but never neither.
+        In a deduplicated table only chunks without a near-identical stored copy are embedded and written,
+        the others are added to the occurrences of their copy.
+
+        Args
+        - text_chunks (Iterable[TaggedChunk]): The chunks of the file, e.g. a generator.
+        - file_id (str): Id of the document the chunks belong to.
+        - table_name (str): The name of the table in the semantic database.
+        - on_progress (Optional[Callable[[int], None]]): Called with the number of chunks written so far after each batch.
+        - deduplicator (Optional[ChunkDeduplicator]): Deduplicator of the table, e.g. to read its stats afterwards.
+          One is created for a deduplicated table if None.
+        - replaced_file_ids (Optional[List[str]]): Ids of earlier versions of the file, see file_ids_named.
+
+        Returns
+        - chunks_written (int): Number of chunks written, stored or added as occurrences.
+        """
+        if deduplicator is None and self.dedup is not None:
+            deduplicator = self.deduplicator(table_name, replaced_file_ids or ())
+        chunks_written = 0
+        try:
+            for batch in batched(text_chunks, self.file_batch_rows):
+                if deduplicator is None:
+                    (self.table_pool
+                        .get_table(table_name, schema=self.EmbeddedChunk)
+                        .add(self.embed_chunks(batch))
+                    )
+                else:
+                    plan = deduplicator.plan(batch)
+                    deduplicator.write(self.embed_chunks(plan.chunks, plan.columns), plan.references)
+                chunks_written += len(batch)
+                if on_progress:
+                    on_progress(chunks_written)
+        except Exception:
+            if chunks_written:
+                self.delete_file_from_semantic_db(file_id, table_name)
+            raise
+        if replaced_file_ids:
+            # Also runs the index and maintenance checks
+            self.delete_files_from_semantic_db(replaced_file_ids, table_name)
+        elif chunks_written:
+            self._after_write(table_name)
+        return chunks_written
+
+    def _after_write(self, table_name: str):
+        # Background index builds and maintenance, the checks themselves are cheap
+        if self.auto_index:
+            self.index_manager.maybe_build_index(table_name)
+        if self.auto_maintenance:
+            self.maintainer.maybe_maintain(table_name)
+
+    def embed_chunks(self, text_chunks: List[TaggedChunk], columns: Optional[List[dict]] = None) -> List[LanceModel]:
+        """
+        Embedds tagged text chunks with the embedding function, ready to be written to a table.
+
+        Args
+        - text_chunks (List[TaggedChunk]): Text chunks with page and file meta data.
+        - columns (Optional[List[dict]]): Further columns of each chunk, e.g. from a DedupPlan.
+
+        Returns
+        - embedded_chunks (List[EmbeddedChunk]): The chunks with their vectors.
+        """
+        if not text_chunks:
+            return []
         embeddings = self.embedding_function(text_chunks=[c.text for c in text_chunks])
-        embedded_chunks = [self.EmbeddedChunk(**c.model_dump(), vector=v) for c, v in zip(text_chunks, embeddings)]
-        (lancedb
-            .connect(self.semantic_db_path)
-            .create_table(
-                table_name, 
-                schema=self.EmbeddedChunk,
-                exist_ok=True)
+        search_vectors = self.vector_storage.stored_vectors(self.vector_storage.search_vectors(embeddings))
+        columns = columns or [{}] * len(text_chunks)
+        if self.vector_storage.keep_full_vectors:
+            return [
+                self.EmbeddedChunk(**c.model_dump(), **extra, vector=v, full_vector=f)
+                for c, extra, v, f in zip(text_chunks, columns, search_vectors, embeddings)
+            ]
+        return [
+            self.EmbeddedChunk(**c.model_dump(), **extra, vector=v)
+            for c, extra, v in zip(text_chunks, columns, search_vectors)
+        ]
+
+    def add_embedded_chunks(
+        self,
+        embedded_chunks: List[LanceModel],
+        table_name="semantic-db-table"
+    ):
+        """
+        Writes embedded chunks to a LanceDB table in a single add, creating the table if needed.
+
+        Args
+        - embedded_chunks (List[EmbeddedChunk]): The chunks with their vectors, possibly from many files.
+        - table_name (str): The name of the table in the semantic database.
+        """
+        if not embedded_chunks:
+            return
+        (self.table_pool
+            .get_table(table_name, schema=self.EmbeddedChunk)
             .add(embedded_chunks)
         )
+        self._after_write(table_name)
+
+    def replace_files_in_semantic_db(
+        self,
+        embedded_chunks: List[LanceModel],
+        replaced_file_ids: List[str],
+        table_name="semantic-db-table"
+    ):
+        """
+        Adds new chunks and deletes the rows of the files they replace in a single table commit,
+        so readers never see a file missing or duplicated.
+
+        Args
+        - embedded_chunks (List[EmbeddedChunk]): The new chunks with their vectors. Their file ids must be new to the table.
+        - replaced_file_ids (List[str]): Ids of the files whose rows are deleted.
+        - table_name (str): The name of the table in the semantic database.
+        """
+        table = self.table_pool.get_table(table_name, schema=self.EmbeddedChunk)
+        replaced_filter = file_ids_filter(replaced_file_ids)
+        if not embedded_chunks:
+            table.delete(replaced_filter)
+            self._after_write(table_name)
+            return
+        (table
+            .merge_insert("file_id")
+            .when_not_matched_insert_all()
+            .when_not_matched_by_source_delete(replaced_filter)
+            .execute(embedded_chunks)
+        )
+        self._after_write(table_name)
+
+    def delete_files_from_semantic_db(
+            self,
+            file_ids: List[str],
+            table_name="semantic-db-table"
+        ):
+        """
+        Delete the rows of several files from the semantic db in one commit.
+
+        Args
+        - file_ids (List[str]): Ids of the files to delete.
+        - table_name (str): The name of the table in the semantic database.
+        """
+        if not file_ids:
+            return
+        if self.dedup is not None:
+            # Chunks that also occur in other documents are kept
+            self.write_deduplicated_chunks([], [], file_ids, table_name)
+            return
+        self.table_pool.get_table(table_name).delete(file_ids_filter(file_ids))
+        self._after_write(table_name)
 
     def delete_file_from_semantic_db(
             self,
@@ -88,17 +448,189 @@ class SemanticDb:
         - file_name (str): The file name to be deleted from the semantic db (deletes all chunks from that file)
         - table_name (str): The name of the table in the semantic database.
         """
-        
-        (lancedb
-            .connect(self.semantic_db_path)
-            .open_table(table_name)
-            .delete(f'file_id = "{file_id}"')
+        self.delete_files_from_semantic_db([file_id], table_name)
+
+    def file_ids_named(self, file_name: str, table_name="semantic-db-table") -> List[str]:
+        """
+        The ids of the files of a table with the given name, e.g. the stored versions of a document before a new one is added.
+
+        Args
+        - file_name (str): Name of the document.
+        - table_name (str): The name of the table in the semantic database.
+
+        Returns
+        - file_ids (List[str]): The file ids, in no particular order.
+        """
+        table = self.table_pool.get_table(table_name, schema=self.EmbeddedChunk)
+        if self.dedup is None:
+            data = table.to_lance().to_table(columns=["file_id"], filter=sql_in("file_name", [file_name]))
+            return sorted(set(data["file_id"].to_pylist()))
+        # A document whose chunks are all shared is only named in the occurrences
+        data = table.to_lance().to_table(
+            columns=["occurrence_file_names", "occurrence_file_ids"],
+            filter=sql_has_any("occurrence_file_names", [file_name])
         )
+        file_ids = set()
+        for names, ids in zip(data["occurrence_file_names"].to_pylist(), data["occurrence_file_ids"].to_pylist()):
+            file_ids.update(file_id for name, file_id in zip(names, ids) if name == file_name)
+        return sorted(file_ids)
+
+    def files_filter(self, file_ids: List[str]) -> str:
+        """SQL filter matching the rows of files, in a deduplicated table also the chunks they share with others."""
+        if self.dedup is not None:
+            return sql_has_any("occurrence_file_ids", file_ids)
+        return file_ids_filter(file_ids)
+
+    def deduplicator(self, table_name="semantic-db-table", replaced_file_ids: Iterable[str] = ()) -> ChunkDeduplicator:
+        """
+        Starts the deduplication of an ingestion run into a table, see stored_signatures.
+
+        Args
+        - table_name (str): The name of the table in the semantic database.
+        - replaced_file_ids (Iterable[str]): Documents replaced in the run, their chunks are not matched against.
+
+        Returns
+        - deduplicator (ChunkDeduplicator): Plans and writes the chunks of the run.
+        """
+        return ChunkDeduplicator(self, table_name, replaced_file_ids)
+
+    def stored_signatures(self, table_name="semantic-db-table") -> StoredSignatures:
+        """
+        The signatures of the chunks of a deduplicated table, read from the table on first use and
+        again only when it was changed by other writers than this semantic db.
+
+        Args
+        - table_name (str): The name of the table in the semantic database.
+
+        Returns
+        - signatures (StoredSignatures): The up to date signatures.
+        """
+        with self._stored_signatures_lock:
+            stored = self._stored_signatures.setdefault(table_name, StoredSignatures(self.dedup))
+        with stored.lock:
+            stored.sync(self.table_pool.get_table(table_name, schema=self.EmbeddedChunk))
+        return stored
+
+    def add_occurrences(self, added: Dict[str, List[Occurrence]], table_name="semantic-db-table") -> List[LanceModel]:
+        """
+        Reads stored chunks of a deduplicated table with occurrences appended, ready to be written back.
+
+        Args
+        - added (Dict[str, List[Occurrence]]): Occurrences to add by chunk id.
+        - table_name (str): The name of the table in the semantic database.
+
+        Returns
+        - rows (List[EmbeddedChunk]): The updated chunks, without the ones no longer stored.
+        """
+        if not added:
+            return []
+        table = self.table_pool.get_table(table_name, schema=self.EmbeddedChunk)
+        rows = table.to_lance().to_table(filter=sql_in("chunk_id", list(added))).to_pylist()
+        return [
+            self.EmbeddedChunk(**{
+                **self._stored_row(row),
+                **occurrence_columns(merge_occurrences(row_occurrences(row), added[row["chunk_id"]]))
+            })
+            for row in rows
+        ]
+
+    def _stored_row(self, row: dict) -> dict:
+        # Rows read back with to_pylist hold python floats, which are not written to a float16 vector column
+        return {**row, "vector": self.vector_storage.stored_vectors([row["vector"]])[0]}
+
+    def _release_files(self, file_ids: List[str], table_name: str, rows: Dict[str, LanceModel]) -> Dict[str, LanceModel]:
+        # Removes the occurrences of deleted files from the chunks mentioning them. A chunk stored for
+        # one of the files moves to its first remaining occurrence, one left without any is not returned.
+        deleted = set(file_ids)
+        table = self.table_pool.get_table(table_name, schema=self.EmbeddedChunk)
+        released = dict(rows)
+        for row in table.to_lance().to_table(filter=self.files_filter(file_ids)).to_pylist():
+            if row["chunk_id"] in released:
+                row = released[row["chunk_id"]].model_dump()
+            else:
+                row = self._stored_row(row)
+            occurrences = [o for o in row_occurrences(row) if o.file_id not in deleted]
+            if not occurrences:
+                released.pop(row["chunk_id"], None)
+                continue
+            if row["file_id"] in deleted:
+                row.update(
+                    file_name=occurrences[0].file_name,
+                    file_id=occurrences[0].file_id,
+                    page_label=occurrences[0].page_label,
+                    page_index=occurrences[0].page_index
+                )
+            released[row["chunk_id"]] = self.EmbeddedChunk(**{**row, **occurrence_columns(occurrences)})
+        return released
+
+    def write_deduplicated_chunks(
+        self,
+        new_rows: List[LanceModel],
+        updated_rows: List[LanceModel],
+        replaced_file_ids: List[str],
+        table_name="semantic-db-table"
+    ):
+        """
+        Writes to a deduplicated table in one commit: adds new chunks, rewrites stored chunks whose
+        occurrences changed and deletes the chunks of replaced files. Chunks of the replaced files that
+        also occur in other documents are kept, stored for one of those.
+
+        Args
+        - new_rows (List[EmbeddedChunk]): Chunks to add.
+        - updated_rows (List[EmbeddedChunk]): Stored chunks with new occurrences, see add_occurrences.
+        - replaced_file_ids (List[str]): Ids of files whose chunks and occurrences are deleted.
+        - table_name (str): The name of the table in the semantic database.
+        """
+        stored = self._stored_signatures.get(table_name)
+        if stored is None:
+            self._write_deduplicated_chunks(new_rows, updated_rows, replaced_file_ids, table_name)
+            return
+        with stored.lock:
+            table = self.table_pool.get_table(table_name, schema=self.EmbeddedChunk)
+            fresh = stored.fingerprint is not None and table_fingerprint(table) == stored.fingerprint
+            self._write_deduplicated_chunks(new_rows, updated_rows, replaced_file_ids, table_name)
+            for row in new_rows:
+                stored.add(row.chunk_id, row.file_id, np.asarray(row.minhash, dtype=np.uint32))
+            # Replacing documents moves their shared chunks to other documents, they are reloaded before the next run
+            fresh = fresh and not replaced_file_ids
+            stored.fingerprint = table_fingerprint(table) if fresh else None
+
+    def _write_deduplicated_chunks(
+        self,
+        new_rows: List[LanceModel],
+        updated_rows: List[LanceModel],
+        replaced_file_ids: List[str],
+        table_name: str
+    ):
+        table = self.table_pool.get_table(table_name, schema=self.EmbeddedChunk)
+        updated = {row.chunk_id: row for row in updated_rows}
+        if replaced_file_ids:
+            updated = self._release_files(replaced_file_ids, table_name, updated)
+        rows = list(new_rows) + list(updated.values())
+        if not updated and not replaced_file_ids:
+            if not rows:
+                return
+            table.add(rows)
+        elif not rows:
+            table.delete(file_ids_filter(replaced_file_ids))
+        else:
+            merge = (table
+                .merge_insert("chunk_id")
+                .when_matched_update_all()
+                .when_not_matched_insert_all())
+            if replaced_file_ids:
+                merge = merge.when_not_matched_by_source_delete(file_ids_filter(replaced_file_ids))
+            merge.execute(rows)
+        self._after_write(table_name)
 
     def semantic_query(self, 
                            query_vector: List[float],
                            table_name="semantic-db-table",
-                           N_results = 4
+                           N_results = 4,
+                           nprobes: Optional[int] = None,
+                           refine_factor: Optional[int] = None,
+                           rerank_factor: Optional[int] = None,
+                           where: Optional[SearchFilter] = None
                            ):
         """
         Query the vector database using semantic search.
@@ -107,16 +639,495 @@ class SemanticDb:
         - query_vector (List[float]): The vectorised user query to query with.
         - table_name (str): The name of the table in the vector db to query.
         - N_results (int): The limit for the number of returned results.
+        - nprobes (Optional[int]): Number of index partitions to search. Higher is more accurate and slower.
+        - refine_factor (Optional[int]): Re-rank N_results * refine_factor index candidates with exact distances.
+        - rerank_factor (Optional[int]): Overrides the rerank_factor of the SemanticDb, 1 turns reranking off.
+        - where (Optional[SearchFilter]): Metadata conditions, applied before the nearest rows are taken.
 
         Return
         - search_results (List[RagSearchResult]): The semantic search results.
+
+        With compact vector storage the search runs on the truncated query vector, and if full vectors
+        are stored the top N_results * rerank_factor candidates are reranked with the full query vector.
+        With the exact search backend the snapshot of the table is searched instead, on the full vectors
+        if they are stored, and nprobes, refine_factor and rerank_factor do not apply.
+        """
+        if self.exact_search is not None:
+            return self.semantic_query_batch([query_vector], table_name, N_results, where)[0]
+        with SEMANTIC_DB_QUERY_SECONDS.time(kind="vector"):
+            rerank_factor = rerank_factor or self.rerank_factor
+            rerank = self.vector_storage.keep_full_vectors and rerank_factor > 1
+            search_vector = self.vector_storage.search_vectors([query_vector])[0]
+            results = (self.table_pool
+                    .get_table(table_name)
+                    .search(search_vector, vector_column_name="vector")
+                    .select(self.result_columns + (["full_vector"] if rerank else []))
+                    .limit(N_results * rerank_factor if rerank else N_results))
+            where_sql = where.sql(occurrences=self.dedup is not None) if where is not None else None
+            if where_sql:
+                results = results.where(where_sql, prefilter=True)
+            if nprobes:
+                results = results.nprobes(nprobes)
+            if refine_factor:
+                results = results.refine_factor(refine_factor)
+            rows = results.to_list()
+            if rerank:
+                rows = rerank_by_full_vectors(query_vector, rows, N_results)
+            return  [RagSearchResult(**r) for r in rows]
+
+    def semantic_query_batch(
+        self,
+        query_vectors: List[List[float]],
+        table_name="semantic-db-table",
+        N_results: int = 4,
+        where: Optional[SearchFilter] = None
+    ) -> List[List[RagSearchResult]]:
+        """
+        Runs several vector searches of a table. With the exact search backend the queries are scored together
+        with matrix products. The LanceDB backend searches one vector per query, its multi-vector search is only
+        a convenience that runs the queries one by one, so the searches run concurrently on the query threads.
+
+        Args
+        - query_vectors (List[List[float]]): The vectorised queries.
+        - table_name (str): The name of the table in the vector db to query.
+        - N_results (int): The limit for the number of results per query.
+        - where (Optional[SearchFilter]): Metadata conditions, applied before the nearest rows are taken.
+
+        Return
+        - search_results (List[List[RagSearchResult]]): The results of each query, closest first.
+        """
+        if self.exact_search is None:
+            return list(self.query_executor.map(
+                lambda query_vector: self.semantic_query(query_vector, table_name, N_results, where=where),
+                query_vectors
+            ))
+        with SEMANTIC_DB_QUERY_SECONDS.time(kind="exact"):
+            if self.exact_search.vector_column == "vector":
+                query_vectors = self.vector_storage.search_vectors(query_vectors)
+            snapshot, hits = self.exact_search.search(table_name, query_vectors, N_results, where)
+            # Only the top rows are decoded, without validation since the snapshot is typed already
+            return [
+                [RagSearchResult.model_construct(**snapshot.row(i), distance=distance) for i, distance in query_hits]
+                for query_hits in hits
+            ]
+
+    def lexical_query(self,
+                      query_text: str,
+                      table_name="semantic-db-table",
+                      N_results = 4,
+                      where: Optional[SearchFilter] = None
+                      ) -> List[RagSearchResult]:
+        """
+        Query the full-text (BM25) index of the text column, good for exact terms such as part numbers or clause ids.
+
+        Args
+        - query_text (str): The user query.
+        - table_name (str): The name of the table in the vector db to query.
+        - N_results (int): The limit for the number of returned results.
+        - where (Optional[SearchFilter]): Metadata conditions, applied before the best rows are taken.
+
+        Return
+        - search_results (List[RagSearchResult]): The lexical search results, best first.
+        """
+        with SEMANTIC_DB_QUERY_SECONDS.time(kind="lexical"):
+            results = (self.table_pool
+                    .get_table(table_name)
+                    .search(query_text, query_type="fts")
+                    .select(self.result_columns)
+                    .limit(N_results))
+            where_sql = where.sql(occurrences=self.dedup is not None) if where is not None else None
+            if where_sql:
+                results = results.where(where_sql, prefilter=True)
+            return [RagSearchResult(**r) for r in results.to_list()]
+
+    def hybrid_query(self,
+                     query_text: str,
+                     query_vector: List[float],
+                     table_name="semantic-db-table",
+                     N_results = 4,
+                     candidates: Optional[int] = None,
+                     rrf_k: int = 60,
+                     where: Optional[SearchFilter] = None
+                     ) -> List[RagSearchResult]:
+        """
+        Runs the lexical and the vector search concurrently and merges them with reciprocal rank fusion.
+        Falls back to the vector results if the table has no full-text index yet.
+
+        Args
+        - query_text (str): The user query for the lexical search.
+        - query_vector (List[float]): The vectorised user query for the semantic search.
+        - table_name (str): The name of the table in the vector db to query.
+        - N_results (int): The number of fused results to return.
+        - candidates (Optional[int]): Results fetched from each search before fusion, defaults to 2 * N_results.
+        - rrf_k (int): Damping constant of the reciprocal rank fusion.
+        - where (Optional[SearchFilter]): Metadata conditions of both searches.
+
+        Return
+        - search_results (List[RagSearchResult]): The fused search results, best first.
+        """
+        candidates = candidates or 2 * N_results
+        with SEMANTIC_DB_QUERY_SECONDS.time(kind="hybrid"):
+            lexical = self.query_executor.submit(self.lexical_query, query_text, table_name, candidates, where)
+            semantic = self.query_executor.submit(self.semantic_query, query_vector, table_name, candidates, where=where)
+            semantic_results = semantic.result()
+            try:
+                lexical_results = lexical.result()
+            except Exception as e:
+                logger.warning(f"Lexical search failed, using vector results only: {e}")
+                return semantic_results[:N_results]
+            return reciprocal_rank_fusion([lexical_results, semantic_results], N_results, k=rrf_k)
+
+    def vector_recall(
+        self,
+        table_name="semantic-db-table",
+        N_results: int = 10,
+        sample_size: int = 100,
+        seed: int = 0
+    ) -> VectorRecallReport:
+        """
+        Measures the recall of the compact vector search, with and without reranking, against an exact
+        search over the full precision vectors. Stored chunks are used as queries, each excluding itself.
+        Needs a table written with keep_full_vectors, and loads its full vectors into memory.
+
+        Args
+        - table_name (str): The name of the table in the vector db.
+        - N_results (int): Results compared per query.
+        - sample_size (int): Number of chunks sampled as queries.
+        - seed (int): Seed of the sampling.
+
+        Return
+        - report (VectorRecallReport): The recall and the storage size of the search vectors.
+        """
+        if not self.vector_storage.keep_full_vectors:
+            raise ValueError("Measuring recall needs the full vectors, store them with keep_full_vectors")
+        table = self.table_pool.get_table(table_name)
+        data = (table
+            .search(vector_column_name="vector")
+            .select(["text", "file_id", "page_index", "full_vector"])
+            .limit(table.count_rows())
+            .to_arrow())
+        full_vectors = (data["full_vector"]
+            .combine_chunks()
+            .flatten()
+            .to_numpy()
+            .reshape(len(data), self.vec_dimension)
+            .astype(np.float32))
+        keys = list(zip(data["file_id"].to_pylist(), data["page_index"].to_pylist(), data["text"].to_pylist()))
+
+        rng = np.random.default_rng(seed)
+        sample = rng.choice(len(data), size=min(sample_size, len(data)), replace=False)
+        found_first_stage = found_reranked = 0
+        for i in sample:
+            distances = np.sum((full_vectors - full_vectors[i]) ** 2, axis=1)
+            distances[i] = np.inf
+            exact = {keys[j] for j in np.argsort(distances, kind="stable")[:N_results]}
+            for rerank_factor in (1, self.rerank_factor):
+                results = self.semantic_query(
+                    full_vectors[i].tolist(), table_name, N_results=N_results + 1, rerank_factor=rerank_factor
+                )
+                found = {(r.file_id, r.page_index, r.text) for r in results} - {keys[i]}
+                hits = len(exact & found)
+                if rerank_factor == 1:
+                    found_first_stage += hits
+                else:
+                    found_reranked += hits
+        total = max(1, len(sample) * N_results)
+        return VectorRecallReport(
+            storage=self.vector_storage.describe() or "full",
+            N_results=N_results,
+            queries=len(sample),
+            recall_first_stage=found_first_stage / total,
+            recall_reranked=found_reranked / total if self.rerank_factor > 1 else found_first_stage / total,
+            search_bytes_per_vector=self.vector_storage.search_bytes_per_vector,
+            compression_ratio=self.vector_storage.compression_ratio
+        )
+
+    def collection(self, name: str) -> CollectionSpec:
+        """
+        Returns a collection by name.
+
+        Raises
+        - ValueError: If there is no collection of that name.
+        """
+        try:
+            return self.collections[name]
+        except KeyError:
+            raise ValueError(f"Unknown collection: {name}")
+
+    def db_at(self, path: Optional[str]) -> "SemanticDb":
+        """
+        Returns the semantic db serving the tables at a path, with the settings of this one.
+        Each path gets its own table pool, index manager and maintainer, created on first use.
+
+        Args
+        - path (Optional[str]): Folder of a LanceDB database, this database if None.
+
+        Returns
+        - semantic_db (SemanticDb): The semantic db at the path.
+        """
+        if path is None or path == self.semantic_db_path:
+            return self
+        with self._path_dbs_lock:
+            db = self._path_dbs.get(path)
+            if db is None:
+                db = SemanticDb(semantic_db_path=path, **self._settings)
+                self._path_dbs[path] = db
+            return db
+
+    def databases(self) -> List["SemanticDb"]:
+        """This semantic db and the ones opened for shards on other paths."""
+        with self._path_dbs_lock:
+            return [self, *self._path_dbs.values()]
+
+    def shards(self, collections: List[str]) -> List[Tuple["SemanticDb", str]]:
+        """
+        The shard tables of collections with the semantic db serving each of them.
+
+        Args
+        - collections (List[str]): Names of the collections.
+
+        Returns
+        - shards (List[Tuple[SemanticDb, str]]): Semantic db and table name of every shard.
+        """
+        return [
+            (self.db_at(shard.path), shard.table_name)
+            for name in collections
+            for shard in self.collection(name).shards
+        ]
+
+    def shard_for(self, collection: str, file_name: str) -> Tuple["SemanticDb", str]:
+        """
+        The shard table a document of a collection is written to, see CollectionSpec.shard_index.
+
+        Args
+        - collection (str): The name of the collection.
+        - file_name (str): Name of the document.
+
+        Returns
+        - shard (Tuple[SemanticDb, str]): Semantic db and table name of the shard.
+        """
+        spec = self.collection(collection)
+        shard = spec.shards[spec.shard_index(file_name)]
+        return self.db_at(shard.path), shard.table_name
+
+    def delete_files_from_collection(self, file_ids: List[str], collection: str):
+        """
+        Deletes the rows of files from every shard of a collection, in one commit per shard that holds any.
+        Shards no document was written to yet are skipped, not created.
+
+        Args
+        - file_ids (List[str]): Ids of the files to delete.
+        - collection (str): The name of the collection.
+        """
+        for db, table_name in self.shards([collection]):
+            try:
+                table = db.table_pool.get_table(table_name)
+            except FileNotFoundError:
+                continue
+            if table.count_rows(db.files_filter(file_ids)):
+                db.delete_files_from_semantic_db(file_ids, table_name)
+
+    def collection_version(self, collections: List[str]) -> int:
+        """
+        The sum of the versions of the shard tables of collections, it grows with every write to any of them.
+        Shards no document was written to yet count as version 0, they are not created by reading their version.
+
+        Args
+        - collections (List[str]): Names of the collections.
+
+        Returns
+        - version (int): The combined version.
+        """
+        version = 0
+        for db, table_name in self.shards(collections):
+            try:
+                version += db.table_pool.get_table(table_name).version
+            except FileNotFoundError:
+                pass
+        return version
+
+    def collection_query(
+        self,
+        query_text: str,
+        query_vector: List[float],
+        collections: List[str],
+        N_results: int = 4,
+        retrieval_mode: str = "vector",
+        candidates: Optional[int] = None,
+        rrf_k: int = 60,
+        where: Optional[SearchFilter] = None
+    ) -> List[RagSearchResult]:
+        """
+        Searches every shard of the selected collections concurrently and merges their results,
+        vector results by distance and full-text results by score, then both with reciprocal rank
+        fusion in hybrid mode. Shards without a full-text index only contribute vector results.
+
+        Args
+        - query_text (str): The user query for the lexical search.
+        - query_vector (List[float]): The vectorised user query for the semantic search.
+        - collections (List[str]): Names of the collections to search.
+        - N_results (int): The number of results to return.
+        - retrieval_mode (str): 'vector' for dense search, 'hybrid' for full-text and dense search with rank fusion.
+        - candidates (Optional[int]): Results fetched from each search before fusion, defaults to 2 * N_results.
+        - rrf_k (int): Damping constant of the reciprocal rank fusion.
+        - where (Optional[SearchFilter]): Metadata conditions of the searches of every shard.
+
+        Return
+        - search_results (List[RagSearchResult]): The merged search results, best first.
+        """
+        shards = self.shards(collections)
+        hybrid = retrieval_mode == "hybrid"
+        if len(shards) == 1:
+            db, table_name = shards[0]
+            if hybrid:
+                return db.hybrid_query(query_text, query_vector, table_name, N_results, candidates, rrf_k, where)
+            return db.semantic_query(query_vector, table_name, N_results, where=where)
+
+        with SEMANTIC_DB_QUERY_SECONDS.time(kind="fan_out"):
+            limit = (candidates or 2 * N_results) if hybrid else N_results
+            semantic = [
+                self.query_executor.submit(db.semantic_query, query_vector, table_name, limit, where=where)
+                for db, table_name in shards
+            ]
+            lexical = [
+                self.query_executor.submit(db.lexical_query, query_text, table_name, limit, where)
+                for db, table_name in shards
+            ] if hybrid else []
+            semantic_results = merge_by_distance([f.result() for f in semantic], limit)
+            if not hybrid:
+                return semantic_results
+            lexical_lists = []
+            for future, (_, table_name) in zip(lexical, shards):
+                try:
+                    lexical_lists.append(future.result())
+                except Exception as e:
+                    logger.warning(f"Lexical search of {table_name} failed, using its vector results only: {e}")
+            if not lexical_lists:
+                return semantic_results[:N_results]
+            lexical_results = merge_by_score(lexical_lists, limit)
+            return reciprocal_rank_fusion([lexical_results, semantic_results], N_results, k=rrf_k)
+
+    def collection_query_batch(
+        self,
+        query_texts: List[str],
+        query_vectors: List[List[float]],
+        collections: List[str],
+        N_results: int = 4,
+        retrieval_mode: str = "vector",
+        where: Optional[SearchFilter] = None
+    ) -> List[List[RagSearchResult]]:
+        """
+        Runs many searches of the selected collections. In vector mode the shards are searched concurrently,
+        with the whole batch at once on the exact search backend and one query thread task per query on LanceDB,
+        see semantic_query_batch, and the results of each query are merged by distance. Hybrid searches run one query after the other, see collection_query.
+
+        Args
+        - query_texts (List[str]): The queries for the lexical search.
+        - query_vectors (List[List[float]]): The vectorised queries, in the order of query_texts.
+        - collections (List[str]): Names of the collections to search.
+        - N_results (int): The number of results per query.
+        - retrieval_mode (str): 'vector' for dense search, 'hybrid' for full-text and dense search with rank fusion.
+        - where (Optional[SearchFilter]): Metadata conditions of the searches of every shard.
+
+        Return
+        - search_results (List[List[RagSearchResult]]): The results of each query, best first.
+        """
+        if retrieval_mode == "hybrid":
+            return [
+                self.collection_query(text, vector, collections, N_results, retrieval_mode, where=where)
+                for text, vector in zip(query_texts, query_vectors)
+            ]
+        shards = self.shards(collections)
+        if len(shards) == 1:
+            db, table_name = shards[0]
+            return db.semantic_query_batch(query_vectors, table_name, N_results, where)
+
+        with SEMANTIC_DB_QUERY_SECONDS.time(kind="fan_out"):
+            shard_futures = []
+            for db, table_name in shards:
+                if db.exact_search is not None:
+                    shard_futures.append([self.query_executor.submit(db.semantic_query_batch, query_vectors, table_name, N_results, where)])
+                else:
+                    # Submitted per query here, a batch task waiting for its queries on the same threads could deadlock
+                    shard_futures.append([
+                        self.query_executor.submit(db.semantic_query, vector, table_name, N_results, where=where)
+                        for vector in query_vectors
+                    ])
+            shard_results = [
+                futures[0].result() if db.exact_search is not None else [f.result() for f in futures]
+                for (db, _), futures in zip(shards, shard_futures)
+            ]
+            return [merge_by_distance(list(result_lists), N_results) for result_lists in zip(*shard_results)]
+
+    def build_fts_index(self, table_name="semantic-db-table") -> IndexStatus:
+        """
+        Builds or replaces the full-text index on the text column of a table, blocking until it is done.
+
+        Args
+        - table_name (str): The name of the table in the semantic database.
+
+        Returns
+        - status (IndexStatus): The index state after the build.
+        """
+        return self.index_manager.build_fts_index(table_name)
+
+    def build_index(self, table_name="semantic-db-table") -> IndexStatus:
+        """
+        Builds or replaces the ANN vector index of a table, blocking until it is done.
+
+        Args
+        - table_name (str): The name of the table in the semantic database.
+
+        Returns
+        - status (IndexStatus): The index state after the build.
+        """
+        return self.index_manager.build_index(table_name)
+
+    def index_status(self, table_name="semantic-db-table") -> IndexStatus:
+        """
+        Reports how many rows of a table are covered by its vector index.
+
+        Args
+        - table_name (str): The name of the table in the semantic database.
+
+        Returns
+        - status (IndexStatus): The index state of the table.
+        """
+        return self.index_manager.status(table_name)
+
+    def table_health(self, table_name="semantic-db-table") -> TableHealth:
+        """
+        Fragment, deleted row and version counts of a table.
+
+        Args
+        - table_name (str): The name of the table in the semantic database.
+
+        Return
+        - health (TableHealth): The layout of the table.
+        """
+        return self.maintainer.health(table_name)
+
+    def maintain(self, table_name="semantic-db-table", force=False) -> MaintenanceReport:
+        """
+        Compacts the table, cleans up old versions and optimises its indices if it needs it, and waits for it.
+
+        Args
+        - table_name (str): The name of the table in the semantic database.
+        - force (bool): Run every step even below the thresholds.
+
+        Return
+        - report (MaintenanceReport): Before and after layout of the table.
+        """
+        return self.maintainer.run_in_background(table_name, force).result()
+
+    def table_pool_stats(self) -> TablePoolStats:
+        """
+        Usage counters of the shared table handles, e.g. how often an open handle was reused instead of reopened.
+
+        Returns
+        - stats (TablePoolStats): A snapshot of the table pool counters.
         """
-        results = (lancedb
-                .connect(self.semantic_db_path)
-                .open_table(table_name)
-                .search(query_vector)
-                .limit(N_results))
-        return  [RagSearchResult(**r) for r in results.to_list()]
+        return self.table_pool.stats()
     
     def get_sources(self, results: List[RagSearchResult]) -> List[str]:
         """
@@ -129,11 +1140,11 @@ class SemanticDb:
         - sources (List[str]): The sources used to answer the question as reference style strings.
         """
         try:
-            # Group sources by document
+            # Group sources by document, a deduplicated chunk cites every page it occurs on
             grouped_sources = {}
-            for r in results:
-                doc = r.file_name
-                page = r.page_index
+            for o in (o for r in results for o in (r.occurrences or [r])):
+                doc = o.file_name
+                page = o.page_index
                 if doc in grouped_sources:
                     grouped_sources[doc].append(page)
                 else:
@@ -0,0 +1,131 @@
+import hashlib
+import json
+from typing import TYPE_CHECKING, Dict, List, Optional
+from pydantic import BaseModel
+
+if TYPE_CHECKING:
+    from .semantic_db import RagSearchResult
+
+# The collection of requests that do not select one, backed by the table used before collections existed
+DEFAULT_COLLECTION = "default"
+DEFAULT_TABLE_NAME = "semantic-db-table"
+
+class ShardSpec(BaseModel):
+    """
+    One table of a collection.
+
+    Attributes:
+        table_name (str): The name of the table
+        path (Optional[str]): Folder of the LanceDB database holding the table, the semantic db path if None
+    """
+    table_name: str
+    path: Optional[str] = None
+
+class CollectionSpec(BaseModel):
+    """
+    A named set of documents, split over one or more shard tables.
+
+    Attributes:
+        name (str): The name of the collection
+        shards (List[ShardSpec]): The tables of the collection, documents are assigned to one by file name
+    """
+    name: str
+    shards: List[ShardSpec]
+
+    @classmethod
+    def spread(cls, name: str, num_shards: int = 1, paths: Optional[List[str]] = None) -> "CollectionSpec":
+        """
+        A collection of num_shards tables named '<name>-<i>', placed on the paths round robin.
+
+        Args
+        - name (str): The name of the collection.
+        - num_shards (int): The number of shard tables.
+        - paths (Optional[List[str]]): Database folders, e.g. on different disks, the semantic db path if None.
+
+        Returns
+        - collection (CollectionSpec): The collection.
+        """
+        paths = paths or [None]
+        return cls(name=name, shards=[
+            ShardSpec(table_name=f"{name}-{i}", path=paths[i % len(paths)]) for i in range(num_shards)
+        ])
+
+    def shard_index(self, file_name: str) -> int:
+        """
+        The shard a document is written to. It only depends on the file name, so a new version of
+        a document lands on the shard of the old one and replaces it there in one commit.
+        """
+        if len(self.shards) == 1:
+            return 0
+        digest = hashlib.sha1(file_name.encode("utf-8")).digest()
+        return int.from_bytes(digest[:8], "big") % len(self.shards)
+
+def load_collections(config: Optional[str] = None) -> Dict[str, CollectionSpec]:
+    """
+    Reads collection definitions from a JSON file or string, e.g.
+
+        {
+            "default": {"shards": [{"table_name": "semantic-db-table"}]},
+            "engineering": {"num_shards": 4, "paths": ["/mnt/disk1/db", "/mnt/disk2/db"]}
+        }
+
+    A collection lists its shards explicitly or gives num_shards and optional paths, see CollectionSpec.spread.
+    The 'default' collection is added with the single table 'semantic-db-table' if it is not defined.
+
+    Args
+    - config (Optional[str]): Path of a JSON file or a JSON string, e.g. from COLLECTIONS_CONFIG.
+
+    Returns
+    - collections (Dict[str, CollectionSpec]): The collections by name.
+    """
+    definitions = {}
+    if config:
+        if config.lstrip().startswith("{"):
+            definitions = json.loads(config)
+        else:
+            with open(config) as f:
+                definitions = json.load(f)
+
+    collections = {}
+    for name, definition in definitions.items():
+        if "shards" in definition:
+            collections[name] = CollectionSpec(name=name, shards=definition["shards"])
+        else:
+            collections[name] = CollectionSpec.spread(name, definition.get("num_shards", 1), definition.get("paths"))
+        if not collections[name].shards:
+            raise ValueError(f"Collection {name} has no shards")
+    collections.setdefault(
+        DEFAULT_COLLECTION, CollectionSpec(name=DEFAULT_COLLECTION, shards=[ShardSpec(table_name=DEFAULT_TABLE_NAME)])
+    )
+    return collections
+
+def merge_by_distance(result_lists: List[List["RagSearchResult"]], N_results: int) -> List["RagSearchResult"]:
+    """
+    Merges the vector search results of several shards into the overall top N_results, closest first.
+
+    Args
+    - result_lists (List[List[RagSearchResult]]): Results of each shard, closest first.
+    - N_results (int): The number of merged results to return.
+
+    Returns
+    - results (List[RagSearchResult]): The merged results.
+    """
+    results = [r for results in result_lists for r in results]
+    results.sort(key=lambda r: float("inf") if r.distance is None else r.distance)
+    return results[:N_results]
+
+def merge_by_score(result_lists: List[List["RagSearchResult"]], N_results: int) -> List["RagSearchResult"]:
+    """
+    Merges the full-text search results of several shards by BM25 score, best first.
+    Each shard scores with its own term statistics, which is close enough for shards of a similar mix.
+
+    Args
+    - result_lists (List[List[RagSearchResult]]): Results of each shard, best first.
+    - N_results (int): The number of merged results to return.
+
+    Returns
+    - results (List[RagSearchResult]): The merged results.
+    """
+    results = [r for results in result_lists for r in results]
+    results.sort(key=lambda r: float("-inf") if r.score is None else r.score, reverse=True)
+    return results[:N_results]
@@ -0,0 +1,229 @@
+import logging
+import threading
+from concurrent.futures import Future
+from datetime import timedelta
+from time import monotonic, time
+from typing import Dict, List, Optional
+from pydantic import BaseModel
+from .index_manager import IndexManager, table_indices
+from .table_pool import TablePool
+
+logger = logging.getLogger(__name__)
+
+class TableHealth(BaseModel):
+    """
+    Layout of a table on disk, which drifts with every small write and delete.
+
+    Attributes:
+        table_name (str): The name of the table
+        version (int): Current version of the table
+        num_versions (int): Versions kept on disk
+        num_rows (int): Rows visible to queries
+        num_fragments (int): Data fragments, each small add creates one
+        num_small_fragments (int): Fragments small enough to be merged by compaction
+        num_deleted_rows (int): Rows hidden by deletion markers but still stored and scanned
+        deleted_ratio (float): Deleted rows as a share of the stored rows
+    """
+    table_name: str
+    version: int
+    num_versions: int
+    num_rows: int
+    num_fragments: int
+    num_small_fragments: int
+    num_deleted_rows: int
+    deleted_ratio: float
+
+class MaintenanceReport(BaseModel):
+    """
+    The outcome of a maintenance run.
+
+    Attributes:
+        table_name (str): The name of the table
+        reasons (List[str]): Thresholds that were exceeded, or 'forced'
+        actions (List[str]): Steps that were run
+        before (TableHealth): Layout before the run
+        after (Optional[TableHealth]): Layout after the run, None when it failed
+        seconds (float): Duration of the run
+        error (Optional[str]): Error message when the run failed
+    """
+    table_name: str
+    reasons: List[str] = []
+    actions: List[str] = []
+    before: TableHealth
+    after: Optional[TableHealth] = None
+    seconds: float = 0.0
+    error: Optional[str] = None
+
+class TableMaintainer:
+    """
+    Compacts fragments, removes deletion markers, cleans up old versions and optimises the indices of
+    semantic db tables once their layout passes configurable thresholds.
+
+    Every small add leaves a fragment and every delete leaves deletion markers, which LanceDB still has to
+    open and skip on each scan. Compaction rewrites small fragments into large ones without the deleted rows,
+    and index optimisation merges rows added since the last index build into the indices.
+    Maintenance runs on its own table handle, on the background thread of the IndexManager so it never
+    overlaps an index build, and readers keep querying the version they have until it commits.
+
+    Args
+    - table_pool (TablePool): The pool used to open tables.
+    - index_manager (IndexManager): Runs maintenance on its background thread.
+    - max_fragments (int): Fragment count that triggers compaction.
+    - max_deleted_ratio (float): Share of deleted rows that triggers compaction.
+    - max_versions (int): Version count that triggers a cleanup of old versions.
+    - keep_versions_seconds (float): Versions younger than this are kept, so long running readers are not broken.
+    - target_rows_per_fragment (int): Rows per fragment after compaction.
+    - check_interval (float): Minimum seconds between two automatic checks of the same table.
+    """
+    def __init__(
+        self,
+        table_pool: TablePool,
+        index_manager: IndexManager,
+        max_fragments: int = 32,
+        max_deleted_ratio: float = 0.1,
+        max_versions: int = 100,
+        keep_versions_seconds: float = 3600.0,
+        target_rows_per_fragment: int = 1024 * 1024,
+        check_interval: float = 60.0
+    ):
+        self.table_pool = table_pool
+        self.index_manager = index_manager
+        self.max_fragments = max_fragments
+        self.max_deleted_ratio = max_deleted_ratio
+        self.max_versions = max_versions
+        self.keep_versions_seconds = keep_versions_seconds
+        self.target_rows_per_fragment = target_rows_per_fragment
+        self.check_interval = check_interval
+        self._last_checked: Dict[str, float] = {}
+        self._last_report: Dict[str, MaintenanceReport] = {}
+        self._lock = threading.Lock()
+
+    def health(self, table_name: str) -> TableHealth:
+        """
+        Reads the fragment, deletion and version counts of a table from its manifest.
+
+        Args
+        - table_name (str): The name of the table in the semantic database.
+
+        Returns
+        - health (TableHealth): The layout of the table.
+        """
+        table = self.table_pool.connection.open_table(table_name)
+        dataset = table.to_lance()
+        stats = dataset.stats.dataset_stats()
+        num_rows = table.count_rows()
+        num_deleted_rows = stats["num_deleted_rows"]
+        stored_rows = num_rows + num_deleted_rows
+        return TableHealth(
+            table_name=table_name,
+            version=table.version,
+            num_versions=len(table.list_versions()),
+            num_rows=num_rows,
+            num_fragments=stats["num_fragments"],
+            num_small_fragments=stats["num_small_files"],
+            num_deleted_rows=num_deleted_rows,
+            deleted_ratio=num_deleted_rows / stored_rows if stored_rows else 0.0
+        )
+
+    def reasons(self, health: TableHealth) -> List[str]:
+        """The thresholds a table exceeds, empty when it needs no maintenance."""
+        reasons = []
+        if health.num_fragments > self.max_fragments:
+            reasons.append(f"{health.num_fragments} fragments > {self.max_fragments}")
+        if health.deleted_ratio > self.max_deleted_ratio:
+            reasons.append(f"{health.deleted_ratio:.0%} deleted rows > {self.max_deleted_ratio:.0%}")
+        if health.num_versions > self.max_versions:
+            reasons.append(f"{health.num_versions} versions > {self.max_versions}")
+        return reasons
+
+    def run(self, table_name: str, force: bool = False) -> MaintenanceReport:
+        """
+        Runs the maintenance steps a table needs, or all of them when forced.
+
+        Args
+        - table_name (str): The name of the table in the semantic database.
+        - force (bool): Compact, clean up and optimise even below the thresholds.
+
+        Returns
+        - report (MaintenanceReport): Before and after layout of the table.
+        """
+        before = self.health(table_name)
+        reasons = self.reasons(before) or (["forced"] if force else [])
+        report = MaintenanceReport(table_name=table_name, reasons=reasons, before=before)
+        if not reasons:
+            report.after = before
+            return report
+
+        table = self.table_pool.connection.open_table(table_name)
+        start = time()
+        errors: List[str] = []
+        try:
+            if force or before.num_fragments > self.max_fragments or before.deleted_ratio > self.max_deleted_ratio:
+                logger.info(f"Compacting {table_name} ({before.num_fragments} fragments, {before.num_deleted_rows} deleted rows)")
+                table.compact_files(target_rows_per_fragment=self.target_rows_per_fragment)
+                report.actions.append("compact_files")
+                # Compaction leaves rows added since the last index build outside the indices, merge them in
+                if table_indices(table):
+                    table.to_lance().optimize.optimize_indices()
+                    report.actions.append("optimize_indices")
+        except Exception as e:
+            errors.append(str(e))
+            logger.error(f"Compacting {table_name} failed: {e}")
+        # Compaction adds a version, so clean up after it, also when compaction or the indices failed
+        try:
+            table.cleanup_old_versions(older_than=timedelta(seconds=self.keep_versions_seconds))
+            report.actions.append("cleanup_old_versions")
+        except Exception as e:
+            errors.append(str(e))
+            logger.error(f"Cleaning up old versions of {table_name} failed: {e}")
+        if errors:
+            report.error = "; ".join(errors)
+        report.seconds = time() - start
+        report.after = self.health(table_name)
+        with self._lock:
+            self._last_report[table_name] = report
+        logger.info(
+            f"Maintained {table_name} in {report.seconds:.1f}s: {report.before.num_fragments} -> "
+            f"{report.after.num_fragments} fragments, {report.before.num_versions} -> {report.after.num_versions} versions"
+        )
+        return report
+
+    def run_in_background(self, table_name: str, force: bool = False) -> Future:
+        """
+        Queues a maintenance run on the background thread of the index manager.
+
+        Returns
+        - future (Future): Resolves to the MaintenanceReport.
+        """
+        return self.index_manager.submit(f"{table_name}#maintenance", lambda name: self.run(name, force), table_name)
+
+    def maybe_maintain(self, table_name: str) -> Optional[Future]:
+        """
+        Queues a maintenance run when the table exceeds a threshold, checking each table
+        at most once every check_interval seconds so frequent writes stay cheap.
+
+        Args
+        - table_name (str): The name of the table in the semantic database.
+
+        Returns
+        - future (Optional[Future]): The queued run, None when none was needed or the check was skipped.
+        """
+        now = monotonic()
+        with self._lock:
+            if now - self._last_checked.get(table_name, -self.check_interval) < self.check_interval:
+                return None
+            self._last_checked[table_name] = now
+        try:
+            reasons = self.reasons(self.health(table_name))
+        except Exception as e:
+            logger.warning(f"Could not check the layout of {table_name}: {e}")
+            return None
+        if not reasons:
+            return None
+        logger.info(f"Queueing maintenance of {table_name}: {', '.join(reasons)}")
+        return self.run_in_background(table_name)
+
+    def last_report(self, table_name: str) -> Optional[MaintenanceReport]:
+        """The report of the last maintenance run of a table by this maintainer."""
+        with self._lock:
+            return self._last_report.get(table_name)
@@ -0,0 +1,132 @@
+import threading
+from time import monotonic
+from typing import Dict, Optional
+import lancedb
+from lancedb.db import DBConnection
+from lancedb.table import Table
+from pydantic import BaseModel
+
+class TablePoolStats(BaseModel):
+    """
+    Counters describing how the table handles in a TablePool have been used.
+
+    Attributes:
+        connects (int): Number of times a LanceDB connection was opened
+        opens (int): Number of times a table handle was opened or created
+        reuses (int): Number of times a cached table handle was handed out
+        version_checks (int): Number of cheap checks for a newer table version
+        refreshes (int): Number of version checks that moved a handle to a newer version
+        cached_tables (int): Number of table handles currently held in the pool
+    """
+    connects: int = 0
+    opens: int = 0
+    reuses: int = 0
+    version_checks: int = 0
+    refreshes: int = 0
+    cached_tables: int = 0
+
+    @property
+    def reuse_ratio(self) -> float:
+        total = self.opens + self.reuses
+        return self.reuses / total if total else 0.0
+
+class TablePool:
+    """
+    Holds one long lived LanceDB connection and a cache of open table handles that can be shared across threads.
+
+    Handles are not reopened per call. Instead, at most once every `refresh_interval` seconds a handle is moved
+    onto the latest table version with `checkout_latest`, which only reads the latest manifest pointer,
+    so rows written by another process (e.g. an ingestion job) become visible without reopening the table.
+
+    Args
+    - semantic_db_path (str): Folder path of the LanceDB database.
+    - refresh_interval (float): Minimum seconds between version checks of a cached handle. Use 0 to check on every access.
+    """
+    def __init__(
+        self,
+        semantic_db_path: str,
+        refresh_interval: float = 1.0
+    ):
+        self.semantic_db_path = semantic_db_path
+        self.refresh_interval = refresh_interval
+        self._lock = threading.Lock()
+        self._connection: Optional[DBConnection] = None
+        self._tables: Dict[str, Table] = {}
+        self._last_checked: Dict[str, float] = {}
+        self._stats = TablePoolStats()
+
+    @property
+    def connection(self) -> DBConnection:
+        """The shared LanceDB connection, opened on first use."""
+        with self._lock:
+            return self._connect()
+
+    def _connect(self) -> DBConnection:
+        # Must be called with self._lock held
+        if self._connection is None:
+            # Versions are refreshed explicitly by the pool so the connection does not need to poll on every read
+            self._connection = lancedb.connect(self.semantic_db_path, read_consistency_interval=None)
+            self._stats.connects += 1
+        return self._connection
+
+    def get_table(self, table_name: str, schema=None) -> Table:
+        """
+        Returns a cached handle for a table, opening it on first use.
+
+        Args
+        - table_name (str): The name of the table in the semantic database.
+        - schema: Optional schema. When given the table is created if it does not exist yet.
+
+        Returns
+        - table (Table): An open LanceDB table handle pointing at the latest known version.
+        """
+        with self._lock:
+            table = self._tables.get(table_name)
+            if table is None:
+                connection = self._connect()
+                if schema is not None:
+                    table = connection.create_table(table_name, schema=schema, exist_ok=True)
+                else:
+                    table = connection.open_table(table_name)
+                self._tables[table_name] = table
+                self._last_checked[table_name] = monotonic()
+                self._stats.opens += 1
+                return table
+            self._stats.reuses += 1
+            if monotonic() - self._last_checked[table_name] < self.refresh_interval:
+                return table
+            self._last_checked[table_name] = monotonic()
+            self._stats.version_checks += 1
+        self._refresh(table)
+        return table
+
+    def _refresh(self, table: Table):
+        version = table.version
+        table.checkout_latest()
+        if table.version != version:
+            with self._lock:
+                self._stats.refreshes += 1
+
+    def table_version(self, table_name: str) -> int:
+        """Returns the version of the cached handle for a table after a version check."""
+        return self.get_table(table_name).version
+
+    def invalidate(self, table_name: Optional[str] = None):
+        """
+        Drops cached handles so the next access reopens them, e.g. after a table was dropped or recreated.
+
+        Args
+        - table_name (Optional[str]): The table to drop from the pool. Drops every table when None.
+        """
+        with self._lock:
+            if table_name is None:
+                self._tables.clear()
+                self._last_checked.clear()
+            else:
+                self._tables.pop(table_name, None)
+                self._last_checked.pop(table_name, None)
+
+    def stats(self) -> TablePoolStats:
+        """Returns a snapshot of the pool usage counters."""
+        with self._lock:
+            return self._stats.model_copy(update={"cached_tables": len(self._tables)})
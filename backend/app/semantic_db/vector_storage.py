@@ -0,0 +1,150 @@
+import os
+from typing import List, Optional
+import numpy as np
+import pyarrow as pa
+from pydantic import BaseModel
+
+PRECISIONS = {"float32": pa.float32(), "float16": pa.float16()}
+
+class VectorStorage(BaseModel):
+    """
+    How embeddings are stored for the first stage vector search.
+
+    Matryoshka embedding models such as nomic-embed-text front load the information into the leading
+    dimensions, so a vector can be truncated and renormalised with a small loss of recall.
+    Storing the full precision vectors in a side column lets the top candidates be reranked exactly,
+    while the scan and the index only ever read the compact vectors.
+
+    Attributes:
+        full_dimensions (int): Dimensions of the vectors returned by the embedding model
+        dimensions (Optional[int]): Leading dimensions kept for search, None keeps all
+        precision (str): Float type of the stored search vectors, 'float32' or 'float16'
+        keep_full_vectors (bool): Also store the full float32 vectors in the 'full_vector' column for reranking
+    """
+    full_dimensions: int
+    dimensions: Optional[int] = None
+    precision: str = "float32"
+    keep_full_vectors: bool = False
+
+    @classmethod
+    def from_env(cls, full_dimensions: int) -> "VectorStorage":
+        """Reads the storage mode from VECTOR_STORAGE_DIMENSIONS, VECTOR_STORAGE_PRECISION and VECTOR_STORAGE_FULL_VECTORS."""
+        dimensions = os.getenv("VECTOR_STORAGE_DIMENSIONS")
+        return cls(
+            full_dimensions=full_dimensions,
+            dimensions=int(dimensions) if dimensions else None,
+            precision=os.getenv("VECTOR_STORAGE_PRECISION", "float32"),
+            keep_full_vectors=os.getenv("VECTOR_STORAGE_FULL_VECTORS", "false").lower() == "true"
+        )
+
+    @property
+    def search_dimensions(self) -> int:
+        return min(self.dimensions or self.full_dimensions, self.full_dimensions)
+
+    @property
+    def value_type(self) -> pa.DataType:
+        if self.precision not in PRECISIONS:
+            raise ValueError(f"Unsupported vector precision {self.precision}, use one of {list(PRECISIONS)}")
+        return PRECISIONS[self.precision]
+
+    @property
+    def compressed(self) -> bool:
+        return self.search_dimensions < self.full_dimensions or self.precision != "float32"
+
+    @property
+    def search_bytes_per_vector(self) -> int:
+        return self.search_dimensions * self.value_type.bit_width // 8
+
+    @property
+    def compression_ratio(self) -> float:
+        """How many times less memory and I/O the search vectors take than full float32 vectors."""
+        return self.full_dimensions * 4 / self.search_bytes_per_vector
+
+    def describe(self) -> str:
+        """Short id of the storage mode, e.g. '256/float16+full'. Empty for full float32 vectors."""
+        if not self.compressed and not self.keep_full_vectors:
+            return ""
+        return f"{self.search_dimensions}/{self.precision}" + ("+full" if self.keep_full_vectors else "")
+
+    def search_vectors(self, vectors: List[List[float]]) -> List[List[float]]:
+        """
+        Truncates and renormalises vectors to the search dimensions.
+
+        Args
+        - vectors (List[List[float]]): Full vectors from the embedding model.
+
+        Returns
+        - search_vectors (List[List[float]]): The compact vectors as floats, e.g. to query the table.
+        """
+        if not self.compressed:
+            return vectors
+        return truncate_and_normalise(np.asarray(vectors, dtype=np.float32), self.search_dimensions).tolist()
+
+    def stored_vectors(self, vectors: List[List[float]]) -> List[np.ndarray]:
+        """
+        Converts search vectors to the numpy float type of the 'vector' column, as arrow does not
+        cast python floats to float16 on write.
+
+        Args
+        - vectors (List[List[float]]): Vectors from search_vectors, or read back from the table.
+
+        Returns
+        - stored_vectors (List[np.ndarray]): The vectors ready to be written.
+        """
+        dtype = np.float16 if self.value_type == pa.float16() else np.float32
+        return list(np.asarray(vectors, dtype=dtype))
+
+def truncate_and_normalise(vectors: np.ndarray, dimensions: int) -> np.ndarray:
+    """
+    Keeps the leading dimensions of matryoshka vectors and scales them back to unit length.
+
+    Args
+    - vectors (np.ndarray): Vectors as rows, shape (n, full_dimensions).
+    - dimensions (int): Leading dimensions to keep.
+
+    Returns
+    - vectors (np.ndarray): Unit length vectors, shape (n, dimensions).
+    """
+    truncated = vectors[:, :dimensions]
+    norms = np.linalg.norm(truncated, axis=1, keepdims=True)
+    return truncated / np.where(norms == 0, 1, norms)
+
+def rerank_by_full_vectors(query_vector: List[float], rows: List[dict], N_results: int) -> List[dict]:
+    """
+    Orders search candidates by their exact L2 distance between full precision vectors.
+
+    Args
+    - query_vector (List[float]): The full vectorised user query.
+    - rows (List[dict]): Search results with a 'full_vector' column.
+    - N_results (int): The number of results to return.
+
+    Returns
+    - rows (List[dict]): The N_results closest rows, with '_distance' set to the full precision distance.
+    """
+    if not rows:
+        return rows
+    full_vectors = np.asarray([r["full_vector"] for r in rows], dtype=np.float32)
+    distances = np.sum((full_vectors - np.asarray(query_vector, dtype=np.float32)) ** 2, axis=1)
+    order = np.argsort(distances, kind="stable")[:N_results]
+    return [{**rows[i], "_distance": float(distances[i])} for i in order]
+
+class VectorRecallReport(BaseModel):
+    """
+    Recall of the compact vector search against an exact search over the full precision vectors.
+
+    Attributes:
+        storage (str): The storage mode, see VectorStorage.describe
+        N_results (int): Results compared per query
+        queries (int): Number of sampled queries
+        recall_first_stage (float): Share of the exact top results found by the compact search alone
+        recall_reranked (float): Share of the exact top results found after reranking with full vectors
+        search_bytes_per_vector (int): Bytes per stored search vector
+        compression_ratio (float): Full float32 vector size divided by the search vector size
+    """
+    storage: str
+    N_results: int
+    queries: int
+    recall_first_stage: float
+    recall_reranked: float
+    search_bytes_per_vector: int
+    compression_ratio: float
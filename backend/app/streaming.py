@@ -0,0 +1,151 @@
+import asyncio
+import json
+import logging
+import re
+from contextlib import suppress
+from time import perf_counter
+from typing import AsyncIterator, Iterator, List, Optional, Union
+from .models import AsyncContentStream, StreamFrame
+
+logger = logging.getLogger(__name__)
+
+EVENT_STREAM = "text/event-stream"
+
+def wants_event_stream(accept: Optional[str]) -> bool:
+    """True if the Accept header of a request asks for Server-Sent Events."""
+    return bool(accept) and EVENT_STREAM in accept
+
+def text_fragments(text: str) -> Iterator[str]:
+    """
+    Splits a complete answer into words with their leading whitespace, like the tokens of a generation,
+    so coalesce sends a replayed answer in the same pieces as a live stream.
+
+    Args
+    - text (str): The answer.
+
+    Yields
+    - (str): The fragments, joined they give the text.
+    """
+    for match in re.finditer(r"\s*\S+|\s+", text):
+        yield match.group(0)
+
+async def coalesce(
+    stream: AsyncContentStream,
+    max_chars: int = 64,
+    max_delay: float = 0.05
+) -> AsyncIterator[Union[str, StreamFrame]]:
+    """
+    Joins the answer fragments of an agent stream, so a response is written in a few larger pieces
+    instead of one small write per token. Text is sent once max_chars are buffered or max_delay seconds
+    after the first buffered fragment, even if no further fragment arrives. The first fragment is sent
+    straight away so the time to first token does not change, frames flush the text before them.
+
+    Args
+    - stream (AsyncContentStream): The agent stream of strings and frames.
+    - max_chars (int): Characters buffered at most, 0 sends every fragment on its own.
+    - max_delay (float): Seconds a fragment waits for others at most.
+
+    Yields
+    - (Union[str, StreamFrame]): Joined text and the frames of the stream.
+    """
+    iterator = stream.__aiter__()
+    if max_chars <= 0:
+        async for item in iterator:
+            yield item
+        return
+    buffer: List[str] = []
+    buffered = 0
+    deadline: Optional[float] = None
+    first = True
+    # The pending read is kept across timeouts, cancelling it would close the agent stream
+    next_item: Optional[asyncio.Future] = None
+    try:
+        while True:
+            if next_item is None:
+                next_item = asyncio.ensure_future(iterator.__anext__())
+            if buffer:
+                done, _ = await asyncio.wait([next_item], timeout=max(0.0, deadline - perf_counter()))
+                if not done:
+                    yield "".join(buffer)
+                    buffer, buffered, deadline = [], 0, None
+                    continue
+            try:
+                item = await next_item
+            except StopAsyncIteration:
+                break
+            next_item = None
+            if not item:
+                continue
+            if isinstance(item, bytes):
+                item = item.decode("utf-8")
+            if isinstance(item, StreamFrame):
+                if buffer:
+                    yield "".join(buffer)
+                    buffer, buffered, deadline = [], 0, None
+                yield item
+                continue
+            if first:
+                first = False
+                yield item
+                continue
+            if not buffer:
+                deadline = perf_counter() + max_delay
+            buffer.append(item)
+            buffered += len(item)
+            if buffered >= max_chars:
+                yield "".join(buffer)
+                buffer, buffered, deadline = [], 0, None
+        if buffer:
+            yield "".join(buffer)
+    finally:
+        if next_item is not None and not next_item.done():
+            # Stops the agent stream where it waits, e.g. aborting the upstream generation
+            next_item.cancel()
+            with suppress(BaseException):
+                await next_item
+        aclose = getattr(iterator, "aclose", None)
+        if aclose is not None:
+            await aclose()
+
+async def text_stream(stream: AsyncIterator[Union[str, StreamFrame]]) -> AsyncIterator[str]:
+    """The stream as plain text, as sent by /chat and /rag before typed frames existed."""
+    async for item in stream:
+        text = item.text() if isinstance(item, StreamFrame) else item
+        if text:
+            yield text
+
+def sse_event(event: str, data: dict) -> bytes:
+    """One Server-Sent Event, the JSON data has no raw line breaks so it fits on one data line."""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n".encode("utf-8")
+
+async def sse_stream(stream: AsyncIterator[Union[str, StreamFrame]]) -> AsyncIterator[bytes]:
+    """
+    The stream as Server-Sent Events: 'token' events with {'text': ...}, 'references' and 'error'
+    events with the data of their frame, and a final 'stats' event with the characters and token events
+    sent, the seconds the stream took and the Ollama token counts and durations of the generation.
+    An exception of the agent ends the stream with an 'error' event instead of a broken response.
+
+    Args
+    - stream (AsyncIterator[Union[str, StreamFrame]]): The coalesced agent stream.
+
+    Yields
+    - (bytes): The encoded events.
+    """
+    start = perf_counter()
+    stats = {"chars": 0, "token_events": 0}
+    try:
+        async for item in stream:
+            if isinstance(item, StreamFrame):
+                if item.event == "stats":
+                    stats.update(item.data)
+                    continue
+                yield sse_event(item.event, item.data)
+            elif item:
+                stats["chars"] += len(item)
+                stats["token_events"] += 1
+                yield sse_event("token", {"text": item})
+    except Exception as e:
+        logger.error(f"Stream failed: {e}")
+        yield sse_event("error", {"message": str(e)})
+    stats["seconds"] = perf_counter() - start
+    yield sse_event("stats", stats)
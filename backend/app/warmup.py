@@ -0,0 +1,82 @@
+import asyncio
+import logging
+from time import perf_counter, time
+from typing import Awaitable, Dict, List, Optional, Union
+from pydantic import BaseModel
+from .agents.llm import preload_model
+from .agents.rag import aget_resources, rag_collections, rag_retrieval_mode
+
+logger = logging.getLogger(__name__)
+
+class WarmupStatus(BaseModel):
+    """
+    Progress of the startup warm-up.
+
+    Attributes:
+        ready (bool): Warm-up finished, requests no longer pay for loading models or opening the table
+        started_at (Optional[float]): Unix time the warm-up started
+        finished_at (Optional[float]): Unix time the warm-up finished
+        steps (Dict[str, float]): Seconds each finished step took
+        errors (Dict[str, str]): Steps that failed and why, the first request retries them
+    """
+    ready: bool = False
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    steps: Dict[str, float] = {}
+    errors: Dict[str, str] = {}
+
+async def _step(status: WarmupStatus, name: str, step: Awaitable):
+    start = perf_counter()
+    try:
+        result = await step
+    except Exception as e:
+        status.errors[name] = str(e)
+        logger.warning(f"Warm-up step {name} failed: {e}")
+        return None
+    status.steps[name] = perf_counter() - start
+    return result
+
+async def _warm_retrieval(status: WarmupStatus, collections: List[str]):
+    resources = await _step(status, "resources", aget_resources())
+    if resources is None:
+        return
+    # Loads the embedding model, with the keep alive of the embedding backend
+    query_vector = await _step(status, "embedding_model", resources.query_embedder.embed("warm up"))
+    semantic_db = resources.semantic_db
+    # Opens the shard tables of the collections
+    if await _step(status, "tables", asyncio.to_thread(semantic_db.collection_version, collections)) is None:
+        return
+    if query_vector is None:
+        return
+    # Reads the indices and the first data files into the page cache
+    search = asyncio.to_thread(
+        semantic_db.collection_query, "warm up", query_vector, collections, retrieval_mode=rag_retrieval_mode
+    )
+    await _step(status, "search", search)
+
+async def warm_up(
+    status: WarmupStatus,
+    collections: Optional[List[str]] = None,
+    keep_alive: Optional[Union[int, str]] = None
+):
+    """
+    Preloads the LLM and the embedding model into Ollama, creates the RAG resources, opens the shard tables
+    and runs a dummy search, so the first request is as fast as later ones. The LLM loads while the
+    retrieval side warms up. Failed steps are recorded in the status and do not stop the others.
+
+    Args
+    - status (WarmupStatus): Updated as the steps finish, reported by the readiness endpoint.
+    - collections (Optional[List[str]]): The collections to open and search, RAG_COLLECTIONS if None.
+    - keep_alive (Optional[Union[int, str]]): How long Ollama keeps the LLM loaded, e.g. '30m' or -1.
+    """
+    status.started_at = time()
+    await asyncio.gather(
+        _step(status, "llm_model", preload_model(keep_alive)),
+        _warm_retrieval(status, collections or rag_collections)
+    )
+    status.finished_at = time()
+    status.ready = True
+    logger.info(
+        f"Warm-up finished in {status.finished_at - status.started_at:.1f}s: "
+        + ", ".join(f"{name} {seconds:.2f}s" for name, seconds in status.steps.items())
+    )
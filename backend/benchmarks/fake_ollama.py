@@ -0,0 +1,107 @@
+import argparse
+import asyncio
+import json
+from time import perf_counter_ns
+from typing import List, Union
+from fastapi import FastAPI
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel
+from .stub_embedder import StubEmbedder
+
+class FakeOllamaSettings(BaseModel):
+    """
+    Timing of the fake Ollama server.
+
+    Attributes:
+        tokens_per_second (float): Generation speed of each stream
+        first_token_ms (float): Delay before the first token, e.g. prompt evaluation
+        response_tokens (int): Tokens generated per response
+        parallel (int): Generations run at once, like OLLAMA_NUM_PARALLEL, others wait
+        embed_ms (float): Latency of an embed call
+        embed_ms_per_input (float): Extra latency per embedded text
+        dimensions (int): Dimensions of the embeddings
+    """
+    tokens_per_second: float = 30.0
+    first_token_ms: float = 200.0
+    response_tokens: int = 200
+    parallel: int = 4
+    embed_ms: float = 10.0
+    embed_ms_per_input: float = 1.0
+    dimensions: int = 768
+
+class GenerateRequest(BaseModel):
+    model: str = ""
+    prompt: str = ""
+
+class EmbedRequest(BaseModel):
+    model: str = ""
+    input: Union[str, List[str]]
+
+def create_app(settings: FakeOllamaSettings) -> FastAPI:
+    """
+    Creates a local stand in for the Ollama API that streams /api/generate as NDJSON and answers /api/embed,
+    with configurable latency and token rate, so the FastAPI service can be load tested without a GPU.
+
+    Args
+    - settings (FakeOllamaSettings): Timing of the fake server.
+
+    Returns
+    - app (FastAPI): The fake Ollama app.
+    """
+    app = FastAPI()
+    generation_slots = asyncio.Semaphore(settings.parallel)
+    embedder = StubEmbedder(settings.dimensions)
+
+    async def generate_lines(request: GenerateRequest):
+        async with generation_slots:
+            start = perf_counter_ns()
+            await asyncio.sleep(settings.first_token_ms / 1000)
+            prompt_done = perf_counter_ns()
+            for i in range(settings.response_tokens):
+                if i:
+                    await asyncio.sleep(1 / settings.tokens_per_second)
+                line = {"model": request.model, "response": f"token{i} ", "done": False}
+                yield json.dumps(line) + "\n"
+            end = perf_counter_ns()
+            yield json.dumps({
+                "model": request.model,
+                "response": "",
+                "done": True,
+                "total_duration": end - start,
+                "prompt_eval_count": len(request.prompt) // 4,
+                "prompt_eval_duration": prompt_done - start,
+                "eval_count": settings.response_tokens,
+                "eval_duration": end - prompt_done
+            }) + "\n"
+
+    @app.post("/api/generate")
+    async def generate(request: GenerateRequest):
+        # Without a prompt Ollama only loads the model, as the warm-up of the backend does
+        if not request.prompt:
+            return {"model": request.model, "response": "", "done": True, "done_reason": "load"}
+        return StreamingResponse(generate_lines(request), media_type="application/x-ndjson")
+
+    @app.post("/api/embed")
+    async def embed(request: EmbedRequest):
+        inputs = [request.input] if isinstance(request.input, str) else request.input
+        await asyncio.sleep((settings.embed_ms + settings.embed_ms_per_input * len(inputs)) / 1000)
+        return {"model": request.model, "embeddings": embedder.get_embeddings(inputs)}
+
+    return app
+
+def main():
+    import uvicorn
+    parser = argparse.ArgumentParser(
+        description="Fake Ollama server for load tests",
+        usage="poetry run python -m benchmarks.fake_ollama --port 11435 --tokens-per-second 30"
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11435)
+    for name, field in FakeOllamaSettings.model_fields.items():
+        parser.add_argument(f"--{name.replace('_', '-')}", type=field.annotation, default=field.default, help=field.description)
+    args = parser.parse_args()
+    settings = FakeOllamaSettings(**{name: getattr(args, name) for name in FakeOllamaSettings.model_fields})
+    uvicorn.run(create_app(settings), host=args.host, port=args.port, log_level="warning")
+
+if __name__ == "__main__":
+    main()
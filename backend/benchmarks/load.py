@@ -0,0 +1,158 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+from datetime import datetime, timezone
+from time import perf_counter
+from typing import Dict, List, Optional
+import httpx
+import numpy as np
+from pydantic import BaseModel
+
+logger = logging.getLogger(__name__)
+
+# Same rough estimate as the context packer, the driver only sees text
+CHARS_PER_TOKEN = 4
+
+class RequestSample(BaseModel):
+    """
+    Timing of one request of a simulated chat session.
+
+    Attributes:
+        status (int): HTTP status, 0 if the request failed without a response
+        ttfb_seconds (Optional[float]): Time to the first byte of the answer
+        latency_seconds (float): Time to the end of the answer
+        tokens (int): Estimated tokens in the answer
+    """
+    status: int
+    ttfb_seconds: Optional[float] = None
+    latency_seconds: float
+    tokens: int = 0
+
+def percentiles(values: List[float]) -> Dict[str, Optional[float]]:
+    if not values:
+        return {"p50": None, "p95": None, "p99": None}
+    return {f"p{p}": float(np.percentile(values, p)) for p in (50, 95, 99)}
+
+async def send(client: httpx.AsyncClient, url: str, question: str) -> RequestSample:
+    start = perf_counter()
+    ttfb = None
+    chars = 0
+    try:
+        async with client.stream("POST", url, json={"messages": [{"role": "user", "content": question}]}) as r:
+            async for text in r.aiter_text():
+                if ttfb is None and text:
+                    ttfb = perf_counter() - start
+                chars += len(text)
+            status = r.status_code
+    except httpx.HTTPError:
+        status = 0
+    return RequestSample(
+        status=status,
+        ttfb_seconds=ttfb,
+        latency_seconds=perf_counter() - start,
+        tokens=chars // CHARS_PER_TOKEN
+    )
+
+async def session(client: httpx.AsyncClient, url: str, question: str, deadline: float, think_seconds: float, samples: List[RequestSample]):
+    """A simulated user asking one question after the other until the deadline."""
+    while perf_counter() < deadline:
+        samples.append(await send(client, url, question))
+        if think_seconds:
+            await asyncio.sleep(think_seconds)
+
+async def run_step(url: str, question: str, concurrency: int, duration: float, think_seconds: float) -> Dict:
+    """Runs `concurrency` sessions for `duration` seconds and summarises their requests."""
+    samples: List[RequestSample] = []
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(timeout=httpx.Timeout(300.0), limits=limits) as client:
+        start = perf_counter()
+        deadline = start + duration
+        await asyncio.gather(*[
+            session(client, url, question, deadline, think_seconds, samples) for _ in range(concurrency)
+        ])
+        elapsed = perf_counter() - start
+
+    ok = [s for s in samples if s.status == 200]
+    stream_rates = [
+        s.tokens / (s.latency_seconds - s.ttfb_seconds)
+        for s in ok if s.ttfb_seconds is not None and s.latency_seconds > s.ttfb_seconds
+    ]
+    return {
+        "concurrency": concurrency,
+        "requests": len(samples),
+        "errors": len(samples) - len(ok),
+        "rejected": sum(1 for s in samples if s.status == 503),
+        "error_rate": (len(samples) - len(ok)) / len(samples) if samples else 0.0,
+        "requests_per_second": len(ok) / elapsed,
+        "tokens_per_second": sum(s.tokens for s in ok) / elapsed,
+        "stream_tokens_per_second": float(np.mean(stream_rates)) if stream_rates else None,
+        "ttfb_seconds": percentiles([s.ttfb_seconds for s in ok if s.ttfb_seconds is not None]),
+        "latency_seconds": percentiles([s.latency_seconds for s in ok])
+    }
+
+def saturation_point(steps: List[Dict], min_gain: float = 0.05, max_error_rate: float = 0.01) -> Optional[int]:
+    """
+    The concurrency after which more sessions stop adding throughput or start failing.
+
+    Args
+    - steps (List[Dict]): Step results in increasing concurrency.
+    - min_gain (float): Relative throughput gain below which a step counts as saturated.
+    - max_error_rate (float): Error rate above which a step counts as saturated.
+
+    Returns
+    - concurrency (Optional[int]): The last concurrency before saturation, None if no step saturated.
+    """
+    for previous, step in zip(steps, steps[1:]):
+        gain = step["tokens_per_second"] / previous["tokens_per_second"] - 1 if previous["tokens_per_second"] else 0
+        if gain < min_gain or step["error_rate"] > max_error_rate:
+            return previous["concurrency"]
+    return None
+
+async def run(args) -> Dict:
+    url = args.url.rstrip("/") + "/" + args.endpoint
+    steps = []
+    for concurrency in [int(c) for c in args.concurrency.split(",")]:
+        logger.info(f"Running {concurrency} concurrent sessions against {url} for {args.duration}s")
+        step = await run_step(url, args.question, concurrency, args.duration, args.think_seconds)
+        logger.info(
+            f"{concurrency} sessions: {step['requests_per_second']:.2f} req/s, "
+            f"{step['tokens_per_second']:.0f} tokens/s, ttfb p99 {step['ttfb_seconds']['p99']}, "
+            f"error rate {step['error_rate']:.1%}"
+        )
+        steps.append(step)
+    return {
+        "url": url,
+        "args": vars(args),
+        "steps": steps,
+        "saturation_concurrency": saturation_point(steps)
+    }
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(
+        description="Load test /chat or /rag with concurrent simulated chat sessions",
+        usage="poetry run python -m benchmarks.load --endpoint rag --concurrency 1,2,4,8,16,32"
+    )
+    parser.add_argument("--url", default="http://127.0.0.1:8000", help="Base URL of the FastAPI service")
+    parser.add_argument("--endpoint", default="chat", choices=["chat", "rag"])
+    parser.add_argument("--concurrency", default="1,2,4,8,16,32", help="Comma separated numbers of concurrent sessions")
+    parser.add_argument("--duration", type=float, default=30.0, help="Seconds per concurrency step")
+    parser.add_argument("--think-seconds", type=float, default=0.0, help="Pause between the questions of a session")
+    parser.add_argument("--question", default="What is the maintenance schedule of the pump?")
+    parser.add_argument("--output", default=None, help="JSON file for the results, benchmarks/results/load-<timestamp>.json by default")
+    args = parser.parse_args()
+
+    started = datetime.now(timezone.utc)
+    report = {"started": started.isoformat(), **asyncio.run(run(args))}
+    output = args.output or os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "results", "load-" + started.strftime("%Y%m%dT%H%M%SZ") + ".json"
+    )
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    logger.info(f"Saturation at {report['saturation_concurrency']} sessions, results written to {output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,245 @@
+import argparse
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+from datetime import datetime, timezone
+from time import perf_counter
+from typing import Dict, List
+
+import numpy as np
+import pyarrow as pa
+
+from app.semantic_db.pdf_utils import iter_pdf_chunks
+from app.semantic_db.semantic_db import SemanticDb
+from app.semantic_db.vector_storage import VectorStorage, truncate_and_normalise
+from benchmarks.stub_embedder import StubEmbedder
+from benchmarks.synthetic import SyntheticVectors, make_pdf_directory
+
+logger = logging.getLogger(__name__)
+
+def directory_bytes(path: str) -> int:
+    """Total size of the files under a directory."""
+    total = 0
+    for root, _, files in os.walk(path):
+        total += sum(os.path.getsize(os.path.join(root, f)) for f in files)
+    return total
+
+def fixed_size_list(vectors: np.ndarray, value_type: pa.DataType) -> pa.FixedSizeListArray:
+    dtype = np.float16 if value_type == pa.float16() else np.float32
+    return pa.FixedSizeListArray.from_arrays(pa.array(vectors.astype(dtype).ravel()), vectors.shape[1])
+
+def synthetic_rows(semantic_db: SemanticDb, start: int, vectors: np.ndarray) -> pa.Table:
+    """
+    Rows of the semantic db table for a batch of synthetic vectors, built as arrow columns
+    so writing a million rows is not dominated by creating pydantic models.
+    The page_index holds the row number, which identifies the row when measuring recall.
+    """
+    storage = semantic_db.vector_storage
+    row_numbers = range(start, start + len(vectors))
+    search_vectors = (
+        truncate_and_normalise(vectors, storage.search_dimensions) if storage.compressed else vectors
+    )
+    columns = {
+        "text": pa.array([f"synthetic chunk {i}" for i in row_numbers]),
+        "vector": fixed_size_list(search_vectors, storage.value_type),
+        "file_name": pa.array([f"synthetic-{i // 1000:04d}.pdf" for i in row_numbers]),
+        "file_id": pa.array([f"synthetic-{i // 1000:04d}" for i in row_numbers]),
+        "page_label": pa.array([str(i) for i in row_numbers]),
+        "page_index": pa.array(row_numbers, pa.int64())
+    }
+    if storage.keep_full_vectors:
+        columns["full_vector"] = fixed_size_list(vectors, pa.float32())
+    return pa.Table.from_pydict(columns, schema=semantic_db.EmbeddedChunk.to_arrow_schema())
+
+def bench_pdfs(work_dir: str, semantic_db: SemanticDb, files: int, pages: int) -> Dict:
+    """Measures pages/sec of the pdf extraction and chunks/sec of ingesting the pdfs with the stub embedder."""
+    paths = make_pdf_directory(os.path.join(work_dir, "pdfs"), files, pages)
+
+    start = perf_counter()
+    chunks = 0
+    for path in paths:
+        for _ in iter_pdf_chunks(
+            path,
+            os.path.basename(path),
+            "bench",
+            chunk_size=semantic_db.chunk_size,
+            chunk_overlap=semantic_db.chunk_overlap
+        ):
+            chunks += 1
+    extract_seconds = perf_counter() - start
+
+    start = perf_counter()
+    for i, path in enumerate(paths):
+        semantic_db.add_file_to_semantic_db(path, os.path.basename(path), f"bench-{i}", table_name="bench-pdf")
+    ingest_seconds = perf_counter() - start
+
+    # Query the ingested chunks, so the write path of the storage mode is checked end to end,
+    # unlike the corpora which are written as arrow tables
+    query_vector = semantic_db.embedding_function(text_chunks=["synthetic page"])[0]
+    if not semantic_db.semantic_query(query_vector, "bench-pdf", N_results=4):
+        raise RuntimeError("Querying the ingested pdfs returned no chunks")
+    recall = None
+    if semantic_db.vector_storage.keep_full_vectors:
+        recall = semantic_db.vector_recall("bench-pdf", N_results=4, sample_size=50).model_dump()
+
+    return {
+        "files": files,
+        "pages": files * pages,
+        "chunks": chunks,
+        "extract_seconds": extract_seconds,
+        "extract_pages_per_second": files * pages / extract_seconds,
+        "ingest_seconds": ingest_seconds,
+        "ingest_chunks_per_second": chunks / ingest_seconds,
+        "vector_recall": recall
+    }
+
+def bench_corpus(
+    semantic_db: SemanticDb,
+    size: int,
+    dimensions: int,
+    ks: List[int],
+    queries: int,
+    write_batch_rows: int
+) -> Dict:
+    """Measures writing, indexing and querying a table of `size` synthetic vectors, and recall against exact search."""
+    table_name = f"bench-{size}"
+    corpus = SyntheticVectors(size, dimensions, batch_size=write_batch_rows)
+
+    start = perf_counter()
+    for batch_start, vectors in corpus.batches():
+        (semantic_db.table_pool
+            .get_table(table_name, schema=semantic_db.EmbeddedChunk)
+            .add(synthetic_rows(semantic_db, batch_start, vectors)))
+    write_seconds = perf_counter() - start
+
+    index_seconds = None
+    status = semantic_db.index_status(table_name)
+    if semantic_db.index_manager.needs_build(status):
+        start = perf_counter()
+        status = semantic_db.build_index(table_name)
+        index_seconds = perf_counter() - start
+
+    query_vectors = corpus.queries(queries)
+    exact = corpus.exact_neighbours(query_vectors, max(ks))
+    query_results = []
+    for k in ks:
+        latencies = []
+        found = 0
+        for query_vector, neighbours in zip(query_vectors, exact):
+            start = perf_counter()
+            results = semantic_db.semantic_query(query_vector.tolist(), table_name, N_results=k)
+            latencies.append(perf_counter() - start)
+            found += len({r.page_index for r in results} & set(neighbours[:k].tolist()))
+        query_results.append({
+            "k": k,
+            "p50_ms": float(np.percentile(latencies, 50) * 1000),
+            "p99_ms": float(np.percentile(latencies, 99) * 1000),
+            "recall": found / (k * len(query_vectors))
+        })
+
+    return {
+        "chunks": size,
+        "write_seconds": write_seconds,
+        "write_chunks_per_second": size / write_seconds,
+        "table_bytes": directory_bytes(os.path.join(semantic_db.semantic_db_path, f"{table_name}.lance")),
+        "index_type": status.index_type,
+        "index_seconds": index_seconds,
+        "queries": query_results
+    }
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except Exception:
+        return ""
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(
+        description="Offline benchmark of pdf extraction, ingestion and retrieval with a stub embedder",
+        usage="poetry run python -m benchmarks.run --sizes 1000,10000,100000"
+    )
+    parser.add_argument("--sizes", default="1000,10000,100000", help="Comma separated corpus sizes in chunks, up to 1000000")
+    parser.add_argument("--ks", default="4,10,50", help="Comma separated numbers of results per query")
+    parser.add_argument("--queries", type=int, default=200, help="Queries per corpus size and k")
+    parser.add_argument("--dimensions", type=int, default=768, help="Dimensions of the synthetic vectors")
+    parser.add_argument("--pdf-files", type=int, default=4, help="Synthetic pdfs for the extraction benchmark")
+    parser.add_argument("--pdf-pages", type=int, default=250, help="Pages per synthetic pdf")
+    parser.add_argument("--chunk-size", type=int, default=None, help="Split pages into windows of at most this many characters")
+    parser.add_argument("--write-batch-rows", type=int, default=10_000, help="Chunks per table write")
+    parser.add_argument("--index-type", default="IVF_PQ", choices=["IVF_PQ", "IVF_HNSW_SQ"])
+    parser.add_argument("--index-min-rows", type=int, default=50_000, help="Build the vector index from this corpus size")
+    parser.add_argument("--storage-dimensions", type=int, default=None, help="Truncate stored search vectors, see VectorStorage")
+    parser.add_argument("--storage-precision", default="float32", choices=["float32", "float16"])
+    parser.add_argument("--keep-full-vectors", action="store_true", help="Store full vectors and rerank with them")
+    parser.add_argument("--search-backend", default="lancedb", choices=["lancedb", "exact"], help="Search the tables or memory-mapped snapshots of them")
+    parser.add_argument("--work-dir", default=None, help="Folder for the pdfs and tables, a temporary folder by default")
+    parser.add_argument("--output", default=None, help="JSON file for the results, benchmarks/results/<timestamp>.json by default")
+    args = parser.parse_args()
+
+    started = datetime.now(timezone.utc)
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="rag-bench-")
+    stub = StubEmbedder(args.dimensions)
+    semantic_db = SemanticDb(
+        embedding_function=stub.get_embeddings,
+        vec_dimension=args.dimensions,
+        semantic_db_path=os.path.join(work_dir, "db"),
+        index_type=args.index_type,
+        index_min_rows=args.index_min_rows,
+        auto_index=False,
+        chunk_size=args.chunk_size,
+        search_backend=args.search_backend,
+        vector_storage=VectorStorage(
+            full_dimensions=args.dimensions,
+            dimensions=args.storage_dimensions,
+            precision=args.storage_precision,
+            keep_full_vectors=args.keep_full_vectors
+        )
+    )
+
+    try:
+        logger.info("Benchmarking pdf extraction and ingestion")
+        pdfs = bench_pdfs(work_dir, semantic_db, args.pdf_files, args.pdf_pages)
+        corpora = []
+        for size in [int(s) for s in args.sizes.split(",")]:
+            logger.info(f"Benchmarking a corpus of {size} chunks")
+            corpora.append(bench_corpus(
+                semantic_db,
+                size,
+                args.dimensions,
+                [int(k) for k in args.ks.split(",")],
+                args.queries,
+                args.write_batch_rows
+            ))
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {
+        "started": started.isoformat(),
+        "git_commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+        "args": vars(args),
+        "storage": semantic_db.vector_storage.describe() or "full",
+        "pdfs": pdfs,
+        "corpora": corpora
+    }
+    output = args.output or os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "results", started.strftime("%Y%m%dT%H%M%SZ") + ".json"
+    )
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    logger.info(f"Results written to {output}")
+
+if __name__ == "__main__":
+    main()
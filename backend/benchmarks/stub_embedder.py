@@ -0,0 +1,34 @@
+import hashlib
+from typing import List
+import numpy as np
+
+class StubEmbedder:
+    """
+    Deterministic local stand in for OllamaVecs, so benchmarks measure our code and not the embedding model.
+    Each text maps to a fixed unit vector seeded by its hash, the same text always gets the same vector.
+
+    Args
+    - dimensions (int): Dimensions of the vectors.
+    """
+    def __init__(self, dimensions: int = 768):
+        self.dimensions = dimensions
+        self.embedding_model = f"stub-{dimensions}"
+        self.calls = 0
+
+    def _vector(self, text: str) -> np.ndarray:
+        seed = int.from_bytes(hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest(), "little")
+        vector = np.random.default_rng(seed).standard_normal(self.dimensions, dtype=np.float32)
+        return vector / np.linalg.norm(vector)
+
+    def get_embeddings(self, text_chunks: List[str]) -> List[List[float]]:
+        self.calls += 1
+        return [self._vector(t).tolist() for t in text_chunks]
+
+    def get_embedding(self, text: str) -> List[float]:
+        return self.get_embeddings([text])[0]
+
+    async def aget_embeddings(self, text_chunks: List[str]) -> List[List[float]]:
+        return self.get_embeddings(text_chunks)
+
+    async def aget_embedding(self, text: str) -> List[float]:
+        return self.get_embedding(text)
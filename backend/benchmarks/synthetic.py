@@ -0,0 +1,105 @@
+import os
+from typing import Iterator, List, Tuple
+import numpy as np
+import pymupdf
+
+# Small fixed vocabulary so the generated text looks like prose to the chunker and the full-text index
+WORDS = (
+    "pump valve pressure flow sensor torque seal bearing shaft motor inspect replace clean check "
+    "maintenance schedule warning caution operator manual section table figure procedure install "
+    "remove tighten loosen calibrate measure record report hours cycle temperature limit nominal"
+).split()
+
+def synthetic_text(rng: np.random.Generator, words: int) -> str:
+    """Random prose of the given number of words, with a line break every 14 words."""
+    chosen = rng.choice(WORDS, size=words)
+    lines = [" ".join(chosen[i:i + 14]) for i in range(0, words, 14)]
+    return "\n".join(lines)
+
+def make_pdf(path: str, pages: int, words_per_page: int = 350, seed: int = 0):
+    """
+    Writes a pdf of synthetic text pages.
+
+    Args
+    - path (str): Path of the pdf to write.
+    - pages (int): Number of pages.
+    - words_per_page (int): Words of text on each page.
+    - seed (int): Seed of the text.
+    """
+    rng = np.random.default_rng(seed)
+    doc = pymupdf.open()
+    for _ in range(pages):
+        page = doc.new_page()
+        page.insert_text((50, 60), synthetic_text(rng, words_per_page), fontsize=8)
+    doc.save(path)
+    doc.close()
+
+def make_pdf_directory(directory: str, files: int, pages_per_file: int, seed: int = 0) -> List[str]:
+    """Writes `files` synthetic pdfs into a directory and returns their paths."""
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for i in range(files):
+        path = os.path.join(directory, f"synthetic-{i:04d}.pdf")
+        make_pdf(path, pages_per_file, seed=seed + i)
+        paths.append(path)
+    return paths
+
+class SyntheticVectors:
+    """
+    A reproducible corpus of clustered unit vectors, generated batch by batch so corpora
+    of a million vectors never have to be held in memory at once.
+
+    Args
+    - size (int): Number of vectors.
+    - dimensions (int): Dimensions of the vectors.
+    - clusters (int): Number of clusters, a clustered corpus gives the ANN index realistic structure.
+    - batch_size (int): Vectors per generated batch.
+    - seed (int): Seed of the corpus.
+    """
+    def __init__(self, size: int, dimensions: int, clusters: int = 256, batch_size: int = 10_000, seed: int = 0):
+        self.size = size
+        self.dimensions = dimensions
+        self.batch_size = batch_size
+        self.seed = seed
+        self.centres = np.random.default_rng(seed).standard_normal((clusters, dimensions), dtype=np.float32)
+
+    def _unit(self, vectors: np.ndarray) -> np.ndarray:
+        return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+    def batches(self) -> Iterator[Tuple[int, np.ndarray]]:
+        """Yields the start row and the vectors of each batch, always the same for the same seed."""
+        for batch, start in enumerate(range(0, self.size, self.batch_size)):
+            rows = min(self.batch_size, self.size - start)
+            rng = np.random.default_rng((self.seed, batch))
+            labels = rng.integers(0, len(self.centres), size=rows)
+            noise = rng.standard_normal((rows, self.dimensions), dtype=np.float32)
+            yield start, self._unit(self.centres[labels] + 0.7 * noise)
+
+    def queries(self, count: int) -> np.ndarray:
+        """Query vectors near random clusters, not identical to any stored vector."""
+        # A seed sequence of a different length than the batch seeds, so queries are never stored vectors
+        rng = np.random.default_rng((self.seed, self.size, count))
+        labels = rng.integers(0, len(self.centres), size=count)
+        noise = rng.standard_normal((count, self.dimensions), dtype=np.float32)
+        return self._unit(self.centres[labels] + 0.7 * noise)
+
+    def exact_neighbours(self, queries: np.ndarray, k: int) -> np.ndarray:
+        """
+        Row numbers of the k nearest stored vectors of each query by L2 distance, found by brute force.
+
+        Returns
+        - neighbours (np.ndarray): Shape (len(queries), k), nearest first.
+        """
+        best_distances = np.full((len(queries), k), np.inf, dtype=np.float32)
+        best_rows = np.zeros((len(queries), k), dtype=np.int64)
+        for start, vectors in self.batches():
+            # For unit vectors the squared L2 distance is 2 - 2 * dot product
+            distances = 2 - 2 * queries @ vectors.T
+            distances = np.concatenate([best_distances, distances], axis=1)
+            batch_rows = np.broadcast_to(np.arange(start, start + len(vectors)), (len(queries), len(vectors)))
+            rows = np.concatenate([best_rows, batch_rows], axis=1)
+            top = np.argpartition(distances, k - 1, axis=1)[:, :k]
+            best_distances = np.take_along_axis(distances, top, axis=1)
+            best_rows = np.take_along_axis(rows, top, axis=1)
+        order = np.argsort(best_distances, axis=1)
+        return np.take_along_axis(best_rows, order, axis=1)
@@ -0,0 +1,119 @@
+from app.semantic_db.semantic_db import SemanticDb
+from app.semantic_db.dedup import DedupSettings
+from app.semantic_db.ollama_vecs import OllamaVecs
+from app.semantic_db.vector_storage import VectorStorage
+from dotenv import load_dotenv
+import argparse
+import logging
+
+load_dotenv()
+
+def get_semantic_db(semantic_db_path: str) -> SemanticDb:
+    """
+    Creates a SemanticDb for maintenance tasks, with automatic index builds turned off.
+
+    Args:
+        semantic_db_path (str): Path where the semantic database is stored
+
+    Returns:
+        SemanticDb: The semantic database
+    """
+    ollama_vecs = OllamaVecs()
+    if not ollama_vecs.dimensions:
+        raise ValueError('Vector dimensions cannot be undefined')
+    return SemanticDb(
+        embedding_function=ollama_vecs.get_embeddings,
+        vec_dimension=ollama_vecs.dimensions,
+        semantic_db_path=semantic_db_path,
+        auto_index=False,
+        auto_maintenance=False,
+        vector_storage=VectorStorage.from_env(ollama_vecs.dimensions),
+        dedup=DedupSettings.from_env()
+    )
+
+def index_status(semantic_db: SemanticDb, table_name: str):
+    status = semantic_db.index_status(table_name)
+    print(status.model_dump_json(indent=2))
+
+def index_build(semantic_db: SemanticDb, table_name: str, index_type: str, min_rows: int, force: bool):
+    semantic_db.index_manager.index_type = index_type
+    semantic_db.index_manager.min_rows = min_rows
+    status = semantic_db.index_status(table_name)
+    if not force and not semantic_db.index_manager.needs_build(status):
+        print(f"Index on {table_name} is up to date, use --force to rebuild anyway")
+        print(status.model_dump_json(indent=2))
+        return
+    try:
+        status = semantic_db.build_index(table_name)
+    except ValueError as e:
+        print(e)
+        return
+    print(status.model_dump_json(indent=2))
+
+def index_build_fts(semantic_db: SemanticDb, table_name: str):
+    status = semantic_db.build_fts_index(table_name)
+    print(status.model_dump_json(indent=2))
+
+def maintenance_status(semantic_db: SemanticDb, table_name: str):
+    health = semantic_db.table_health(table_name)
+    print(health.model_dump_json(indent=2))
+    reasons = semantic_db.maintainer.reasons(health)
+    print(f"Needs maintenance: {', '.join(reasons)}" if reasons else "No maintenance needed")
+
+def maintenance_run(semantic_db: SemanticDb, table_name: str, force: bool, keep_versions_seconds: float):
+    semantic_db.maintainer.keep_versions_seconds = keep_versions_seconds
+    report = semantic_db.maintain(table_name, force=force)
+    print(report.model_dump_json(indent=2))
+
+def vector_recall(semantic_db: SemanticDb, table_name: str, k: int, samples: int, rerank_factor: int):
+    semantic_db.rerank_factor = rerank_factor
+    report = semantic_db.vector_recall(table_name, N_results=k, sample_size=samples)
+    print(report.model_dump_json(indent=2))
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Maintenance tasks for the semantic database")
+    parser.add_argument("semantic_db_path", help="Path where the semantic database is stored, e.g. db_semantic/")
+    parser.add_argument("--table", default="semantic-db-table", help="Name of the table in the semantic database")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    index_parser = commands.add_parser("index", help="Inspect or build the ANN vector index")
+    index_commands = index_parser.add_subparsers(dest="index_command", required=True)
+    index_commands.add_parser("status", help="Show indexed and unindexed row counts")
+    build_parser = index_commands.add_parser("build", help="Build or rebuild the vector index")
+    build_parser.add_argument("--index-type", default="IVF_PQ", choices=["IVF_PQ", "IVF_HNSW_SQ"])
+    build_parser.add_argument("--min-rows", type=int, default=50_000, help="Skip the build below this row count")
+    build_parser.add_argument("--force", action="store_true", help="Build even if the index is up to date")
+    index_commands.add_parser("build-fts", help="Build or rebuild the full-text index used by hybrid retrieval")
+
+    maintenance_parser = commands.add_parser("maintenance", help="Inspect or run compaction and cleanup of old versions")
+    maintenance_commands = maintenance_parser.add_subparsers(dest="maintenance_command", required=True)
+    maintenance_commands.add_parser("status", help="Show fragment, deleted row and version counts")
+    run_parser = maintenance_commands.add_parser("run", help="Compact, clean up old versions and optimise indices if needed")
+    run_parser.add_argument("--force", action="store_true", help="Run even below the thresholds")
+    run_parser.add_argument("--keep-versions-seconds", type=float, default=3600.0, help="Keep versions younger than this")
+
+    recall_parser = commands.add_parser("recall", help="Measure the recall of compact vector storage against full vectors")
+    recall_parser.add_argument("--k", type=int, default=10, help="Results compared per query")
+    recall_parser.add_argument("--samples", type=int, default=100, help="Number of chunks sampled as queries")
+    recall_parser.add_argument("--rerank-factor", type=int, default=4, help="Candidates reranked per result")
+
+    args = parser.parse_args()
+    semantic_db = get_semantic_db(args.semantic_db_path)
+    if args.command == "index":
+        if args.index_command == "status":
+            index_status(semantic_db, args.table)
+        elif args.index_command == "build":
+            index_build(semantic_db, args.table, args.index_type, args.min_rows, args.force)
+        elif args.index_command == "build-fts":
+            index_build_fts(semantic_db, args.table)
+    elif args.command == "maintenance":
+        if args.maintenance_command == "status":
+            maintenance_status(semantic_db, args.table)
+        elif args.maintenance_command == "run":
+            maintenance_run(semantic_db, args.table, args.force, args.keep_versions_seconds)
+    elif args.command == "recall":
+        vector_recall(semantic_db, args.table, args.k, args.samples, args.rerank_factor)
+
+if __name__ == "__main__":
+    main()
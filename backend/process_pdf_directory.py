@@ -1,47 +1,117 @@
 from app.semantic_db.semantic_db import SemanticDb
+from app.semantic_db.dedup import DedupSettings
 import os
 from app.semantic_db.ollama_vecs import OllamaVecs
-from app.semantic_db.pdf_utils import get_pdf_bytes
+from app.semantic_db.embedding_cache import EmbeddingCache
+from app.semantic_db.embedding_batches import EmbeddingBatchPolicy
+from app.semantic_db.ingest_pipeline import IngestPipeline
+from app.semantic_db.manifest import IngestManifest
+from app.semantic_db.pdf_utils import check_chunking
+from app.semantic_db.sharding import load_collections
+from app.semantic_db.vector_storage import VectorStorage
 from dotenv import load_dotenv
-from time import time
+import argparse
 import logging
-import sys
+from time import perf_counter
 # from app.semantic_db.openai_vecs import OpenAIVecs
 # openai_api_key = os.getenv("OPENAI_API_KEY")
 
-if len(sys.argv) != 3:
-    print("Usage: poetry run python process_pdf_directory.py pdfs/ db_semantic/")
-    sys.exit(1)
-
 load_dotenv()
 
 def process_pdf_directory(
     pdf_dir_path: str,
     semantic_db_path: str,
+    parse_workers: int = 4,
+    embed_workers: int = 2,
+    queue_size: int = 8,
+    write_batch_rows: int = 5000,
+    embedding_cache_dir: str | None = None,
+    chunk_size: int | None = None,
+    chunk_overlap: int = 200,
+    fts_index: bool = False,
+    storage_dimensions: int | None = None,
+    storage_precision: str = "float32",
+    keep_full_vectors: bool = False,
+    collection: str | None = None,
+    dedup: bool = False,
+    dedup_threshold: float = 0.9,
+    embed_request_chars: int = 50_000,
+    embed_request_concurrency: int = 2,
+    manifest_dir: str | None = None,
 ) -> tuple[int, list[str]]:
     """
     Process all PDFs in a directory and add them to a semantic database.
-    
+    Parsing, embedding and writing run as concurrent pipeline stages, see IngestPipeline.
+
+    A manifest next to the table (see IngestManifest) makes re-runs incremental: unchanged files are
+    skipped, changed files have their rows replaced and files removed from the directory have their rows deleted.
+
     Args:
         pdf_dir_path (str): Path to directory containing PDF files
         semantic_db_path (str): Path where semantic database should be stored
-        
+        parse_workers (int): Number of processes parsing PDFs
+        embed_workers (int): Number of concurrent embedding calls
+        queue_size (int): Maximum number of files waiting between pipeline stages
+        write_batch_rows (int): Number of chunks batched into one table write
+        embedding_cache_dir (str | None): Folder of an on-disk embedding cache, so unchanged text is not re-embedded
+        chunk_size (int | None): Split pages into overlapping windows of at most this many characters, None keeps whole pages
+        chunk_overlap (int): Number of characters shared by consecutive windows of a page
+        fts_index (bool): Keep a full-text index on the chunk text up to date for hybrid retrieval
+        storage_dimensions (int | None): Truncate the stored search vectors to this many dimensions, None keeps all
+        storage_precision (str): Float type of the stored search vectors, 'float32' or 'float16'
+        keep_full_vectors (bool): Also store the full float32 vectors for reranking, see VectorStorage
+        collection (str | None): Spread the files over the shards of this collection from COLLECTIONS_CONFIG,
+            None writes them to the 'semantic-db-table' table
+        dedup (bool): Store near-identical chunks once with the pages they occur on, see ChunkDeduplicator.
+            Fixed per table, the server needs INGEST_DEDUP=true to read them
+        dedup_threshold (float): Estimated word shingle similarity from which two chunks count as one
+        embed_request_chars (int): Characters of text per embedding request at most, see EmbeddingBatchPolicy
+        embed_request_concurrency (int): Embedding requests in flight per embed worker
+        manifest_dir (str | None): Local folder of the manifest, needed when semantic_db_path is a remote URI such as s3://
+
     Returns:
         tuple[int, list[str]]: Number of files processed and list of any failed files
     """
     # Set up logging
     logging.basicConfig(level=logging.INFO)
     logger = logging.getLogger(__name__)
-    
+
     # Initialize embedding function and semantic DB
-    ollama_vecs = OllamaVecs()
+    batch_policy = EmbeddingBatchPolicy.from_env().model_copy(
+        update={"max_chars": embed_request_chars, "concurrency": embed_request_concurrency}
+    )
+    ollama_vecs = OllamaVecs(batch_policy=batch_policy)
     if not ollama_vecs.dimensions:
         raise ValueError('Vector dimensions cannot be undefined')
+    embedding_function = ollama_vecs.get_embeddings
+    if embedding_cache_dir:
+        embedding_cache = EmbeddingCache(
+            embedding_function,
+            embedding_model=ollama_vecs.embedding_model,
+            dimensions=ollama_vecs.dimensions,
+            cache_dir=embedding_cache_dir
+        )
+        embedding_function = embedding_cache.get_embeddings
+    vector_storage = VectorStorage(
+        full_dimensions=ollama_vecs.dimensions,
+        dimensions=storage_dimensions,
+        precision=storage_precision,
+        keep_full_vectors=keep_full_vectors
+    )
     semantic_db = SemanticDb(
-        embedding_function=ollama_vecs.get_embeddings,
+        embedding_function=embedding_function,
         vec_dimension=ollama_vecs.dimensions,
-        semantic_db_path=semantic_db_path
+        semantic_db_path=semantic_db_path,
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap,
+        fts_index=fts_index,
+        vector_storage=vector_storage,
+        collections=load_collections(os.getenv("COLLECTIONS_CONFIG")),
+        dedup=DedupSettings(threshold=dedup_threshold) if dedup else None
     )
+    if collection is not None:
+        # Fails early on an unknown collection
+        semantic_db.collection(collection)
 
     # openai_vecs = OpenAIVecs(api_key=openai_api_key)
     # semantic_db = SemanticDb(
@@ -49,54 +119,133 @@ def process_pdf_directory(
     #     vec_dimension=openai_vecs.dimensions,
     #     semantic_db_path="test_db_semantic/"
     # )
-    
-    # Helper function to generate timestamp IDs
-    def get_timestamp_id() -> str:
-        return str(int(time() * 1000000))
-    
+
     # Validate directory exists
     if not os.path.isdir(pdf_dir_path):
         raise ValueError(f"Directory not found: {pdf_dir_path}")
-    
+
     # Get list of PDF files
     pdf_files = [f for f in os.listdir(pdf_dir_path) if f.lower().endswith('.pdf')]
     if not pdf_files:
         logger.warning(f"No PDF files found in {pdf_dir_path}")
-        return 0, []
-    
-    processed_count = 0
-    failed_files = []
-    
-    # Process each PDF file
-    for pdf_file in pdf_files:
-        full_path = os.path.join(pdf_dir_path, pdf_file)
-        try:
-                
-            # Read and process the PDF
-            logger.info(f"Processing: {pdf_file}")
-            pdf_bytes = get_pdf_bytes(full_path)
-            
-            semantic_db.add_file_to_semantic_db(
-                doc_as_bytes=pdf_bytes,
-                file_name=pdf_file,
-                file_id=get_timestamp_id()
-            )
-            
-            processed_count += 1
-            logger.info(f"Successfully processed: {pdf_file}")
-            
-        except Exception as e:
-            logger.error(f"Failed to process {pdf_file}: {str(e)}")
-            failed_files.append(pdf_file)
-            
-    logger.info(f"Processing complete. Successfully processed {processed_count} files.")
+
+    # Work out what changed since the last run
+    # A collection has one manifest for all its shards
+    manifest = IngestManifest(semantic_db_path, collection or "semantic-db-table", manifest_dir)
+    plan = manifest.plan(
+        pdf_dir_path,
+        pdf_files,
+        # A new storage mode means new vectors, like a new model
+        embedding_model="@".join(filter(None, [ollama_vecs.embedding_model, vector_storage.describe()])),
+        chunking=f"{chunk_size}/{chunk_overlap}" if chunk_size else ""
+    )
+    logger.info(
+        f"{len(plan.to_ingest)} new or changed files, {len(plan.unchanged)} unchanged, "
+        f"{len(plan.deleted)} deleted"
+    )
+
+    # Remove the rows of files that are no longer in the directory
+    if plan.deleted:
+        deleted_file_ids = [e.file_id for e in plan.deleted]
+        if collection:
+            semantic_db.delete_files_from_collection(deleted_file_ids, collection)
+        else:
+            semantic_db.delete_files_from_semantic_db(deleted_file_ids)
+        manifest.remove([e.file_name for e in plan.deleted])
+
+    pipeline = IngestPipeline(
+        semantic_db,
+        parse_workers=parse_workers,
+        embed_workers=embed_workers,
+        queue_size=queue_size,
+        write_batch_rows=write_batch_rows,
+        collection=collection,
+        on_batch_written=manifest.record_written
+    )
+    start = perf_counter()
+    result = pipeline.run(plan.to_ingest)
+    elapsed = perf_counter() - start
+    # Persist mtimes of files that were touched but not modified
+    manifest.save()
+    for db in semantic_db.databases():
+        db.index_manager.wait()
+
+    processed_count = len(result.processed_files)
+    failed_files = result.failed_files
+    logger.info(f"Processing complete. Successfully processed {processed_count} files ({result.chunks_written} chunks).")
+    if elapsed > 0:
+        logger.info(
+            f"Ingested {result.pages_parsed} pages in {elapsed:.1f}s "
+            f"({result.pages_parsed / elapsed:.1f} pages/s, {result.chunks_written / elapsed:.1f} chunks/s)"
+        )
     if failed_files:
         logger.warning(f"Failed to process {len(failed_files)} files: {failed_files}")
-        
+    if result.dedup is not None:
+        logger.info(
+            f"Deduplication: {result.dedup.unique_chunks} of {result.dedup.chunks} chunks stored "
+            f"({result.dedup.duplicate_ratio:.0%} near duplicates: {result.dedup.duplicates_in_file} within files, "
+            f"{result.dedup.duplicates_across_files} across files, {result.dedup.duplicates_of_stored} of stored chunks)"
+        )
+        if result.dedup.orphaned_references:
+            logger.warning(f"Dropped {result.dedup.orphaned_references} occurrences of chunks of failed files")
+    if embedding_cache_dir:
+        embedding_cache.flush()
+        cache_stats = embedding_cache.stats()
+        logger.info(f"Embedding cache: {cache_stats.hits} hits, {cache_stats.misses} misses ({cache_stats.hit_ratio:.0%} hit ratio)")
+
     return processed_count, failed_files
 
 
-process_pdf_directory(
-    pdf_dir_path = sys.argv[1],
-    semantic_db_path = sys.argv[2],
-)
\ No newline at end of file
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Embed the PDFs in a directory into the semantic database",
+        usage="poetry run python process_pdf_directory.py pdfs/ db_semantic/"
+    )
+    parser.add_argument("pdf_dir_path", help="Directory containing PDF files")
+    parser.add_argument("semantic_db_path", help="Path where the semantic database is stored")
+    parser.add_argument("--parse-workers", type=int, default=4, help="Number of processes parsing PDFs")
+    parser.add_argument("--embed-workers", type=int, default=2, help="Number of concurrent embedding calls")
+    parser.add_argument("--queue-size", type=int, default=8, help="Maximum files waiting between pipeline stages")
+    parser.add_argument("--write-batch-rows", type=int, default=5000, help="Chunks batched into one table write")
+    parser.add_argument("--chunk-size", type=int, default=os.getenv("CHUNK_SIZE") or None, help="Split pages into windows of at most this many characters")
+    parser.add_argument("--chunk-overlap", type=int, default=int(os.getenv("CHUNK_OVERLAP", "200")), help="Characters shared by consecutive windows of a page")
+    parser.add_argument("--fts-index", action="store_true", help="Maintain a full-text index for hybrid retrieval")
+    parser.add_argument("--storage-dimensions", type=int, default=os.getenv("VECTOR_STORAGE_DIMENSIONS"), help="Truncate stored search vectors to this many dimensions")
+    parser.add_argument("--storage-precision", default=os.getenv("VECTOR_STORAGE_PRECISION", "float32"), choices=["float32", "float16"], help="Float type of the stored search vectors")
+    parser.add_argument("--keep-full-vectors", action="store_true", default=os.getenv("VECTOR_STORAGE_FULL_VECTORS", "false").lower() == "true", help="Also store full precision vectors for reranking")
+    parser.add_argument("--collection", default=None, help="Collection from COLLECTIONS_CONFIG whose shards the files are spread over")
+    parser.add_argument("--dedup", action="store_true", default=os.getenv("INGEST_DEDUP", "false").lower() == "true", help="Store near-identical chunks once with the pages they occur on")
+    parser.add_argument("--dedup-threshold", type=float, default=float(os.getenv("INGEST_DEDUP_THRESHOLD", "0.9")), help="Similarity from which two chunks count as one")
+    parser.add_argument("--embed-request-chars", type=int, default=int(os.getenv("EMBED_REQUEST_MAX_CHARS", "50000")), help="Characters of text per embedding request at most")
+    parser.add_argument("--embed-request-concurrency", type=int, default=int(os.getenv("EMBED_REQUEST_CONCURRENCY", "2")), help="Embedding requests in flight per embed worker")
+    parser.add_argument("--manifest-dir", default=None, help="Local folder of the ingest manifest, needed for a remote semantic db path")
+    parser.add_argument("--embedding-cache-dir", default=os.getenv("EMBEDDING_CACHE_DIR"), help="Folder of the on-disk embedding cache")
+    args = parser.parse_args()
+    try:
+        check_chunking(args.chunk_size, args.chunk_overlap)
+    except ValueError as e:
+        parser.error(str(e))
+    if "://" in args.semantic_db_path and args.manifest_dir is None:
+        parser.error("a remote semantic_db_path needs a local --manifest-dir for the ingest manifest")
+
+    process_pdf_directory(
+        pdf_dir_path = args.pdf_dir_path,
+        semantic_db_path = args.semantic_db_path,
+        parse_workers = args.parse_workers,
+        embed_workers = args.embed_workers,
+        queue_size = args.queue_size,
+        write_batch_rows = args.write_batch_rows,
+        embedding_cache_dir = args.embedding_cache_dir,
+        chunk_size = args.chunk_size,
+        chunk_overlap = args.chunk_overlap,
+        fts_index = args.fts_index,
+        storage_dimensions = args.storage_dimensions,
+        storage_precision = args.storage_precision,
+        keep_full_vectors = args.keep_full_vectors,
+        collection = args.collection,
+        dedup = args.dedup,
+        dedup_threshold = args.dedup_threshold,
+        embed_request_chars = args.embed_request_chars,
+        embed_request_concurrency = args.embed_request_concurrency,
+        manifest_dir = args.manifest_dir,
+    )
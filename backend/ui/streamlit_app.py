@@ -1,3 +1,4 @@
+import uuid
 import streamlit as st
 import requests
 
@@ -6,8 +7,8 @@ BASE_URL = "http://localhost:8000"
 URL_EXT = "/rag"
 URL = f"{BASE_URL}{URL_EXT}"
 
-def chat_response(messages):
-    with requests.post(URL, json={"messages": messages}, stream=True) as r:
+def chat_response(messages, session_id):
+    with requests.post(URL, json={"messages": messages, "session_id": session_id}, stream=True) as r:
         for chunk in r.iter_content(None, decode_unicode=True):
             if chunk:
                 yield chunk
@@ -16,6 +17,9 @@ st.title('Ask the data a question')
 
 if "messages" not in st.session_state:
     st.session_state.messages = []
+# Lets the backend continue the LLM context of the earlier turns
+if "session_id" not in st.session_state:
+    st.session_state.session_id = uuid.uuid4().hex
 
 for message in st.session_state.messages:
     with st.chat_message(message["role"]):
@@ -31,5 +35,5 @@ if prompt := st.chat_input("What is up?"):
             {"role": m["role"], "content": m["content"]}
             for m in st.session_state.messages
         ]
-        response = st.write_stream(chat_response(messages))
+        response = st.write_stream(chat_response(messages, st.session_state.session_id))
     st.session_state.messages.append({"role": "assistant", "content": response})
\ No newline at end of file